@@ -10,7 +10,17 @@ import numpy as np
 import pandas as pd
 from scipy import sparse
 
-from .common import OBS_TERM_COLUMNS, VAR_TERM_COLUMNS, get_ctypes, log, parse_manifest
+from .common import (
+    OBS_DICTIONARY_COLUMNS,
+    OBS_TERM_COLUMNS,
+    VAR_TERM_COLUMNS,
+    encode_obs_columns,
+    get_ctypes,
+    load_obs_dictionary,
+    log,
+    parse_manifest,
+    save_obs_dictionaries,
+)
 
 
 def compute_raw_X_normed(raw_X: sparse.spmatrix):
@@ -23,76 +33,161 @@ def compute_raw_X_normed(raw_X: sparse.spmatrix):
         return sparse.diags((1.0 / raw_X.sum(axis=1)).A1).dot(raw_X).tocoo()
 
 
-def load_axes_dataframes(uri: str, datasets: list, ctx: tiledb.Ctx, current_schema_only: bool, verbose: bool):
-    # accumulate unique var_ids - ie, merge the datasets on the var/feature axis
-    var_names = set()
-    obs_row_start_idx = 0
+def read_filtered_axes(h5ad, current_schema_only: bool):
+    """
+    Read the H5AD obs and raw var, filtered to primary human cells and genes. Return
+    (obs_df, var_names), or None if the dataset is skipped.
+    """
+    if not os.path.exists(h5ad.path):
+        log("H5AD path does not exist", h5ad.path)
+        return None
 
-    for h5ad_idx, h5ad in enumerate(datasets):
-        if not os.path.exists(h5ad.path):
-            log("H5AD path does not exist", h5ad.path)
-            continue
+    ad = anndata.read_h5ad(h5ad.path, backed="r")
+    cxg_version = get_cellxgene_schema_version(ad)
 
-        if verbose:
-            log(f"Adding {h5ad_idx+1} of {len(datasets)}: {h5ad.path}")
+    if current_schema_only and cxg_version != "2.0.0":
+        log("H5AD has old schema version, skipping...", h5ad.path)
+        return None
 
-        ad = anndata.read_h5ad(h5ad.path, backed="r")
-        cxg_version = get_cellxgene_schema_version(ad)
+    _, raw_var = get_raw(ad)
+    if raw_var is None:
+        log("H5AD does NOT contain required RAW data. Skipping...", h5ad.path)
+        return None
 
-        if current_schema_only and cxg_version != "2.0.0":
-            log("H5AD has old schema version, skipping...", h5ad.path)
-            continue
+    # Create a copy of AnnData from which we slice primary data and genes ONLY.
+    ad = filter_anndata(anndata.AnnData(X=None, obs=ad.obs, var=raw_var))
+    if ad.n_obs == 0:
+        log("H5AD has no data after filtering, skipping...", h5ad.path)
+        return None
 
-        _, raw_var = get_raw(ad)
-        if raw_var is None:
-            print("H5AD does NOT contain required RAW data. Skipping...", h5ad.path)
-            return
+    # subset axis dataframes to the columns we care about and standardize index name
+    obs_df = ad.obs[OBS_TERM_COLUMNS].copy()
+    obs_df["dataset_id"] = h5ad.dataset_id
+    obs_df.index.rename("obs_name", inplace=True)
+    obs_df.reset_index(inplace=True)
+    var_df = raw_var[VAR_TERM_COLUMNS]
+    return obs_df, set(var_df.index)
 
-        # Create a copy of AnnData from which we slice primary data and genes ONLY.
-        ad = filter_anndata(anndata.AnnData(X=None, obs=ad.obs, var=raw_var))
-        if ad.n_obs == 0:
-            log("H5AD has no data after filtering, skipping...", h5ad.path)
-            continue
 
-        # subset axis dataframes to the columns we care about and standardize index name
-        obs_df = ad.obs[OBS_TERM_COLUMNS].copy()
-        obs_df["dataset_id"] = h5ad.dataset_id
-        var_df = raw_var[VAR_TERM_COLUMNS]
+def count_filtered_obs(h5ad, current_schema_only: bool, verbose: bool):
+    """
+    Return (number of filtered obs rows, var names, { dictionary-encoded column: distinct
+    values }) of the H5AD, or None if it is skipped.
+    """
+    if verbose:
+        log("reading obs...", h5ad.path)
+    axes = read_filtered_axes(h5ad, current_schema_only)
+    if axes is None:
+        return None
+    obs_df, var_names = axes
+    distinct_values = {column: set(obs_df[column].unique()) for column in OBS_DICTIONARY_COLUMNS}
+    return len(obs_df), var_names, distinct_values
 
-        # build a set of unique var_name
-        var_names |= set(var_df.index)
 
-        # incrementally append obs
-        if verbose:
-            log("saving obs...", h5ad.path)
-        obs_df.index.rename("obs_name", inplace=True)
-        obs_df.reset_index(inplace=True)
-        column_types, varlen_types = get_ctypes(obs_df)
-        tiledb.from_pandas(
-            uri=f"{uri}/obs",
-            dataframe=obs_df,
-            mode="append",
-            ctx=ctx,
-            column_types=column_types,
-            varlen_types=varlen_types,
-            row_start_idx=obs_row_start_idx,
-        )
-
-        obs_row_start_idx += len(obs_df)
+def save_obs(
+    uri: str,
+    h5ad,
+    row_start_idx: int,
+    n_obs: int,
+    dictionaries: dict,
+    tdb_config: dict,
+    current_schema_only: bool,
+    verbose: bool,
+):
+    """
+    Write the H5AD filtered obs, dictionary-encoded, as a fragment of the obs array, at rows
+    [row_start_idx, row_start_idx + n_obs).
+    """
+    obs_df, _ = read_filtered_axes(h5ad, current_schema_only)
+    if len(obs_df) != n_obs:
+        raise Exception(f"{h5ad.path} changed while loading, expected {n_obs} obs rows, found {len(obs_df)}")
+    encode_obs_columns(obs_df, dictionaries)
 
     if verbose:
-        log(f"Total rows={obs_row_start_idx}")
+        log(f"saving obs at row {row_start_idx}...", h5ad.path)
+    column_types, varlen_types = get_ctypes(obs_df)
+    tiledb.from_pandas(
+        uri=f"{uri}/obs",
+        dataframe=obs_df,
+        mode="append",
+        ctx=tiledb.Ctx(tdb_config),
+        column_types=column_types,
+        varlen_types=varlen_types,
+        row_start_idx=row_start_idx,
+    )
+
+
+def load_axes_dataframes(
+    uri: str, datasets: list, tdb_config: dict, current_schema_only: bool, max_workers: int, verbose: bool
+):
+    """
+    Load the obs and var of all datasets, in two passes over a process pool:
+
+    1. read and filter each dataset's obs and var, counting its obs rows
+    2. write each dataset's obs at its row offset, which is the prefix sum of the row
+       counts of the datasets before it (in manifest order), so the obs rows are in the
+       same order however the writes are scheduled
+
+    The term columns and dataset_id are dictionary-encoded, with a dictionary per column
+    of the sorted distinct values of all datasets, which is saved before the obs.
+
+    The var names of all datasets are then merged, and saved in sorted order.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as pp:
+        futures = [pp.submit(count_filtered_obs, h5ad, current_schema_only, verbose) for h5ad in datasets]
+        counts = [future.result() for future in futures]
+
+        # accumulate unique var_ids - ie, merge the datasets on the var/feature axis
+        var_names = set()
+        distinct_values = {column: set() for column in OBS_DICTIONARY_COLUMNS}
+        loaded = []
+        obs_row_start_idx = 0
+        for h5ad, count in zip(datasets, counts):
+            if count is None:
+                continue
+            n_obs, dataset_var_names, dataset_distinct_values = count
+            var_names |= dataset_var_names
+            for column, values in dataset_distinct_values.items():
+                distinct_values[column] |= values
+            loaded.append((h5ad, obs_row_start_idx, n_obs))
+            obs_row_start_idx += n_obs
+
+        if verbose:
+            log(f"Total rows={obs_row_start_idx}")
+
+        # saved in a worker, as the pool may still fork, and this process must not hold a TileDB context when it does
+        dictionaries = {column: sorted(values) for column, values in distinct_values.items()}
+        if loaded:
+            pp.submit(save_obs_dictionaries, uri, dictionaries, tdb_config).result()
+
+        futures = [
+            pp.submit(
+                save_obs, uri, h5ad, row_start_idx, n_obs, dictionaries, tdb_config, current_schema_only, verbose
+            )
+            for h5ad, row_start_idx, n_obs in loaded
+        ]
+        count = 0
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Error", e)
+                raise e
+
+            count += 1
+            if verbose:
+                log(f"create: dataset {count} of {len(futures)} obs saved")
 
     # save var
     if verbose:
-        log("saving var...", h5ad.path)
-    var_df = pd.DataFrame(data={"var_name": list(var_names)})
+        log("saving var...")
+    var_df = pd.DataFrame(data={"var_name": sorted(var_names)})
     column_types, varlen_types = get_ctypes(var_df)
     tiledb.from_pandas(
         uri=f"{uri}/var",
         dataframe=var_df,
         mode="append",
-        ctx=ctx,
+        ctx=tiledb.Ctx(tdb_config),
         column_types=column_types,
         varlen_types=varlen_types,
         row_start_idx=0,
@@ -129,13 +224,11 @@ def load_raw_X_normed(
 
     ctx = tiledb.Ctx(tdb_config)
 
-    # get the starting row index for this dataset
+    # get the starting row index for this dataset, ie, the first row with its dataset_id code
+    dataset_code = load_obs_dictionary(uri, "dataset_id", ctx).get_loc(dataset_id)
     with tiledb.open(f"{uri}/obs", ctx=ctx) as obs:
-        # there is a bug in QueryCondition
-        # qc = tiledb.QueryCondition(f"dataset_id == '{dataset_id}'")
-        # row_start_idx_groups = obs.query(attrs=["dataset_id"], attr_cond=qc).df[:].reset_index().groupby("dataset_id").min()
-        row_start_idx_groups = obs.query(attrs=["dataset_id"]).df[:].reset_index().groupby("dataset_id").min()
-        row_start_idx = row_start_idx_groups.loc[bytes(dataset_id, "utf-8"), "index"]
+        dataset_codes = obs.query(attrs=["dataset_id"]).df[:]["dataset_id"]
+        row_start_idx = dataset_codes.index[dataset_codes.to_numpy() == dataset_code].min()
 
     # get the var_name map
     with tiledb.open(f"{uri}/var", ctx=ctx) as var:
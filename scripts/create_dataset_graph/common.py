@@ -1,9 +1,19 @@
 import io
+import os
+import gzip
+import hashlib
 from datetime import datetime
 import csv
 from collections import namedtuple
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import numpy as np
 import pandas as pd
+import tiledb
 
 # columns we preserve in our mini-atlas, on the assumption all data comes
 # from cellxgene corpus.  Schema:
@@ -21,6 +31,11 @@ OBS_TERM_COLUMNS = [
 
 VAR_TERM_COLUMNS = []
 
+# obs columns stored dictionary-encoded, ie, as int32 codes into a per-column dictionary
+# of the distinct values, saved in the aggregation's obs_dictionaries group
+OBS_DICTIONARY_COLUMNS = OBS_TERM_COLUMNS + ["dataset_id"]
+OBS_DICTIONARIES = "obs_dictionaries"
+
 
 def get_ctypes(df: pd.DataFrame):
     column_types = {}
@@ -50,6 +65,79 @@ def chunker(listlike, chunk_size):
         yield listlike[i : i + chunk_size]
 
 
+def obs_dictionary_uri(uri: str, column: str) -> str:
+    return f"{uri}/{OBS_DICTIONARIES}/{column}"
+
+
+def encode_obs_columns(obs_df: pd.DataFrame, dictionaries: dict) -> pd.DataFrame:
+    """
+    Replace each dictionary-encoded column with its int32 codes into the column dictionary.
+    """
+    for column, dictionary in dictionaries.items():
+        codes = pd.Categorical(obs_df[column], categories=dictionary).codes
+        if (codes < 0).any():
+            raise ValueError(f"{column} has values missing from its dictionary")
+        obs_df[column] = codes.astype(np.int32)
+    return obs_df
+
+
+def save_obs_dictionaries(uri: str, dictionaries: dict, tdb_config: dict):
+    """
+    Save each column dictionary (a list of distinct values, indexed by code) as a dense
+    array in the obs_dictionaries group.
+    """
+    ctx = tiledb.Ctx(tdb_config)
+    group = tiledb.Group(f"{uri}/{OBS_DICTIONARIES}", mode="w", ctx=ctx)
+    for column, dictionary in dictionaries.items():
+        dictionary_df = pd.DataFrame(index=pd.RangeIndex(0, len(dictionary), name="code"), data={"value": dictionary})
+        column_types, varlen_types = get_ctypes(dictionary_df)
+        tiledb.from_pandas(
+            uri=obs_dictionary_uri(uri, column),
+            dataframe=dictionary_df,
+            ctx=ctx,
+            sparse=False,
+            column_types=column_types,
+            varlen_types=varlen_types,
+        )
+        group.add(uri=obs_dictionary_uri(uri, column), name=column)
+    group.close()
+
+
+def load_obs_dictionary(uri: str, column: str, ctx: tiledb.Ctx) -> pd.Index:
+    """
+    Return the column dictionary, ie, the distinct values indexed by code.
+    """
+    with tiledb.open(obs_dictionary_uri(uri, column), ctx=ctx) as dictionary:
+        values = dictionary.df[:]["value"]
+    return pd.Index([v.decode("utf-8") if isinstance(v, bytes) else v for v in values], dtype=object)
+
+
+def decode_obs_column(codes, dictionary: pd.Index) -> pd.Categorical:
+    """
+    Return the dictionary-encoded column as a Categorical, without materializing a value per row.
+    """
+    return pd.Categorical.from_codes(np.asarray(codes), categories=dictionary)
+
+
+def write_precompressed_variants(path: str):
+    """
+    Write content-hashed copies of the file, as-is and gzip (and, if the brotli package is
+    installed, brotli) compressed, eg, dataset_graph.<hash>.json{,.gz,.br}, so that the
+    server (see server/static_assets.py) serves them without compressing per request.
+    """
+    with open(path, "rb") as f:
+        body = f.read()
+    stem, ext = os.path.splitext(path)
+    hashed_path = f"{stem}.{hashlib.sha256(body).hexdigest()[:16]}{ext}"
+    variants = {"": body, ".gz": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(body, quality=11)
+    for suffix, variant in variants.items():
+        with open(hashed_path + suffix, "wb") as f:
+            f.write(variant)
+    return hashed_path
+
+
 def log(*args):
     print(f"[{datetime.now()}]", *args)
 
@@ -5,7 +5,7 @@ import tiledb
 import numpy as np
 import pandas as pd
 
-from .common import OBS_TERM_COLUMNS, VAR_TERM_COLUMNS, get_ctypes, log, parse_manifest
+from .common import OBS_DICTIONARIES, OBS_DICTIONARY_COLUMNS, VAR_TERM_COLUMNS, get_ctypes, log, parse_manifest
 from .add import load_axes_dataframes
 
 
@@ -89,13 +89,17 @@ def create_empty_aggregation(uri: str, ctx: tiledb.Ctx):
     tiledb.group_create(uri, ctx=ctx)
     agg = tiledb.Group(uri, mode="w", ctx=ctx)
 
+    # term columns and dataset_id are int32 codes, decoded by the dictionaries saved in the obs_dictionaries group
     exemplar = pd.DataFrame(
         index=pd.RangeIndex(0, 1, name="obs_id"),
-        data={"obs_name": [""], "dataset_id": [""]} | {k: [""] for k in OBS_TERM_COLUMNS},
+        data={"obs_name": [""]} | {k: np.zeros(1, dtype=np.int32) for k in OBS_DICTIONARY_COLUMNS},
     )
     create_dataframe_array(f"{uri}/obs", ctx, exemplar, None, sparse=False)
     agg.add(uri=f"{uri}/obs", name="obs")
 
+    tiledb.group_create(f"{uri}/{OBS_DICTIONARIES}", ctx=ctx)
+    agg.add(uri=f"{uri}/{OBS_DICTIONARIES}", name=OBS_DICTIONARIES)
+
     exemplar = pd.DataFrame(
         index=pd.RangeIndex(0, 1, name="var_id"), data={"var_name": [""]} | {k: [""] for k in VAR_TERM_COLUMNS}
     )
@@ -113,7 +117,16 @@ def create_empty_aggregation(uri: str, ctx: tiledb.Ctx):
     return 0
 
 
-def create(*, uri: str, manifest: io.TextIOBase, tdb_config: dict, current_schema_only: bool, verbose: bool, **other):
+def create(
+    *,
+    uri: str,
+    manifest: io.TextIOBase,
+    tdb_config: dict,
+    current_schema_only: bool,
+    max_workers: int,
+    verbose: bool,
+    **other,
+):
     # datasets = [d for d in [d.strip() for d in manifest.readlines()] if d.endswith(".h5ad") and os.path.exists(d)]
     datasets = parse_manifest(manifest)
     datasets = [d for d in datasets if d.path.endswith('.h5ad') and os.path.exists(d.path)]
@@ -131,7 +144,11 @@ def create(*, uri: str, manifest: io.TextIOBase, tdb_config: dict, current_schem
     if verbose:
         log("Creating empty aggregation", uri)
     create_empty_aggregation(uri, ctx)
+    # the obs are loaded in forked processes, so don't hold a TileDB context (and its threads) across the fork
+    del ctx
 
-    load_axes_dataframes(uri, datasets, ctx, current_schema_only, verbose)
+    # reading obs is light on memory (unlike load-X), so use every core by default
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    load_axes_dataframes(uri, datasets, tdb_config, current_schema_only, max_workers, verbose)
 
     return 0
@@ -15,7 +15,7 @@ import owlready2
 import yaml
 import pandas as pd
 
-from .common import OBS_TERM_COLUMNS
+from .common import OBS_TERM_COLUMNS, decode_obs_column, load_obs_dictionary, write_precompressed_variants
 
 """
 Given reference ontologies (CL, UBERON, etc) and a baseline dataset,
@@ -65,6 +65,9 @@ TERM_LINKS = ["parents", "part_of", "have_part", "develops_from", "derives_from"
 # are not present in the data.
 SEED_ONTOLOGIES = ["CL", "HANCESTRO", "HsapDv", "MmusDv"]
 
+# Number of roots per ontology, by descendant count, for which the server precomputes layouts
+LAYOUT_ROOTS_PER_ONTOLOGY = 10
+
 
 # global names of interest
 PART_OF = owlready2.IRIS["http://purl.obolibrary.org/obo/BFO_0000050"]
@@ -138,9 +141,15 @@ def create_graph(
         "created_on": datetime.datetime.now().astimezone().isoformat(),
         "owl_info": {name: info["urls"][info["latest"]] for name, info in owl_info.items()},
         "ontologies": in_use_ontologies,
+        "layout_roots": get_layout_roots(in_use_ontologies),
     }
     json.dump(result, output)
 
+    if output != sys.stdout:
+        output.close()
+        hashed_path = write_precompressed_variants(output.name)
+        print(f"Wrote {hashed_path} and compressed variants.")
+
 
 def create_in_use_ontologies(master_ontology, terms_in_use):
     in_use_ontologies = {
@@ -169,7 +178,7 @@ def annotate_ontology(in_use_ontologies: dict, obs_df: pd.DataFrame, var_df: pd.
     # Links found in the data between cell_type and tissue_type are saved in 'part_of'
     grouped = (
         obs_df[["cell_type_ontology_term_id", "tissue_ontology_term_id"]]
-        .groupby(by=["cell_type_ontology_term_id", "tissue_ontology_term_id"])
+        .groupby(by=["cell_type_ontology_term_id", "tissue_ontology_term_id"], observed=True)
         .size()
     )
     for fromId in grouped.index.to_frame().to_dict(orient="series")["cell_type_ontology_term_id"].unique():
@@ -213,6 +222,35 @@ def cleanup_fields(in_use_ontologies):
     }
 
 
+def get_layout_roots(in_use_ontologies, n_roots=LAYOUT_ROOTS_PER_ONTOLOGY) -> dict:
+    """
+    Return the terms with the most descendants in each ontology, ie, the subgraphs
+    which are most expensive to lay out, for the server to precompute.
+    """
+    layout_roots = {}
+    for ont_name, ontology in in_use_ontologies.items():
+        children = {term_id: [] for term_id in ontology}
+        for term_id, term in ontology.items():
+            for parent_id in term.get("parents", []):
+                if parent_id in children:
+                    children[parent_id].append(term_id)
+
+        n_descendants = {}
+        for term_id in ontology:
+            descendants = set()
+            to_be_processed = deque(children[term_id])
+            while len(to_be_processed) > 0:
+                child = to_be_processed.popleft()
+                if child not in descendants:
+                    descendants.add(child)
+                    to_be_processed.extend(children[child])
+            n_descendants[term_id] = len(descendants)
+
+        heaviest = sorted(ontology, key=lambda term_id: n_descendants[term_id], reverse=True)[:n_roots]
+        layout_roots[ont_name] = [term_id for term_id in heaviest if n_descendants[term_id] > 0]
+    return layout_roots
+
+
 def is_non_human(term_id, term) -> bool:
     label = term["label"].lower()
     non_human = (
@@ -465,12 +503,9 @@ def load_obs_dataframe(uri: str):
         attrs = [c for c in OBS_TERM_COLUMNS if c not in dim_names]
         obs_df = obs.query(dims=dims, attrs=attrs).df[:]
 
-        # stringify
-        for i in range(obs.schema.nattr):
-            attr = obs.attr(i)
-            name = attr.name
-            if attr.dtype == "bytes" and attr.isvar is True and name in obs_df.keys():
-                obs_df[name] = obs_df[name].str.decode("utf-8")
+    # the term columns are stored as dictionary codes, so decode them to categoricals
+    for col in OBS_TERM_COLUMNS:
+        obs_df[col] = decode_obs_column(obs_df[col].to_numpy(), load_obs_dictionary(uri, col, tiledb_ctx))
 
     """
     The tissue_ontology_term_id and the assay_ontology_term_id columns may contain auxillary information
@@ -479,11 +514,15 @@ def load_obs_dataframe(uri: str):
     and
     https://github.com/chanzuckerberg/single-cell-curation/blob/main/schema/2.0.0/schema.md#assay_ontology_term_id
 
-    This code removes the extra suffix annotation from _all_ term columns.
+    This code removes the extra suffix annotation from _all_ term columns. It is applied to the
+    categories rather than to every row, merging categories which differ only by their suffix.
     """
     pat = r"(?P<term>^.+:\S+)(?:\s\(.*\))?$"
     for col in OBS_TERM_COLUMNS:
-        obs_df[col] = obs_df[col].str.replace(pat, lambda m: m.group("term"), regex=True)
+        terms = obs_df[col].cat.categories.str.replace(pat, lambda m: m.group("term"), regex=True)
+        unique_terms = pd.Index(terms.unique())
+        codes = unique_terms.get_indexer(terms)[obs_df[col].cat.codes.to_numpy()]
+        obs_df[col] = pd.Categorical.from_codes(codes, categories=unique_terms)
 
     return obs_df
 
@@ -10,7 +10,7 @@ from scipy import stats
 from statsmodels.stats.multitest import multipletests
 from progress.bar import Bar
 
-from .common import chunker, OBS_TERM_COLUMNS, log
+from .common import chunker, load_obs_dictionary, OBS_TERM_COLUMNS, log
 
 
 def do_ranking(uri, chunk_index, var_ids, tdb_config, init_buffer_bytes, verbose):
@@ -103,6 +103,7 @@ def rank_genes_groups(
             groupby_key=k,
             obs_df=obs_df,
             var_df=var_df,
+            dictionary=load_obs_dictionary(uri, k, ctx),
             top_n=top_n,
             verbose=verbose,
             tdb_config=tdb_config,
@@ -117,6 +118,7 @@ def _rank_genes_groups(
     uri: str,
     obs_df: pd.DataFrame,
     var_df: pd.DataFrame,
+    dictionary: pd.Index,
     groupby_key: str,
     top_n: int,
     verbose: bool,
@@ -127,6 +129,9 @@ def _rank_genes_groups(
     For each gene, calculate:
     * U statistic and pval from X rankings
     * mean and n from normalized X
+
+    The groups are the dictionary codes of the groupby_key column, which are decoded
+    to terms for the results.
     """
     n_obs = len(obs_df)
     n_var = len(var_df)
@@ -202,7 +207,7 @@ def _rank_genes_groups(
         .reset_index(level=(2, 1))
         .drop(columns=[groupby_key])
     )
-    top_n.index = top_n.index.astype(str)
+    top_n.index = dictionary[top_n.index.to_numpy()]
 
     results = top_n.groupby(level=0).apply(
         lambda df: (
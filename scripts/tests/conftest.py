@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts are run as a package from the repo root, eg, python -m scripts.create_dataset_graph
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
@@ -0,0 +1,70 @@
+"""
+Dictionary encoding of the obs term columns, and the round trip of the dictionaries through TileDB.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+tiledb = pytest.importorskip("tiledb")
+
+from scripts.create_dataset_graph.common import (  # noqa: E402
+    decode_obs_column,
+    encode_obs_columns,
+    load_obs_dictionary,
+    save_obs_dictionaries,
+)
+
+OBS = {
+    "cell_type_ontology_term_id": ["CL:0000084", "CL:0000236", "CL:0000084", "CL:0000000"],
+    "tissue_ontology_term_id": ["UBERON:0002107", "UBERON:0002107", "UBERON:0000178", "UBERON:0002107"],
+    "dataset_id": ["dataset-1", "dataset-1", "dataset-2", "dataset-2"],
+}
+
+
+@pytest.fixture
+def obs_df():
+    return pd.DataFrame(OBS)
+
+
+@pytest.fixture
+def dictionaries():
+    # with values which don't occur, as the dictionaries are of all datasets
+    return {
+        "cell_type_ontology_term_id": ["CL:0000000", "CL:0000084", "CL:0000236", "CL:0000540"],
+        "tissue_ontology_term_id": ["UBERON:0000178", "UBERON:0002107"],
+    }
+
+
+def test_encode_decode_round_trip(obs_df, dictionaries):
+    encoded = encode_obs_columns(obs_df.copy(), dictionaries)
+    for column, dictionary in dictionaries.items():
+        assert encoded[column].dtype == np.int32
+        decoded = decode_obs_column(encoded[column].to_numpy(), pd.Index(dictionary))
+        assert list(decoded) == OBS[column]
+        assert list(decoded.categories) == dictionary
+    # other columns are left as they were
+    assert list(encoded["dataset_id"]) == OBS["dataset_id"]
+
+
+def test_encode_values_missing_from_dictionary(obs_df, dictionaries):
+    dictionaries["tissue_ontology_term_id"] = ["UBERON:0002107"]
+    with pytest.raises(ValueError, match="tissue_ontology_term_id has values missing from its dictionary"):
+        encode_obs_columns(obs_df, dictionaries)
+
+
+def test_save_load_round_trip(obs_df, dictionaries, tmp_path):
+    uri = str(tmp_path / "agg")
+    # as create does
+    tiledb.group_create(uri)
+    tiledb.group_create(f"{uri}/obs_dictionaries")
+    save_obs_dictionaries(uri, dictionaries, {})
+    encoded = encode_obs_columns(obs_df.copy(), dictionaries)
+
+    ctx = tiledb.Ctx()
+    for column, dictionary in dictionaries.items():
+        loaded = load_obs_dictionary(uri, column, ctx)
+        assert list(loaded) == dictionary
+        assert list(decode_obs_column(encoded[column].to_numpy(), loaded)) == OBS[column]
+
+    with tiledb.Group(f"{uri}/obs_dictionaries", ctx=ctx) as group:
+        assert {member.name for member in group} == set(dictionaries)
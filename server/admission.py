@@ -0,0 +1,32 @@
+"""
+Admission control for expensive queries.
+
+Census reads and rollups are CPU and memory intensive, so the number running at
+once in each process is capped. Requests which cannot start a query within the
+admission timeout receive a 503, rather than queueing without bound. Cached
+responses never need a slot.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import abort
+
+MAX_HEAVY_QUERIES = int(os.environ.get("MAX_HEAVY_QUERIES", 4))
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", 30))
+
+_slots = threading.BoundedSemaphore(MAX_HEAVY_QUERIES)
+
+
+@contextmanager
+def heavy_query():
+    """
+    Context manager (or function decorator) which holds one of the MAX_HEAVY_QUERIES
+    slots while the query runs.
+    """
+    if not _slots.acquire(timeout=ADMISSION_TIMEOUT):
+        abort(503, "Server is busy, please retry")
+    try:
+        yield
+    finally:
+        _slots.release()
@@ -1,8 +1,33 @@
-from flask import Flask
-import requests # https://stackoverflow.com/questions/2018026/what-are-the-differences-between-the-urllib-urllib2-urllib3-and-requests-modul
-import cell_census
+import re
+import json
+import hashlib
+
+from flask import Flask, request, abort
+import numpy as np
 import pandas as pd
-from rollup import rollup_across_cell_type_descendants, ALL_CELL_ONTOLOGY_TERMS
+from ontology import get_ontology_closure, SERVER_ONTOLOGIES
+from rollup import rollup_across_lineage
+from cache import LRUCache, ResponseCache, cached_json_response, cached_frame_response
+from disk_cache import DiskCache, disk_cache
+from census_access import (
+    CensusPool,
+    read_cell_type_codes,
+    read_gene_expression_summary,
+    read_soma_joinids,
+    read_value_counts,
+    value_filter,
+    value_filter_columns,
+    value_filter_errors,
+)
+from portal import portal_datasets, upstream_response, get_datasets_by_term
+from admission import heavy_query
+from dataset_graph import get_dataset_graph
+from layout import LAYOUTS, DEFAULT_FILTERS, get_layout
+from static_assets import STATIC_ASSETS, get_static_asset, find_static_asset
+from cube import CATEGORY_ONTOLOGIES, ROLLUP_DIRECTIONS, RollupCubeJob, compute_rollup_cube, cube_categories
+from warmup import SERVER_WARMUP, SERVER_WARMUP_ON_IMPORT, Warmup
+from embedding import MIN_PROFILES, fit_embedding, transform_embedding, run_in_pool, validate_params
+from metrics import instrument_flask, metrics_text
 # cors
 from flask_cors import CORS, cross_origin
 
@@ -12,10 +37,36 @@ app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
+# per-route latency and in-flight metrics, see /api/metrics
+instrument_flask(app)
+
+
+def open_census():
+    # cell_census (and tiledbsoma) are slow to import, so are imported on first use
+    import cell_census
+
+    return cell_census.open_soma()
 
-# open connection to the census, as of 0.4.0 this needs to be closed manually? 
+
+# census handles are opened on first use and pooled. As of 0.4.0 they need to be closed manually, see
 # https://github.com/chanzuckerberg/cell-census/releases/tag/v0.4.0
-census = cell_census.open_soma()
+census_pool = CensusPool(open_census)
+
+# computed responses, keyed by the census and ontology versions they were computed from. The expensive caches are
+# persisted to disk, so they survive restarts and deploys.
+response_cache = ResponseCache(persist="responses")
+# per-term lookups are cheap and numerous, so keep them from evicting the expensive responses
+term_response_cache = ResponseCache(maxsize=1024, name="termResponses")
+# per-gene expression summaries (dataframes), so that a batch only reads the genes not already summarized
+gene_summary_cache = LRUCache(maxsize=4096, persist="geneSummaries")
+# the cell type code of every census cell, by census version and organism, so gene expression reads don't read the
+# cell types from the obs. These are large (4 bytes per cell), so there is one per organism, shared by all tissues, and
+# they are not persisted.
+cell_type_codes_cache = LRUCache(maxsize=2, name="cellTypeCodes")
+# computed census dataframes, shared by the response formats (JSON, Arrow, msgpack) they are serialized to
+frame_cache = LRUCache(maxsize=128, persist="frames")
+# fitted embeddings, by embedding ID, so that new terms can be projected into them
+embedding_cache = LRUCache(maxsize=32, persist="embeddings")
 
 @app.route('/api')
 def hello_world():
@@ -28,57 +79,529 @@ def hello_world():
 def api():
     return {'hello': 'world'}
 
+@app.route('/api/ready')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def ready():
+    # readiness probe: 200 once the background warmup has finished and all of its required steps are done, else 503.
+    # Reports each warmup step's progress, and the required steps which failed.
+    ready = warmup.ready
+    return {"ready": ready, "failed": warmup.failed, "steps": warmup.status}, 200 if ready else 503
+
+@app.route('/api/metrics')
+def metrics():
+    # Prometheus scrape endpoint: request latency by route, sub-span timings, cache hit rates and memory
+    body, content_type = metrics_text()
+    return body, 200, {"Content-Type": content_type}
+
 @app.route('/api/portalDatasets')
 @cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
 def portalDatasets():
-    # make a request to the url "https://api.cellxgene.cziscience.com/dp/v1/datasets/index"
-    # and return the response
+    # proxy "https://api.cellxgene.cziscience.com/dp/v1/datasets/index", served from a
+    # cached copy which is revalidated in the background when stale.
+    return upstream_response(portal_datasets.get())
+
+@app.route('/api/datasetsByTerm/<term_id>')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def datasetsByTerm(term_id):
+    # the portal datasets annotated with the term, eg, /api/datasetsByTerm/CL:0000540. With
+    # ?descendants=true, also include datasets annotated with any of its descendants.
+    descendants = request.args.get("descendants", "false").lower() in ("1", "true", "yes")
+    index = get_datasets_by_term()
+    ontology_name = term_id.split(":", 1)[0]
+    ontology_version = None
+    if descendants and ontology_name in SERVER_ONTOLOGIES:
+        ontology_version = get_ontology_closure(ontology_name).version
+    return cached_json_response(
+        term_response_cache,
+        ("datasetsByTerm", index.version, ontology_version, term_id, descendants),
+        lambda: index.lookup(term_id, descendants=descendants),
+    )
 
-    # first we make a request to the url
-    response = requests.get("https://api.cellxgene.cziscience.com/dp/v1/datasets/index")   
-    # then we return the response
-    return response.json()
 
 @app.route('/api/census/cellMetadataFields')
 @cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
 def cellMetadata():
-    return list(census["census_data"]["homo_sapiens"].obs.keys())
+    return cached_json_response(
+        response_cache,
+        ("cellMetadataFields", census_pool.version),
+        compute_cell_metadata_fields,
+    )
+
+
+@heavy_query()
+def compute_cell_metadata_fields():
+    with census_pool.handle() as census:
+        return list(census["census_data"]["homo_sapiens"].obs.keys())
+
+def records_by(df, column):
+    # { value of column: { other column: value, ... }, ... }, built from column lists rather than per-row dataframe
+    # access, eg, for cellCounts: { "CL:0000540": { "unique_cell_count": n, "unique_cell_count_with_descendants": n } }
+    others = [col for col in df.columns if col != column]
+    rows = zip(*[df[col].tolist() for col in others])
+    return {key: dict(zip(others, row)) for key, row in zip(df[column].tolist(), rows)}
+
+
+def get_rollup_args():
+    # validate the ontology rollup query parameters, eg, ?category=tissue&direction=ancestors
+    category = request.args.get("category", "cell_type")
+    direction = request.args.get("direction", "descendants")
+    if category not in CATEGORY_ONTOLOGIES or CATEGORY_ONTOLOGIES[category] not in SERVER_ONTOLOGIES:
+        abort(400, f"Unsupported category: {category}")
+    if direction not in ROLLUP_DIRECTIONS:
+        abort(400, f"Unsupported direction: {direction}")
+    return category, direction
+
+
+@app.route('/api/ontology/<ontology_name>/<term_id>/<direction>')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def ontologyLineage(ontology_name, term_id, direction):
+    # the term and all of its ancestors or descendants, eg, /api/ontology/CL/CL:0000540/descendants
+    if ontology_name not in SERVER_ONTOLOGIES:
+        abort(404, f"Unknown ontology: {ontology_name}")
+    if direction not in ROLLUP_DIRECTIONS:
+        abort(404, f"Unknown direction: {direction}")
+    closure = get_ontology_closure(ontology_name)
+    if term_id not in closure.term_index:
+        abort(404, f"Unknown term: {term_id}")
+    return closure.relatives(term_id, descendants=(direction == "descendants"))
+
+
+@app.route('/api/assets')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def assets():
+    # the content-hashed URL of each static asset, eg, { "dataset_graph.json": "/api/assets/dataset_graph.<hash>.json" }
+    # assets missing from STATIC_ASSETS_DIR are omitted
+    assets = {name: get_static_asset(name) for name in STATIC_ASSETS}
+    return {name: f"/api/assets/{asset.hashed_name}" for name, asset in assets.items() if asset is not None}
+
+
+@app.route('/api/assets/<filename>')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def asset(filename):
+    # a static asset, precompressed. Content-hashed names are immutable, logical names (eg, dataset_graph.json) must
+    # be revalidated.
+    asset, immutable = find_static_asset(filename)
+    if asset is None:
+        abort(404, f"Unknown asset: {filename}")
+    return asset.response(immutable)
+
+
+MAX_NEIGHBORHOOD_DEPTH = 10
+MAX_SEARCH_RESULTS = 100
+
+
+@app.route('/api/graph/search')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def graphSearch():
+    # prefix and fuzzy search over dataset graph term labels and synonyms, eg, /api/graph/search?q=lymphocyte
+    # Optional ?limit (default 20) and ?ontology (eg, CL). Returns [{ "term_id", "label", "match" }]
+    query = request.args.get("q", "")
+    limit = min(request.args.get("limit", 20, type=int), MAX_SEARCH_RESULTS)
+    ontology_name = request.args.get("ontology")
+    graph = get_dataset_graph()
+
+    def compute_search():
+        return [
+            {"term_id": term_id, "label": graph.terms[term_id].get("label"), "match": name}
+            for term_id, name in graph.search_index.search(query, limit, ontology_name)
+        ]
+
+    return cached_json_response(
+        term_response_cache, ("search", graph.version, query, limit, ontology_name), compute_search
+    )
+
+
+@app.route('/api/graph/<term_id>/neighborhood')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def graphNeighborhood(term_id):
+    # the dataset graph terms up to ?depth (default 1) links above or below the term, with their children, eg,
+    # /api/graph/CL:0000540/neighborhood?depth=2. Returns { term ID: term }
+    depth = min(request.args.get("depth", 1, type=int), MAX_NEIGHBORHOOD_DEPTH)
+    graph = get_dataset_graph()
+    if term_id not in graph:
+        abort(404, f"Unknown term: {term_id}")
+
+    def compute_neighborhood():
+        terms = graph.neighborhood(term_id, depth)
+        return {t: {**graph.terms[t], "children": graph.children.get(t, [])} for t in terms}
+
+    return cached_json_response(
+        term_response_cache, ("neighborhood", graph.version, term_id, depth), compute_neighborhood
+    )
+
+
+@app.route('/api/graph/<term_id>/<direction>')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def graphLineage(term_id, direction):
+    # the term and its dataset graph ancestors or descendants, optionally to ?depth, with their distance from the
+    # term, eg, /api/graph/CL:0000540/ancestors. Returns { term ID: depth }
+    if direction not in ROLLUP_DIRECTIONS:
+        abort(404, f"Unknown direction: {direction}")
+    depth = request.args.get("depth", None, type=int)
+    graph = get_dataset_graph()
+    if term_id not in graph:
+        abort(404, f"Unknown term: {term_id}")
+    walk = graph.descendants if direction == "descendants" else graph.ancestors
+    return cached_json_response(
+        term_response_cache, ("lineage", graph.version, term_id, direction, depth), lambda: walk(term_id, depth)
+    )
+
+
+@app.route('/api/layout/<term_id>')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def layout(term_id):
+    # layout of the dataset graph subgraph rooted at the term, eg, /api/layout/CL:0000540?layout=force&max_depth=3
+    # ?layout is sugiyama (default) or force. Optional filters, as in the DAG explorer: ?min_outdegree, ?max_outdegree
+    # and ?max_depth.
+    layout = request.args.get("layout", "sugiyama")
+    if layout not in LAYOUTS:
+        abort(400, f"Unknown layout: {layout}")
+    filters = {name: request.args.get(name, default, type=int) for name, default in DEFAULT_FILTERS.items()}
+    graph = get_dataset_graph()
+    if term_id not in graph:
+        abort(404, f"Unknown term: {term_id}")
+
+    return cached_json_response(
+        response_cache,
+        ("layout", graph.version, term_id, layout, tuple(filters.items())),
+        heavy_query()(lambda: get_layout(graph, term_id, layout, filters)),
+    )
+
+
+@app.route('/api/census/obsCounts')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def obsCounts():
+    # value counts over a census obs field, eg, /api/census/obsCounts?field=assay&filter=tissue_general == 'lung'
+    # Optional ?organism (default homo_sapiens), and ?rollup=true to also count *_ontology_term_id values
+    # across their descendants.
+    field = request.args.get("field")
+    if not field:
+        abort(400, "Missing field")
+    obs_filter = request.args.get("filter") or None
+    organism = request.args.get("organism", "homo_sapiens")
+    rollup = request.args.get("rollup", "false").lower() in ("1", "true", "yes")
+    filter_columns = set()
+    if obs_filter:
+        try:
+            filter_columns = value_filter_columns(obs_filter)
+        except ValueError as e:
+            abort(400, f"Invalid filter: {e}")
+
+    ontology_name = None
+    if rollup:
+        ontology_name = CATEGORY_ONTOLOGIES.get(field.removesuffix("_ontology_term_id"))
+        if not field.endswith("_ontology_term_id") or ontology_name not in SERVER_ONTOLOGIES:
+            abort(400, f"Field {field} can't be rolled up")
+    ontology_version = get_ontology_closure(ontology_name).version if ontology_name else None
+
+    return cached_frame_response(
+        response_cache,
+        frame_cache,
+        ("obsCounts", census_pool.version, ontology_version, organism, field, obs_filter, rollup),
+        lambda: compute_obs_counts(organism, field, obs_filter, filter_columns, ontology_name),
+        # { value: { "count": n, "count_with_descendants": n }, ... }
+        lambda df: records_by(df, field),
+    )
+
+
+@heavy_query()
+def compute_obs_counts(organism, field, obs_filter, filter_columns, ontology_name):
+    # check the field and the filter against the obs schema before reading
+    with census_pool.handle() as census:
+        organisms = census["census_data"].keys()
+        obs_columns = set(census["census_data"][organism].obs.keys()) if organism in organisms else None
+    if obs_columns is None:
+        abort(400, f"Unknown organism: {organism}")
+    if field not in obs_columns:
+        abort(400, f"Unknown obs field: {field}")
+    unknown_columns = sorted(filter_columns - obs_columns)
+    if unknown_columns:
+        abort(400, f"Invalid filter: unknown obs fields {', '.join(unknown_columns)}")
+
+    try:
+        with census_pool.handle() as census:
+            counts = read_value_counts(census["census_data"][organism].obs, field, obs_filter)
+    except value_filter_errors() as e:
+        abort(400, f"Invalid filter: {e}")
+
+    counts_df = pd.DataFrame({field: counts.index.astype(str), "count": counts.to_numpy()})
+    if ontology_name:
+        # add the ancestors of the terms present, so that there is something to roll up into
+        closure = get_ontology_closure(ontology_name)
+        terms = set(counts_df[field])
+        ancestors = set(a for term in terms for a in closure.relatives(term, descendants=False))
+        missing_terms = list(ancestors - terms)
+        added_empty_rows = pd.DataFrame({field: missing_terms, "count": np.zeros(len(missing_terms), dtype=np.int64)})
+        counts_df = pd.concat([counts_df, added_empty_rows], ignore_index=True)
+
+        rollup_df = rollup_across_lineage(counts_df, term_col=field, ontology_name=ontology_name)
+        counts_df["count_with_descendants"] = rollup_df["count"]
+
+    return counts_df
+
+
+# gene and term IDs are used in census queries, so are strictly validated
+ID_PATTERN = re.compile(r"^[A-Za-z0-9_.:-]+$")
+MAX_GENES_PER_REQUEST = 100
+
+
+@app.route('/api/census/geneExpression')
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def geneExpression():
+    # per cell type mean expression and fraction of cells expressing, for a batch of genes, eg,
+    # /api/census/geneExpression?genes=ENSG00000161798,ENSG00000168484&tissue=UBERON:0002048
+    # Optional ?organism (default homo_sapiens), and ?rollup=true to roll up across cell type descendants.
+    genes = sorted(set(gene for gene in request.args.get("genes", "").split(",") if gene))
+    tissue = request.args.get("tissue") or None
+    organism = request.args.get("organism", "homo_sapiens")
+    rollup = request.args.get("rollup", "false").lower() in ("1", "true", "yes")
+    if not genes or len(genes) > MAX_GENES_PER_REQUEST:
+        abort(400, f"Specify between 1 and {MAX_GENES_PER_REQUEST} genes")
+    if not all(ID_PATTERN.match(id) for id in genes + [organism] + ([tissue] if tissue else [])):
+        abort(400, "Invalid gene, tissue or organism")
+
+    ontology_version = get_ontology_closure("CL").version if rollup else None
+    return cached_frame_response(
+        response_cache,
+        frame_cache,
+        ("geneExpression", census_pool.version, ontology_version, organism, tissue, tuple(genes), rollup),
+        lambda: compute_gene_expression(organism, tissue, genes, rollup),
+        lambda df: gene_expression_json(df, genes),
+    )
+
+
+def get_gene_expression_summaries(organism, tissue, genes) -> pd.DataFrame:
+    # summarize the genes which are not already cached, all in one census read
+    version = census_pool.version
+    summaries = {gene: gene_summary_cache.get((version, organism, tissue, gene)) for gene in genes}
+    missing_genes = [gene for gene, summary in summaries.items() if summary is None]
+    if missing_genes:
+        with heavy_query(), census_pool.handle() as census:
+            if organism not in census["census_data"].keys():
+                abort(400, f"Unknown organism: {organism}")
+            experiment = census["census_data"][organism]
+            cell_type_codes = cell_type_codes_cache.get_or_compute(
+                (version, organism), lambda: read_cell_type_codes(experiment)
+            )
+            # the tissue's cells, read per request rather than cached
+            soma_joinids = None
+            if tissue:
+                soma_joinids = read_soma_joinids(experiment.obs, value_filter(tissue_ontology_term_id=tissue))
+            summary = read_gene_expression_summary(experiment, missing_genes, cell_type_codes, soma_joinids)
+        for gene, gene_summary in summary.groupby("feature_id"):
+            summaries[gene] = gene_summary
+        for gene in missing_genes:
+            # genes not in the census have an empty summary
+            if summaries[gene] is None:
+                summaries[gene] = summary.iloc[0:0]
+            gene_summary_cache.put((version, organism, tissue, gene), summaries[gene])
+
+    return pd.concat(summaries.values(), ignore_index=True)
+
+
+def compute_gene_expression(organism, tissue, genes, rollup):
+    summary = get_gene_expression_summaries(organism, tissue, genes)
+
+    if rollup and len(summary) > 0:
+        # add the ancestors of the cell types present, for every gene, so that there is something to roll up into
+        cell_types = set(summary["cell_type_ontology_term_id"])
+        closure = get_ontology_closure("CL")
+        ancestors = set(a for cell_type in cell_types for a in closure.relatives(cell_type, descendants=False))
+        missing = pd.MultiIndex.from_product(
+            [list(ancestors - cell_types), genes], names=["cell_type_ontology_term_id", "feature_id"]
+        ).to_frame(index=False)
+        summary = pd.concat([summary, missing.assign(n_cells=0, nnz=0, sum=0.0)], ignore_index=True)
+        summary = rollup_across_lineage(summary, term_col="cell_type_ontology_term_id")
+
+    summary = summary[summary["n_cells"] > 0]
+    summary = summary.assign(mean=summary["sum"] / summary["n_cells"], frac=summary["nnz"] / summary["n_cells"])
+    columns = ["feature_id", "cell_type_ontology_term_id", "mean", "frac", "n_cells"]
+    return summary[columns].reset_index(drop=True)
+
+
+def gene_expression_json(summary, genes):
+    # { gene: { cell_type: { "mean": x, "frac": y, "n_cells": n }, ... }, ... }
+    result = {gene: {} for gene in genes}
+    columns = ["feature_id", "cell_type_ontology_term_id", "mean", "frac", "n_cells"]
+    for gene, cell_type, mean, frac, n_cells in zip(*[summary[col].tolist() for col in columns]):
+        result[gene][cell_type] = {"mean": mean, "frac": frac, "n_cells": n_cells}
+    return result
+
+
+MAX_GENES_PER_EMBEDDING = 2000
+
+
+@app.route('/api/embedding', methods=['POST'])
+@cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
+def embedding():
+    # PCA then UMAP of the terms' gene expression profiles (mean expression of each gene). The body is:
+    # { "terms": [...], "genes": [...], "params": { "n_neighbors": 15, ... }, "embedding_id": optional }
+    # If embedding_id is given, the terms are projected into that previously fitted embedding.
+    # Returns { "embedding_id": id, "coords": { term: [x, y] or null (no expression) } }
+    body = request.get_json(silent=True) or {}
+    terms = sorted(set(body.get("terms") or []))
+    genes = sorted(set(body.get("genes") or []))
+    if not terms or not genes or len(genes) > MAX_GENES_PER_EMBEDDING:
+        abort(400, f"Specify terms, and between 1 and {MAX_GENES_PER_EMBEDDING} genes")
+    if not all(isinstance(id, str) and ID_PATTERN.match(id) for id in terms + genes):
+        abort(400, "Invalid term or gene")
+    params = body.get("params") or {}
+    if not isinstance(params, dict):
+        abort(400, "Invalid params")
+    try:
+        params = validate_params(params)
+    except ValueError as e:
+        abort(400, f"Invalid params: {e}")
+
+    base_id = body.get("embedding_id")
+    if base_id is not None:
+        if not isinstance(base_id, str):
+            abort(400, "Invalid embedding_id")
+        return cached_json_response(
+            response_cache,
+            ("embeddingProjection", census_pool.version, base_id, tuple(terms)),
+            lambda: compute_embedding_projection(base_id, terms),
+        )
+
+    # the embedding ID identifies the data version, and all inputs of the fit
+    key = json.dumps([census_pool.version, terms, genes, params])
+    embedding_id = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return cached_json_response(
+        response_cache,
+        ("embedding", embedding_id),
+        lambda: compute_embedding(embedding_id, terms, genes, params),
+    )
+
+
+def get_expression_profiles(terms, genes) -> np.ndarray:
+    # rows are terms, columns are genes, values are mean expression
+    # one streamed X read, of the genes not already summarized
+    summaries = get_gene_expression_summaries("homo_sapiens", None, genes)
+    summaries = summaries[summaries["n_cells"] > 0]
+    means = (summaries["sum"] / summaries["n_cells"]).to_numpy()
+    profiles = pd.DataFrame(
+        {"term": summaries["cell_type_ontology_term_id"], "gene": summaries["feature_id"], "mean": means}
+    ).pivot_table(index="term", columns="gene", values="mean", fill_value=0.0)
+    return profiles.reindex(index=terms, columns=genes, fill_value=0.0).to_numpy()
+
+
+def coords_response(embedding_id, terms, has_profile, coords):
+    result = {term: None for term in terms}
+    for term, xy in zip(np.asarray(terms)[has_profile], coords):
+        result[term] = [float(xy[0]), float(xy[1])]
+    return {"embedding_id": embedding_id, "coords": result}
+
+
+def compute_embedding(embedding_id, terms, genes, params):
+    profiles = get_expression_profiles(terms, genes)
+    # terms with no expression of any of the genes can't be embedded
+    has_profile = profiles.any(axis=1)
+    if has_profile.sum() < MIN_PROFILES:
+        abort(400, f"At least {MIN_PROFILES} terms must express the genes")
+
+    with heavy_query():
+        coords, models = run_in_pool(fit_embedding, profiles[has_profile], params)
+    embedding_cache.put(embedding_id, {"genes": genes, "models": models})
+    return coords_response(embedding_id, terms, has_profile, coords)
+
+
+def compute_embedding_projection(embedding_id, terms):
+    fitted = embedding_cache.get(embedding_id)
+    if fitted is None:
+        abort(404, f"Unknown or expired embedding: {embedding_id}")
+
+    profiles = get_expression_profiles(terms, fitted["genes"])
+    has_profile = profiles.any(axis=1)
+    coords = np.zeros((0, 2))
+    if has_profile.any():
+        with heavy_query():
+            coords = run_in_pool(transform_embedding, fitted["models"], profiles[has_profile])
+    return coords_response(embedding_id, terms, has_profile, coords)
+
+
+# how long a request waits for the first rollup cube, before failing with a 503
+ROLLUP_CUBE_TIMEOUT = 120
+
+
+def rollup_cube_version():
+    # the cube only changes with the census release (re-read periodically by the pool) or the ontology versions (fixed
+    # for the life of the process)
+    ontology_versions = tuple(get_ontology_closure(CATEGORY_ONTOLOGIES[c]).version for c in cube_categories())
+    return (census_pool.version,) + ontology_versions
+
+
+def build_rollup_cube(version):
+    # a new server process loads the cube from disk, rather than recomputing it
+    key = DiskCache.make_key("rollupCube", version)
+    cube = disk_cache.get(key)
+    if cube is None:
+        with census_pool.handle() as census:
+            cube = compute_rollup_cube(census, version)
+        disk_cache.put(key, cube)
+    return cube
+
+
+rollup_cube = RollupCubeJob(build_rollup_cube, rollup_cube_version)
+
 
 @app.route('/api/census/cellCounts')
 @cross_origin(origin='localhost',headers=['Content- Type','Authorization'])
 def cellCounts():
-    # basic use of the census_summary_cell_counts dataframe.
-    # Each Cell Census contains a top-level dataframe summarizing counts of various cell labels. You can read this into a Pandas DataFrame:
-    census_summary_cell_counts = census["census_info"]["summary_cell_counts"].read().concat().to_pandas()
-    
-    # limit to humans and cell types
-    census_summary_cell_counts = census_summary_cell_counts[census_summary_cell_counts["organism"]=="Homo sapiens"]
-    census_summary_cell_counts = census_summary_cell_counts[census_summary_cell_counts["category"]=="cell_type"]
-    
-    # get the columns we care about
-    census_summary_cell_counts = census_summary_cell_counts[["ontology_term_id","unique_cell_count"]]
-
-    # add missing CL terms to rollup into
-    MISSING_CL_TERMS = list(set(ALL_CELL_ONTOLOGY_TERMS).symmetric_difference(set(census_summary_cell_counts["ontology_term_id"])))
-    added_empty_rows = pd.DataFrame([{"ontology_term_id": cl, "unique_cell_count": 0} for cl in MISSING_CL_TERMS])
-    census_summary_cell_counts = pd.concat([census_summary_cell_counts, added_empty_rows])
-    
-    # do the rollup
-    rollup_cell_type_df = rollup_across_cell_type_descendants(census_summary_cell_counts)
-    census_summary_cell_counts["unique_cell_count_with_descendants"] = rollup_cell_type_df["unique_cell_count"]
-
-    # create the json we're going to return, which will look like this and ONLY include the Homo Sapiens data (from the organism column)
-    # {
-    # data: [
-    #     {
-    #         "cell_type": "astrocyte", # where this is the ontology_term_id column
-    #         "unique_cell_count": 0.0 # where this is the total cell count column
-    #     },
-    # ]
-    # }
-    census_summary_cell_counts = census_summary_cell_counts.set_index("ontology_term_id")
-    records = census_summary_cell_counts.to_dict('records')
-    return dict(zip(census_summary_cell_counts.index,records))    
+    # optional ?organism (default homo_sapiens), ?category=cell_type|tissue|disease|... and
+    # ?direction=descendants|ancestors, defaulting to human cell types rolled up across their descendants.
+    category, direction = get_rollup_args()
+    organism = request.args.get("organism", "homo_sapiens")
+    try:
+        cube = rollup_cube.get(timeout=ROLLUP_CUBE_TIMEOUT)
+    except TimeoutError:
+        abort(503, "Cell counts are being computed, please retry")
+    if (organism, category) not in cube:
+        abort(404, f"No {category} cell counts for organism: {organism}")
+
+    return cached_frame_response(
+        response_cache,
+        frame_cache,
+        ("cellCounts", cube.version, organism, category, direction),
+        lambda: cube.slice(organism, category, direction),
+        lambda df: records_by(df, "ontology_term_id"),
+    )
+
+
+def warm_ontologies():
+    for name in SERVER_ONTOLOGIES:
+        get_ontology_closure(name)
+
+
+def warm_rollup_kernel():
+    from rollup_kernel import compile_kernel
+
+    compile_kernel()
+
+
+# initialize the heavy subsystems in the background, rather than in the first requests
+warmup = Warmup(
+    [
+        ("ontologies", warm_ontologies),
+        ("rollup_kernel", warm_rollup_kernel),
+        ("portal_datasets", portal_datasets.get),
+        ("dataset_graph", get_dataset_graph),
+        ("census", lambda: census_pool.version),
+        ("rollup_cube", lambda: rollup_cube.get()),
+    ],
+    # the portal is an upstream service, and its datasets are refetched on use
+    optional=("portal_datasets",),
+)
+
+
+def start_warmup():
+    # called from the main thread, which must start numba's thread pool before the warmup or request threads call the
+    # rollup kernel (see rollup_kernel.init_threads)
+    from rollup_kernel import init_threads
 
+    init_threads()
+    warmup.start()
 
 
+# gunicorn workers start the warmup once they are initialized, rather than on import (see gunicorn.conf.py)
+if SERVER_WARMUP and SERVER_WARMUP_ON_IMPORT:
+    start_warmup()
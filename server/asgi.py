@@ -0,0 +1,83 @@
+"""
+ASGI serving mode for the python backend, with the same routes and JSON shapes
+as the WSGI app in app.py.
+
+Lightweight routes (health, and the cached portal proxy, which revalidates with a
+non-blocking HTTP client) are served directly from the event loop. All other
+routes are served by the Flask app in a bounded thread pool, so slow census reads
+and rollups never block the event loop, and the number of concurrent heavy
+queries is capped by admission control (see admission.py).
+
+Run with:
+
+    $ SERVER_MODE=asgi gunicorn
+
+or, for development:
+
+    $ uvicorn asgi:app --port 5000
+"""
+import os
+import gzip
+import hashlib
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header
+
+from app import app as flask_app
+from portal import portal_datasets, UpstreamEntry
+from metrics import instrument_endpoint
+
+# threads serving the Flask routes
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", 16))
+
+# equivalent to the Flask-CORS configuration in app.py
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+async def hello_world(request: Request):
+    return HTMLResponse('<h1>This is the "/" route for the python backend for cellxgene-ontology</h1>')
+
+
+async def health(request: Request):
+    return JSONResponse({"hello": "world"}, headers=CORS_HEADERS)
+
+
+async def portal_datasets_route(request: Request):
+    return upstream_response(request, await portal_datasets.aget())
+
+
+def upstream_response(request: Request, entry: UpstreamEntry) -> Response:
+    """
+    Create a conditional response for the cached upstream entry, equivalent to
+    portal.upstream_response.
+    """
+    etag = entry.etag or f'"{hashlib.sha256(entry.body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding", **CORS_HEADERS}
+    if entry.last_modified:
+        headers["Last-Modified"] = entry.last_modified
+
+    if_none_match = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+    if "*" in if_none_match or etag.removeprefix("W/") in if_none_match:
+        return Response(status_code=304, headers=headers)
+
+    if parse_accept_header(request.headers.get("accept-encoding")).quality("gzip") > 0:
+        body = entry.body
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(entry.body)
+    return Response(body, headers=headers, media_type=entry.content_type)
+
+
+app = Starlette(
+    routes=[
+        Route("/api", hello_world),
+        # the Flask routes are instrumented by the Flask app
+        Route("/api/health", instrument_endpoint("/api/health", health)),
+        Route("/api/portalDatasets", instrument_endpoint("/api/portalDatasets", portal_datasets_route)),
+        Mount("/", app=WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+    ]
+)
@@ -0,0 +1,478 @@
+"""
+Local stand-ins for the server's external data, for benchmarking (see benchmark.py):
+
+- fixture OWL files, of synthetic CL and UBERON hierarchies, which are loaded through
+  the ontology cache (ontology.py) as downloaded ontologies are
+- a fake SOMA census, of synthetic cells and expression, backed by pandas
+- a stub of the portal datasets index, served over HTTP
+- a dataset graph (and gene names) of the fixture terms, for the graph, layout and
+  asset routes
+
+Fixtures are generated deterministically from a seed into a directory, along with the
+server's caches, so that runs are repeatable and never touch the network:
+
+    $FIXTURES_DIR/
+        owl/                    # <ontology>.owl
+        census/                 # parquet and npz files read by the fake census
+        portal/                 # datasets_index.json
+        public/                 # dataset_graph.json, ens_gene_convert.json
+        *_cache/                # the server's caches, see fixture_environment()
+
+The server is pointed at the fixtures via the environment (fixture_environment()),
+which must be set before any server module is imported, and create_app() (in place
+of app:app) serves the Flask app with its census pool reading the fake census.
+"""
+import os
+import gzip
+import json
+import hashlib
+import threading
+from functools import lru_cache
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+FIXTURES_DIR_ENV = "BENCH_FIXTURES_DIR"
+
+# ontology name: (number of terms, noun of the term labels)
+FIXTURE_ONTOLOGIES = {"CL": (400, "cell"), "UBERON": (200, "tissue")}
+
+# census experiment name: (organism label, NCBITaxon term, fraction of the cells)
+FIXTURE_ORGANISMS = {
+    "homo_sapiens": ("Homo sapiens", "NCBITaxon:9606", 0.8),
+    "mus_musculus": ("Mus musculus", "NCBITaxon:10090", 0.2),
+}
+
+FIXTURE_ASSAYS = {
+    "EFO:0009899": "10x 3' v2",
+    "EFO:0009922": "10x 3' v3",
+    "EFO:0011025": "10x 5' v1",
+    "EFO:0008931": "Smart-seq2",
+}
+
+FIXTURE_SEXES = {"PATO:0000383": "female", "PATO:0000384": "male"}
+
+N_DATASETS = 50
+N_TISSUES_GENERAL = 10
+
+# expressed genes per cell, as a fraction of all genes
+EXPRESSION_DENSITY = 0.02
+
+# rows per Arrow table read from the fake census
+READ_BATCH_ROWS = 65536
+
+LABEL_WORDS = ["alpha", "beta", "basal", "mature", "naive", "resident", "ciliated", "secretory", "stromal", "motor"]
+
+
+def fixture_environment(root: str) -> dict:
+    """
+    Return the environment variables pointing the server at the fixtures in root, and
+    keeping all of its caches there.
+    """
+    return {
+        FIXTURES_DIR_ENV: root,
+        "SERVER_ONTOLOGIES": ",".join(FIXTURE_ONTOLOGIES),
+        "ONTOLOGY_CACHE_DIR": os.path.join(root, "ontology_cache"),
+        "PORTAL_CACHE_DIR": os.path.join(root, "portal_cache"),
+        "LAYOUT_CACHE_DIR": os.path.join(root, "layout_cache"),
+        "STATIC_CACHE_DIR": os.path.join(root, "static_cache"),
+        "DISK_CACHE_PATH": os.path.join(root, "disk_cache", "cache.sqlite"),
+        "DATASET_GRAPH_URI": os.path.join(root, "public", "dataset_graph.json"),
+        "STATIC_ASSETS_DIR": os.path.join(root, "public"),
+    }
+
+
+def synthetic_hierarchy(prefix: str, n_terms: int, noun: str, rng: np.random.Generator) -> dict:
+    """
+    Return {term ID: (label, [parent term IDs])} of a random DAG rooted at the first
+    term. Each term has a parent among the terms before it, and some have a second.
+    """
+    terms = {}
+    term_ids = [f"{prefix}:{i:07d}" for i in range(n_terms)]
+    for i, term_id in enumerate(term_ids):
+        parents = []
+        if i > 0:
+            parents = sorted(set(rng.integers(0, i, size=2 if rng.random() < 0.2 else 1).tolist()))
+        words = rng.choice(LABEL_WORDS, size=2, replace=False)
+        terms[term_id] = (f"{words[0]} {words[1]} {noun} {i}", [term_ids[p] for p in parents])
+    return terms
+
+
+def write_owl(path: str, name: str, terms: dict, version: str):
+    """
+    Write the hierarchy as an OWL (RDF/XML) file, with OBO style IRIs.
+    """
+    obo = "http://purl.obolibrary.org/obo"
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write(
+            f'<rdf:RDF xmlns="{obo}/{name.lower()}.owl#" xml:base="{obo}/{name.lower()}.owl"'
+            ' xmlns:owl="http://www.w3.org/2002/07/owl#"'
+            ' xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+            ' xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#">\n'
+        )
+        f.write(f'  <owl:Ontology rdf:about="{obo}/{name.lower()}.owl">\n')
+        f.write(f'    <owl:versionIRI rdf:resource="{obo}/{name.lower()}/{version}/{name.lower()}.owl"/>\n')
+        f.write("  </owl:Ontology>\n")
+        for term_id, (label, parents) in terms.items():
+            f.write(f'  <owl:Class rdf:about="{obo}/{term_id.replace(":", "_")}">\n')
+            for parent in parents:
+                f.write(f'    <rdfs:subClassOf rdf:resource="{obo}/{parent.replace(":", "_")}"/>\n')
+            f.write(f"    <rdfs:label>{escape(label)}</rdfs:label>\n")
+            f.write("  </owl:Class>\n")
+        f.write("</rdf:RDF>\n")
+
+
+def _zipf_choice(rng: np.random.Generator, values: list, size: int) -> np.ndarray:
+    # a few values are common and most are rare, as cell types are in the census
+    weights = 1.0 / np.arange(1, len(values) + 1)
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=size, p=weights / weights.sum())]
+
+
+def synthetic_obs(n_cells: int, hierarchies: dict, rng: np.random.Generator) -> pd.DataFrame:
+    cell_types = list(hierarchies["CL"])
+    tissues = list(hierarchies["UBERON"])
+    tissues_general = tissues[:N_TISSUES_GENERAL]
+    tissue = _zipf_choice(rng, tissues, n_cells)
+    # each tissue belongs to one general tissue
+    general_of = {t: tissues_general[i % N_TISSUES_GENERAL] for i, t in enumerate(tissues)}
+    tissue_general_term = np.array([general_of[t] for t in tissue], dtype=object)
+    assay = rng.choice(list(FIXTURE_ASSAYS), size=n_cells)
+    sex = rng.choice(list(FIXTURE_SEXES), size=n_cells)
+    return pd.DataFrame(
+        {
+            "soma_joinid": np.arange(n_cells, dtype=np.int64),
+            "dataset_id": np.char.add("dataset-", rng.integers(0, N_DATASETS, n_cells).astype(str)).astype(object),
+            "assay": pd.Series(assay).map(FIXTURE_ASSAYS).to_numpy(dtype=object),
+            "assay_ontology_term_id": assay.astype(object),
+            "cell_type_ontology_term_id": _zipf_choice(rng, cell_types, n_cells),
+            "is_primary_data": rng.random(n_cells) < 0.8,
+            "sex": pd.Series(sex).map(FIXTURE_SEXES).to_numpy(dtype=object),
+            "sex_ontology_term_id": sex.astype(object),
+            "tissue_ontology_term_id": tissue,
+            "tissue_general": np.array([hierarchies["UBERON"][t][0] for t in tissue_general_term], dtype=object),
+            "tissue_general_ontology_term_id": tissue_general_term,
+        }
+    )
+
+
+def synthetic_var(n_genes: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "soma_joinid": np.arange(n_genes, dtype=np.int64),
+            "feature_id": [f"ENSG{i:011d}" for i in range(n_genes)],
+            "feature_name": [f"GENE{i}" for i in range(n_genes)],
+        }
+    )
+
+
+def synthetic_X(n_cells: int, n_genes: int, rng: np.random.Generator) -> dict:
+    """
+    Return the raw counts as COO arrays, sorted by cell then gene.
+    """
+    nnz = int(n_cells * n_genes * EXPRESSION_DENSITY)
+    positions = np.unique(rng.integers(0, n_cells * n_genes, size=nnz, dtype=np.int64))
+    return {
+        "soma_dim_0": positions // n_genes,
+        "soma_dim_1": positions % n_genes,
+        "soma_data": (rng.poisson(2.0, size=len(positions)) + 1).astype(np.float32),
+    }
+
+
+def summary_cell_counts(obs_by_organism: dict, labels: dict) -> pd.DataFrame:
+    """
+    Summarize the cell counts of each (organism, category, term), as in the census
+    census_info/summary_cell_counts.
+    """
+    categories = {
+        "all": None,
+        "assay": "assay_ontology_term_id",
+        "cell_type": "cell_type_ontology_term_id",
+        "sex": "sex_ontology_term_id",
+        "tissue": "tissue_ontology_term_id",
+        "tissue_general": "tissue_general_ontology_term_id",
+    }
+    rows = []
+    for organism, obs in obs_by_organism.items():
+        label = FIXTURE_ORGANISMS[organism][0]
+        for category, column in categories.items():
+            terms = obs[column] if column else pd.Series("na", index=obs.index)
+            total = terms.value_counts()
+            unique = terms[obs["is_primary_data"]].value_counts().reindex(total.index, fill_value=0)
+            for term_id in total.index:
+                rows.append(
+                    (label, category, term_id, labels.get(term_id, term_id), int(total[term_id]), int(unique[term_id]))
+                )
+    df = pd.DataFrame(
+        rows, columns=["organism", "category", "ontology_term_id", "label", "total_cell_count", "unique_cell_count"]
+    )
+    df.insert(0, "soma_joinid", np.arange(len(df), dtype=np.int64))
+    return df
+
+
+def portal_datasets_index(obs_by_organism: dict, labels: dict) -> list:
+    """
+    Return the portal datasets index, with the terms annotating each fixture dataset.
+    """
+    fields = {
+        "assay": "assay_ontology_term_id",
+        "cell_type": "cell_type_ontology_term_id",
+        "sex": "sex_ontology_term_id",
+        "tissue": "tissue_ontology_term_id",
+    }
+    datasets = {}
+    for organism, obs in obs_by_organism.items():
+        _, taxon, _ = FIXTURE_ORGANISMS[organism]
+        for dataset_id, dataset_obs in obs.groupby("dataset_id"):
+            dataset = datasets.setdefault(
+                dataset_id,
+                {"id": dataset_id, "name": f"Fixture {dataset_id}", "cell_count": 0, "organism": []},
+            )
+            dataset["cell_count"] += len(dataset_obs)
+            dataset["organism"].append({"label": FIXTURE_ORGANISMS[organism][0], "ontology_term_id": taxon})
+            for field, column in fields.items():
+                terms = sorted(set(dataset_obs[column]) | {t["ontology_term_id"] for t in dataset.get(field, [])})
+                dataset[field] = [{"label": labels.get(t, t), "ontology_term_id": t} for t in terms]
+    return [datasets[dataset_id] for dataset_id in sorted(datasets)]
+
+
+def dataset_graph(hierarchies: dict, obs_by_organism: dict) -> dict:
+    """
+    Return a dataset graph (as written by create-graph) of the fixture terms.
+    """
+    term_columns = ["cell_type_ontology_term_id", "tissue_ontology_term_id"]
+    n_cells = pd.concat([obs[col] for obs in obs_by_organism.values() for col in term_columns]).value_counts()
+    ontologies = {}
+    layout_roots = {}
+    for name, terms in hierarchies.items():
+        ontologies[name] = {
+            term_id: {"label": label, "parents": parents, "synonyms": [], "n_cells": int(n_cells.get(term_id, 0))}
+            for term_id, (label, parents) in terms.items()
+        }
+        # the root, and its first children
+        layout_roots[name] = [term_id for term_id, (_, parents) in terms.items() if len(parents) <= 1][:3]
+    return {"created_on": "fixture", "ontologies": ontologies, "layout_roots": layout_roots}
+
+
+def build_fixtures(root: str, n_cells: int = 100_000, n_genes: int = 2000, seed: int = 0):
+    """
+    Generate the fixtures into root, and load the fixture ontologies into the ontology
+    cache. The environment (fixture_environment(root)) must already be set.
+    """
+    from ontology import parse_owl, save_ontology, load_closure
+
+    rng = np.random.default_rng(seed)
+    for subdir in ["owl", "census", "portal", "public"]:
+        os.makedirs(os.path.join(root, subdir), exist_ok=True)
+
+    hierarchies = {}
+    for name, (n_terms, noun) in FIXTURE_ONTOLOGIES.items():
+        hierarchies[name] = synthetic_hierarchy(name, n_terms, noun, rng)
+        owl_path = os.path.join(root, "owl", f"{name}.owl")
+        write_owl(owl_path, name, hierarchies[name], f"fixture-{seed}")
+        ontology = parse_owl(name, f"file://{owl_path}")
+        save_ontology(ontology, os.environ["ONTOLOGY_CACHE_DIR"])
+        load_closure(ontology, os.environ["ONTOLOGY_CACHE_DIR"])
+    labels = {term_id: label for terms in hierarchies.values() for term_id, (label, _) in terms.items()}
+    labels.update(FIXTURE_ASSAYS)
+    labels.update(FIXTURE_SEXES)
+
+    census_dir = os.path.join(root, "census")
+    var = synthetic_var(n_genes)
+    obs_by_organism = {}
+    for organism, (_, _, fraction) in FIXTURE_ORGANISMS.items():
+        n_organism_cells = max(1, int(n_cells * fraction))
+        obs_by_organism[organism] = synthetic_obs(n_organism_cells, hierarchies, rng)
+        obs_by_organism[organism].to_parquet(os.path.join(census_dir, f"{organism}.obs.parquet"))
+        var.to_parquet(os.path.join(census_dir, f"{organism}.var.parquet"))
+        np.savez(os.path.join(census_dir, f"{organism}.X.npz"), **synthetic_X(n_organism_cells, n_genes, rng))
+    summary_cell_counts(obs_by_organism, labels).to_parquet(os.path.join(census_dir, "summary_cell_counts.parquet"))
+    pd.DataFrame(
+        {"label": ["census_schema_version", "census_build_date"], "value": ["fixture", f"seed-{seed}"]}
+    ).to_parquet(os.path.join(census_dir, "summary.parquet"))
+
+    with open(os.path.join(root, "portal", "datasets_index.json"), "w") as f:
+        json.dump(portal_datasets_index(obs_by_organism, labels), f)
+    with open(os.path.join(root, "public", "dataset_graph.json"), "w") as f:
+        json.dump(dataset_graph(hierarchies, obs_by_organism), f)
+    with open(os.path.join(root, "public", "ens_gene_convert.json"), "w") as f:
+        gene_names = [{gene: name} for gene, name in zip(var["feature_id"], var["feature_name"])]
+        json.dump({"gene_terms": {FIXTURE_ORGANISMS["homo_sapiens"][1]: gene_names}}, f)
+
+
+def fixture_terms(root: str) -> dict:
+    """
+    Return {ontology name: [term IDs]} of the fixture ontologies, and the gene IDs
+    (under "genes"), for generating requests.
+    """
+    with open(os.path.join(root, "public", "dataset_graph.json")) as f:
+        graph = json.load(f)
+    terms = {name: list(ontology_terms) for name, ontology_terms in graph["ontologies"].items()}
+    terms["genes"] = pd.read_parquet(os.path.join(root, "census", "homo_sapiens.var.parquet"))["feature_id"].tolist()
+    terms["layout_roots"] = graph["layout_roots"]
+    return terms
+
+
+class FakeReadIter(list):
+    """
+    Arrow tables read from the fake census, as returned by SOMA reads.
+    """
+
+    def concat(self) -> pa.Table:
+        return pa.concat_tables(self)
+
+
+def _to_tables(df: pd.DataFrame) -> FakeReadIter:
+    # always at least one (possibly empty) table, so the schema is known
+    return FakeReadIter(
+        pa.Table.from_pandas(df.iloc[start : start + READ_BATCH_ROWS], preserve_index=False)
+        for start in range(0, max(len(df), 1), READ_BATCH_ROWS)
+    )
+
+
+class FakeSOMADataFrame:
+    """
+    A pandas-backed stand-in for a SOMA DataFrame. Value filters are evaluated with
+    DataFrame.query, which accepts the subset of the SOMA filter syntax used by the
+    server (==, in, and, True/False).
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+    def keys(self) -> list:
+        return self.df.columns.tolist()
+
+    def query(self, value_filter: str = None) -> pd.DataFrame:
+        return self.df.query(value_filter) if value_filter else self.df
+
+    def read(self, value_filter: str = None, column_names: list = None) -> FakeReadIter:
+        df = self.query(value_filter)
+        return _to_tables(df[column_names] if column_names else df)
+
+
+class FakeSparseNDArray:
+    """
+    A stand-in for a SOMA SparseNDArray, as a dict of COO columns.
+    """
+
+    def __init__(self, coo: dict):
+        self._coo = coo
+
+    def read(self, coords=()):
+        return FakeSparseRead(self._coo, coords)
+
+
+class FakeSparseRead:
+    def __init__(self, coo: dict, coords):
+        self._coo = coo
+        self._coords = coords
+
+    def tables(self):
+        dims = [self._coo["soma_dim_0"], self._coo["soma_dim_1"]]
+        for start in range(0, len(dims[0]), READ_BATCH_ROWS):
+            batch = slice(start, start + READ_BATCH_ROWS)
+            mask = np.ones(len(dims[0][batch]), dtype=bool)
+            for dim, coords in zip(dims, self._coords):
+                if not isinstance(coords, slice):
+                    mask &= np.isin(dim[batch], coords)
+            if mask.any():
+                yield pa.Table.from_pydict({name: array[batch][mask] for name, array in self._coo.items()})
+
+
+class FakeMeasurement:
+    def __init__(self, var: pd.DataFrame, X: dict):
+        self.var = FakeSOMADataFrame(var)
+        self.X = {"raw": FakeSparseNDArray(X)}
+
+
+class FakeExperiment:
+    def __init__(self, obs: pd.DataFrame, var: pd.DataFrame, X: dict):
+        self.obs = FakeSOMADataFrame(obs)
+        self.ms = {"RNA": FakeMeasurement(var, X)}
+
+
+class FakeCensus(dict):
+    def close(self):
+        pass
+
+
+@lru_cache(maxsize=None)
+def _load_census(census_dir: str) -> FakeCensus:
+    census_data = {}
+    for organism in FIXTURE_ORGANISMS:
+        with np.load(os.path.join(census_dir, f"{organism}.X.npz")) as X:
+            census_data[organism] = FakeExperiment(
+                pd.read_parquet(os.path.join(census_dir, f"{organism}.obs.parquet")),
+                pd.read_parquet(os.path.join(census_dir, f"{organism}.var.parquet")),
+                dict(X),
+            )
+    census_info = {
+        name: FakeSOMADataFrame(pd.read_parquet(os.path.join(census_dir, f"{name}.parquet")))
+        for name in ["summary", "summary_cell_counts"]
+    }
+    return FakeCensus(census_data=census_data, census_info=census_info)
+
+
+def open_fake_census(root: str = None) -> FakeCensus:
+    """
+    Open the fake census in root (by default, $BENCH_FIXTURES_DIR). The data is read
+    once per process, and shared by all handles, which are read-only.
+    """
+    return _load_census(os.path.join(root or os.environ[FIXTURES_DIR_ENV], "census"))
+
+
+def create_app():
+    """
+    Return the server's Flask app, with its census pool opening the fake census, eg,
+    gunicorn -c gunicorn.conf.py "bench_fixtures:create_app()". The warmup, if
+    enabled with BENCH_WARMUP, is started once the fake census is in place.
+    """
+    os.environ["SERVER_WARMUP"] = "0"
+    import app
+    from census_access import CensusPool
+
+    app.census_pool = CensusPool(open_fake_census)
+    if os.environ.get("BENCH_WARMUP", "1").lower() in ("1", "true", "yes"):
+        app.start_warmup()
+    return app.app
+
+
+class _PortalHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body, etag = self.server.body, self.server.etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_portal_stub(root: str) -> ThreadingHTTPServer:
+    """
+    Serve the fixture portal datasets index (with ETag revalidation) from a
+    background thread. The index URL is the server's url attribute.
+    """
+    with open(os.path.join(root, "portal", "datasets_index.json"), "rb") as f:
+        body = f.read()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PortalHandler)
+    server.body = body
+    server.etag = f'"{hashlib.sha256(body).hexdigest()}"'
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/dp/v1/datasets/index"
+    threading.Thread(target=server.serve_forever, name="portal-stub", daemon=True).start()
+    return server
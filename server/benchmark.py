@@ -0,0 +1,376 @@
+"""
+Benchmarks of the server, against local fixtures (see bench_fixtures.py) rather than
+the live census, ontologies and portal, so that results are repeatable and comparable
+across server changes.
+
+Load tests serve the app under gunicorn (with gunicorn.conf.py), and report the
+latency percentiles and throughput of each endpoint under concurrent requests:
+
+    python benchmark.py load [--concurrency N] [--requests N] [--endpoints a,b] [--json out.json]
+
+Rollup micro-benchmarks time rollup_across_cell_type_descendants over synthetic tidy
+frames of increasing dimensionality, with the dense and sparse rollups:
+
+    python benchmark.py rollup [--shapes 400 400x100 400x100x10] [--repeat N]
+
+Fixtures are generated into --fixtures (by default a new temporary directory), and
+reused if already there. Save results with --json, and compare a later run to them
+with --compare.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from bench_fixtures import (
+    N_TISSUES_GENERAL,
+    LABEL_WORDS,
+    build_fixtures,
+    fixture_environment,
+    fixture_terms,
+    start_portal_stub,
+)
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# how long to wait for the server to start, and to finish its warmup (seconds)
+STARTUP_TIMEOUT = 120
+WARMUP_TIMEOUT = 600
+
+CELL_TYPE_COLUMN = "cell_type_ontology_term_id"
+
+# the number of distinct embeddings requested, as each is a UMAP fit
+N_EMBEDDINGS = 4
+
+
+def _choice(rng: np.random.Generator, values: list):
+    return values[int(rng.integers(len(values)))]
+
+
+# endpoint name: fn(rng, fixture terms) returning the kwargs of a request
+ENDPOINTS = {
+    "health": lambda rng, t: {"method": "GET", "url": "/api/health"},
+    "portalDatasets": lambda rng, t: {"method": "GET", "url": "/api/portalDatasets"},
+    "datasetsByTerm": lambda rng, t: {
+        "method": "GET",
+        "url": f"/api/datasetsByTerm/{_choice(rng, t['CL'])}",
+        "params": {"descendants": "true"},
+    },
+    "ontologyLineage": lambda rng, t: {
+        "method": "GET",
+        "url": f"/api/ontology/CL/{_choice(rng, t['CL'])}/{_choice(rng, ['descendants', 'ancestors'])}",
+    },
+    "cellCounts": lambda rng, t: {
+        "method": "GET",
+        "url": "/api/census/cellCounts",
+        "params": {
+            "organism": _choice(rng, ["homo_sapiens", "mus_musculus"]),
+            "category": _choice(rng, ["cell_type", "tissue", "tissue_general"]),
+            "direction": _choice(rng, ["descendants", "ancestors"]),
+        },
+    },
+    "obsCounts": lambda rng, t: {
+        "method": "GET",
+        "url": "/api/census/obsCounts",
+        "params": {
+            "field": "cell_type_ontology_term_id",
+            "filter": f"tissue_general_ontology_term_id == '{_choice(rng, t['UBERON'][:N_TISSUES_GENERAL])}'",
+            "rollup": "true",
+        },
+    },
+    "geneExpression": lambda rng, t: {
+        "method": "GET",
+        "url": "/api/census/geneExpression",
+        "params": {"genes": ",".join(rng.choice(t["genes"], size=5, replace=False)), "rollup": "true"},
+    },
+    "embedding": lambda rng, t: {
+        "method": "POST",
+        "url": "/api/embedding",
+        "json": {
+            "terms": np.random.default_rng(int(rng.integers(N_EMBEDDINGS))).choice(t["CL"], 30, False).tolist(),
+            "genes": t["genes"][:50],
+        },
+    },
+    "graphSearch": lambda rng, t: {
+        "method": "GET",
+        "url": "/api/graph/search",
+        "params": {"q": (lambda word: word[: int(rng.integers(3, len(word) + 1))])(_choice(rng, LABEL_WORDS))},
+    },
+    "graphNeighborhood": lambda rng, t: {
+        "method": "GET",
+        "url": f"/api/graph/{_choice(rng, t['CL'])}/neighborhood",
+        "params": {"depth": 2},
+    },
+    "layout": lambda rng, t: {
+        "method": "GET",
+        "url": f"/api/layout/{_choice(rng, t['layout_roots']['CL'])}",
+        "params": {"max_depth": int(rng.integers(2, 5))},
+    },
+}
+
+
+def prepare_fixtures(args) -> str:
+    """
+    Point the environment at the fixtures, generating them if necessary, and return
+    the fixtures directory.
+    """
+    root = os.path.abspath(args.fixtures or tempfile.mkdtemp(prefix="server-bench-"))
+    os.environ.update(fixture_environment(root))
+    if not os.path.exists(os.path.join(root, "public", "dataset_graph.json")):
+        start = time.perf_counter()
+        build_fixtures(root, n_cells=args.cells, n_genes=args.genes, seed=args.seed)
+        print(f"Generated fixtures in {root} ({time.perf_counter() - start:.1f}s)")
+    return root
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, timeout: float, server: subprocess.Popen = None) -> bool:
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"The server exited with status {server.returncode}")
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def start_server(root: str, args) -> tuple:
+    """
+    Start gunicorn serving the app with the fake census, and return (process, base URL).
+    """
+    port = _free_port()
+    env = {
+        **os.environ,
+        "BIND": f"127.0.0.1:{port}",
+        "WEB_CONCURRENCY": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+        "BENCH_WARMUP": "0" if args.cold else "1",
+    }
+    log = open(os.path.join(root, "gunicorn.log"), "ab")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "bench_fixtures:create_app()"],
+        cwd=SERVER_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    log.close()
+    base_url = f"http://127.0.0.1:{port}"
+    if not _wait_for(f"{base_url}/api/health", STARTUP_TIMEOUT, server):
+        server.terminate()
+        raise RuntimeError(f"The server did not start, see {root}/gunicorn.log")
+    if not args.cold and not _wait_for(f"{base_url}/api/ready", WARMUP_TIMEOUT, server):
+        print("Warning: the server warmup did not finish")
+    return server, base_url
+
+
+def run_load(base_url: str, requests_kwargs: list, concurrency: int) -> dict:
+    """
+    Make the requests from concurrency threads (each keeping one request in flight),
+    and return their latency percentiles and throughput.
+    """
+    import requests
+
+    local = threading.local()
+
+    def timed_request(kwargs):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.request(**{**kwargs, "url": base_url + kwargs["url"]}, timeout=300)
+        response.content
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_request, requests_kwargs))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results])
+    errors = sum(1 for _, status in results if status >= 400)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "max": float(latencies.max()),
+        "throughput": len(results) / elapsed,
+    }
+
+
+def _delta(value: float, baseline: float) -> str:
+    return f"{100 * (value - baseline) / baseline:+6.1f}%" if baseline else ""
+
+
+def print_load_results(results: dict, baseline: dict):
+    print(
+        f"\n{'endpoint':20} {'requests':>8} {'errors':>6} {'p50 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10} "
+        f"{'req/s':>8}"
+    )
+    for name, r in results.items():
+        line = (
+            f"{name:20} {r['requests']:8d} {r['errors']:6d} {1000 * r['p50']:10.1f} {1000 * r['p99']:10.1f} "
+            f"{1000 * r['max']:10.1f} {r['throughput']:8.1f}"
+        )
+        if name in baseline:
+            b = baseline[name]
+            line += f"   p50 {_delta(r['p50'], b['p50'])}  p99 {_delta(r['p99'], b['p99'])}"
+            line += f"  req/s {_delta(r['throughput'], b['throughput'])}"
+        print(line)
+
+
+def load(args) -> dict:
+    root = prepare_fixtures(args)
+    terms = fixture_terms(root)
+    endpoints = args.endpoints.split(",") if args.endpoints else list(ENDPOINTS)
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        portal_stub = start_portal_stub(root)
+        os.environ["PORTAL_DATASETS_INDEX_URL"] = portal_stub.url
+        server, base_url = start_server(root, args)
+
+    results = {}
+    try:
+        for name in endpoints:
+            # the same requests, in the same order, on every run
+            rng = np.random.default_rng(args.seed)
+            requests_kwargs = [ENDPOINTS[name](rng, terms) for _ in range(args.requests)]
+            results[name] = run_load(base_url, requests_kwargs, args.concurrency)
+            print(f"{name}: done")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def synthetic_tidy_frame(shape: tuple, cell_types: list, density: float, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Return a tidy frame with a cell type column and one column per
+    other dimension (of shape[1:] values each), with density of the combinations
+    present, and count and sum value columns.
+    """
+    n_combinations = int(np.prod(shape))
+    n_rows = max(1, int(n_combinations * density))
+    positions = np.sort(rng.choice(n_combinations, size=n_rows, replace=False))
+    indices = np.unravel_index(positions, shape)
+    columns = {CELL_TYPE_COLUMN: np.asarray(cell_types[: shape[0]], dtype=object)[indices[0]]}
+    for dim, dim_indices in enumerate(indices[1:], start=1):
+        columns[f"dim_{dim}"] = np.char.add(f"d{dim}-", dim_indices.astype(str)).astype(object)
+    columns["count"] = rng.integers(0, 1000, size=n_rows)
+    columns["sum"] = rng.random(n_rows) * 100
+    return pd.DataFrame(columns)
+
+
+def _parse_shape(text: str) -> tuple:
+    return tuple(int(n) for n in text.lower().split("x"))
+
+
+def rollup(args) -> dict:
+    root = prepare_fixtures(args)
+    from rollup import MAX_DENSE_ROLLUP_SIZE, rollup_across_cell_type_descendants
+    from rollup_kernel import compile_kernel
+
+    cell_types = fixture_terms(root)["CL"]
+    compile_kernel()
+    rng = np.random.default_rng(args.seed)
+
+    results = {}
+    print(f"\n{'shape':16} {'rows':>10} {'mode':6} {'median (ms)':>12} {'min (ms)':>10} {'Mrows/s':>8}")
+    for shape_text in args.shapes:
+        shape = _parse_shape(shape_text)
+        if shape[0] > len(cell_types):
+            raise SystemExit(f"At most {len(cell_types)} cell types, in shape {shape_text}")
+        df = synthetic_tidy_frame(shape, cell_types, args.density, rng)
+        for mode in args.modes.split(","):
+            # the dense array holds every combination, of each value column
+            if mode == "dense" and np.prod(shape) * 2 > MAX_DENSE_ROLLUP_SIZE:
+                continue
+            sparse = {"dense": False, "sparse": True, "auto": None}[mode]
+            # the first call loads the ontology closure
+            rollup_across_cell_type_descendants(df, cell_type_col=CELL_TYPE_COLUMN, sparse=sparse)
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                rollup_across_cell_type_descendants(df, cell_type_col=CELL_TYPE_COLUMN, sparse=sparse)
+                timings.append(time.perf_counter() - start)
+            median = float(np.median(timings))
+            results[f"{shape_text}/{mode}"] = {"rows": len(df), "median": median, "min": float(min(timings))}
+            print(
+                f"{shape_text:16} {len(df):10d} {mode:6} {1000 * median:12.2f} {1000 * min(timings):10.2f} "
+                f"{len(df) / median / 1e6:8.2f}"
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", type=str, default=None, help="Fixtures directory, generated if empty")
+    parser.add_argument("--cells", type=int, default=100_000, help="Number of fixture census cells")
+    parser.add_argument("--genes", type=int, default=2000, help="Number of fixture census genes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fixtures and requests")
+    parser.add_argument("--json", type=str, default=None, help="Save the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare to results saved with --json")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sp = subparsers.add_parser("load", help="Load test the server endpoints")
+    sp.add_argument("--endpoints", type=str, default=None, help=f"Comma separated, of {', '.join(ENDPOINTS)}")
+    sp.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    sp.add_argument("--concurrency", type=int, default=8, help="Concurrent requests")
+    sp.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    sp.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    sp.add_argument("--cold", action="store_true", help="Don't wait for the server warmup")
+    sp.add_argument("--url", type=str, default=None, help="Load test this server, serving the same fixtures")
+
+    sp = subparsers.add_parser("rollup", help="Micro-benchmark the rollup")
+    sp.add_argument("--shapes", nargs="*", default=["400", "400x10", "400x100", "400x10x10", "400x100x10"])
+    sp.add_argument("--density", type=float, default=0.25, help="Fraction of the combinations present")
+    sp.add_argument("--modes", type=str, default="dense,sparse", help="Comma separated, of dense, sparse and auto")
+    sp.add_argument("--repeat", type=int, default=5, help="Timed calls per shape and mode")
+
+    args = parser.parse_args()
+    results = load(args) if args.command == "load" else rollup(args)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    if args.command == "load":
+        print_load_results(results, baseline)
+    elif baseline:
+        print("\nCompared to the baseline (median):")
+        for name, r in results.items():
+            if name in baseline:
+                print(f"  {name:24} {_delta(r['median'], baseline[name]['median'])}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Caching of computed API responses.
+
+Expensive responses only change when the underlying data changes (eg, a new census
+release or ontology version), so they are computed once, serialized, and cached
+under a key which includes those data versions. Each cached response carries a
+strong ETag (a hash of the body), so clients can revalidate with If-None-Match
+and receive a 304 instead of the payload.
+
+Concurrent requests for the same uncached key (eg, a thundering herd after a deploy)
+are coalesced, so that only one computes the response and the rest wait for it.
+
+Caches may also be persisted to the disk cache (see disk_cache.py), so that they
+survive restarts and are shared by all server processes.
+
+Tabular responses are negotiated on the Accept header: Arrow IPC stream, msgpack
+(a map of column name to column values), or JSON (the default).
+"""
+import json
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import msgpack
+import pandas as pd
+import pyarrow as pa
+from flask import Response, request
+
+from disk_cache import DiskCache, disk_cache
+from metrics import CACHE_LOOKUPS, span
+
+CachedResponse = namedtuple("CachedResponse", ["body", "mimetype", "etag"])
+
+
+def make_cached_response(body: bytes, mimetype: str) -> CachedResponse:
+    return CachedResponse(body, mimetype, hashlib.sha256(body).hexdigest())
+
+
+@span("serialize")
+def make_json_cached_response(data) -> CachedResponse:
+    return make_cached_response(json.dumps(data, separators=(",", ":")).encode("utf-8"), "application/json")
+
+
+JSON_MIMETYPE = "application/json"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+
+@span("serialize")
+def make_arrow_cached_response(df: pd.DataFrame) -> CachedResponse:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return make_cached_response(sink.getvalue().to_pybytes(), ARROW_MIMETYPE)
+
+
+@span("serialize")
+def make_msgpack_cached_response(df: pd.DataFrame) -> CachedResponse:
+    # columnar, ie, { column: [values] }, so there are no per-row objects to build or parse
+    columns = {str(col): df[col].tolist() for col in df.columns}
+    return make_cached_response(msgpack.packb(columns), MSGPACK_MIMETYPE)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into a single in-flight computation,
+    whose result (or exception) is shared by all callers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache, keyed by a tuple which must include the versions of all
+    data the value was computed from.
+    """
+
+    def __init__(self, maxsize: int = 128, persist: str = None, disk: DiskCache = disk_cache, name: str = None):
+        """
+        If persist is specified, entries are also stored in the disk cache, under that
+        namespace, and entries missing from memory are looked up there. name labels the
+        cache's hit/miss metrics, and defaults to persist.
+        """
+        self.maxsize = maxsize
+        self.name = name or persist or "unnamed"
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._persist = persist
+        self._disk = disk
+
+    def get(self, key):
+        entry, result = self._lookup(key)
+        CACHE_LOOKUPS.labels(self.name, result).inc()
+        return entry
+
+    def _lookup(self, key):
+        # return (entry, result), where result is "hit", "disk_hit" or "miss"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry, "hit"
+
+        if self._persist:
+            entry = self._disk.get(DiskCache.make_key(self._persist, key))
+            if entry is not None:
+                self._put_memory(key, entry)
+                return entry, "disk_hit"
+        return None, "miss"
+
+    def put(self, key, entry):
+        self._put_memory(key, entry)
+        if self._persist:
+            self._disk.put(DiskCache.make_key(self._persist, key), entry)
+
+    def _put_memory(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute_fn):
+        """
+        Return the cached entry for key, calling compute_fn() to create it on a miss.
+        Concurrent misses on the same key share a single call to compute_fn().
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self._flight.do(key, lambda: self._compute(key, compute_fn))
+        return entry
+
+    def _compute(self, key, compute_fn):
+        # another caller may have completed the computation since our miss
+        entry, _ = self._lookup(key)
+        if entry is None:
+            entry = compute_fn()
+            self.put(key, entry)
+        return entry
+
+
+class ResponseCache(LRUCache):
+    """
+    LRU cache of CachedResponse.
+    """
+
+
+def to_conditional_response(entry: CachedResponse) -> Response:
+    """
+    Create a Flask response for the cached entry, which is a 304 if the request's
+    If-None-Match matches the entry ETag.
+    """
+    response = Response(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    # allow caching, but require revalidation so that new data versions are picked up
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+def cached_json_response(cache: ResponseCache, key, compute_fn) -> Response:
+    """
+    Return a conditional JSON response for key, calling compute_fn() to compute the
+    (JSON serializable) data on a cache miss.
+    """
+    entry = cache.get_or_compute(key, lambda: make_json_cached_response(compute_fn()))
+    return to_conditional_response(entry)
+
+
+def cached_frame_response(cache: ResponseCache, frame_cache: LRUCache, key, compute_fn, to_json) -> Response:
+    """
+    Return a conditional response for key in the format negotiated by the request's
+    Accept header. compute_fn() computes a DataFrame on a cache miss, which is cached
+    in frame_cache and shared by all formats. to_json(df) returns the (JSON
+    serializable) data of the default JSON format.
+    """
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, ARROW_MIMETYPE, MSGPACK_MIMETYPE], JSON_MIMETYPE)
+
+    def compute():
+        df = frame_cache.get_or_compute(key, compute_fn)
+        if mimetype == ARROW_MIMETYPE:
+            return make_arrow_cached_response(df)
+        if mimetype == MSGPACK_MIMETYPE:
+            return make_msgpack_cached_response(df)
+        return make_json_cached_response(to_json(df))
+
+    response = to_conditional_response(cache.get_or_compute((key, mimetype), compute))
+    response.vary.add("Accept")
+    return response
@@ -0,0 +1,435 @@
+"""
+Access to the Cell Census.
+
+Census dataframes can be large, so reads should push filters and column projections
+down into the SOMA read (value_filter and column_names), rather than reading the
+whole dataframe and filtering it in pandas. Where possible, consume the result as a
+stream of Arrow tables rather than concatenating it.
+"""
+import os
+import sys
+import ast
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from metrics import span
+
+
+logger = logging.getLogger(__name__)
+
+# how often (seconds) to check for a new census release
+CENSUS_VERSION_TTL = float(os.environ.get("CENSUS_VERSION_TTL", 3600))
+
+
+class CensusPool:
+    """
+    Thread-safe, fork-aware pool of open census handles.
+
+    Handles are opened lazily, on first use. A handle which raises a storage error (see
+    storage_errors) while in use is closed and discarded, so the next request reopens
+    the census. Other errors return the handle to the pool. Handles
+    inherited across a fork (eg, from a pre-loading gunicorn master) are never used
+    by the child process.
+
+    The census version is re-read every version_ttl seconds. A handle is pinned to the
+    release it opened, so when the version changes the pooled handles are discarded.
+    """
+
+    def __init__(self, open_fn, max_idle: int = 4, version_ttl: float = CENSUS_VERSION_TTL):
+        self._open_fn = open_fn
+        self._max_idle = max_idle
+        self._version_ttl = version_ttl
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._version_lock = threading.Lock()
+        self._idle = []
+        self._version = None
+        self._version_read_at = 0.0
+        # incremented when the version changes, so that handles of the previous release are not pooled
+        self._generation = 0
+
+    def _check_fork(self):
+        if os.getpid() != self._pid:
+            # don't close the parent's handles - they are still in use by the parent
+            self._reset()
+
+    def _acquire(self):
+        self._check_fork()
+        with self._lock:
+            generation = self._generation
+            if self._idle:
+                return self._idle.pop(), generation
+        return self._open_fn(), generation
+
+    def _release(self, census, generation: int):
+        with self._lock:
+            if os.getpid() == self._pid and generation == self._generation and len(self._idle) < self._max_idle:
+                self._idle.append(census)
+                return
+        _close(census)
+
+    @contextmanager
+    def handle(self):
+        """
+        Context manager returning an open census handle for exclusive use by the caller.
+        """
+        census, generation = self._acquire()
+        try:
+            yield census
+        except storage_errors():
+            # the handle may be in a bad state, so reopen on next use
+            _close(census)
+            raise
+        except Exception:
+            # eg, an HTTP error response or invalid input, which leave the handle usable
+            self._release(census, generation)
+            raise
+        else:
+            self._release(census, generation)
+
+    @property
+    def version(self) -> str:
+        """
+        The census release, re-read every version_ttl seconds.
+        """
+        self._check_fork()
+        if self._version is None or time.monotonic() - self._version_read_at > self._version_ttl:
+            # one thread re-reads the version, while the others use the previous one
+            if self._version_lock.acquire(blocking=self._version is None):
+                try:
+                    if self._version is None or time.monotonic() - self._version_read_at > self._version_ttl:
+                        self._read_version()
+                finally:
+                    self._version_lock.release()
+        return self._version
+
+    def _read_version(self):
+        # read from a newly opened handle, as pooled handles are pinned to the release they opened
+        census = self._open_fn()
+        try:
+            version = get_census_version(census)
+        except Exception:
+            _close(census)
+            raise
+        with self._lock:
+            if self._version is not None and version != self._version:
+                logger.info(f"Census version changed from {self._version} to {version}")
+                self._generation += 1
+                idle, self._idle = self._idle, []
+            else:
+                idle = []
+            self._version = version
+            self._version_read_at = time.monotonic()
+            generation = self._generation
+        for idle_census in idle:
+            _close(idle_census)
+        # the new handle is of the current release, so can be pooled
+        self._release(census, generation)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for census in idle:
+            _close(census)
+
+
+def _module_errors(module_name: str, error_name: str) -> tuple:
+    # the census libraries are slow to import, so are only imported with the census (see open_census in app.py)
+    module = sys.modules.get(module_name)
+    error = getattr(module, error_name, None)
+    return (error,) if error is not None else ()
+
+
+def storage_errors() -> tuple:
+    """
+    Return the exception types of census storage (I/O) errors, after which a census
+    handle may be unusable.
+    """
+    return (OSError, *_module_errors("tiledb", "TileDBError"))
+
+
+def value_filter_errors() -> tuple:
+    """
+    Return the exception types of census reads with a value filter which doesn't apply
+    to the dataframe, eg, one comparing a string column to a number.
+    """
+    return (ValueError, TypeError, *_module_errors("tiledbsoma", "SOMAError"))
+
+
+def _close(census):
+    try:
+        census.close()
+    except Exception as e:
+        logger.warning(f"Error closing census: {e}")
+
+
+def value_filter(**equals) -> str:
+    """
+    Return a SOMA value_filter expression matching all of the column == value
+    conditions, eg, value_filter(organism="Homo sapiens", category="cell_type").
+    None values are ignored. Return None if there are no conditions.
+    """
+    conditions = [f"{column} == {_quote(value)}" for column, value in equals.items() if value is not None]
+    return " and ".join(conditions) if conditions else None
+
+
+def _quote(value) -> str:
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+        return f"'{escaped}'"
+    return repr(value)
+
+
+# the expression syntax accepted by SOMA value filters
+_VALUE_FILTER_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.In,
+    ast.NotIn,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.List,
+    ast.Tuple,
+)
+
+
+def value_filter_columns(value_filter: str) -> set:
+    """
+    Return the names of the columns referenced by a SOMA value_filter expression, eg,
+    {"tissue_general", "sex"} for "tissue_general == 'lung' and sex != 'male'". Raise
+    ValueError if the expression is not a valid value filter.
+    """
+    try:
+        tree = ast.parse(value_filter, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(e.msg) from None
+    columns = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _VALUE_FILTER_NODES):
+            expression = ast.get_source_segment(value_filter, node) or type(node).__name__
+            raise ValueError(f"Unsupported expression: {expression}")
+        if isinstance(node, ast.Name):
+            columns.add(node.id)
+    return columns
+
+
+def read_batches(soma_df, value_filter: str = None, column_names: list = None) -> Iterator[pa.Table]:
+    """
+    Stream a SOMA dataframe as Arrow tables, with the filter and projection pushed
+    down into the read.
+    """
+    yield from soma_df.read(value_filter=value_filter, column_names=column_names)
+
+
+@span("census_read")
+def read_pandas(soma_df, value_filter: str = None, column_names: list = None) -> pd.DataFrame:
+    """
+    Read a SOMA dataframe into pandas, with the filter and projection pushed down
+    into the read. Only use this for results which are known to be small.
+    """
+    tables = list(read_batches(soma_df, value_filter, column_names))
+    if not tables:
+        return pd.DataFrame(columns=column_names)
+    return pa.concat_tables(tables).to_pandas()
+
+
+@span("census_read")
+def read_value_counts(soma_df, column: str, value_filter: str = None) -> pd.Series:
+    """
+    Count the occurrences of each value in a column of a SOMA dataframe, optionally
+    filtered. Only the one column is read, and it is counted batch by batch as it
+    streams from the census, so the rows are never materialized in pandas.
+    """
+    counts = {}
+    for batch in read_batches(soma_df, value_filter, column_names=[column]):
+        batch_counts = pc.value_counts(batch.column(column))
+        for value, count in zip(
+            batch_counts.field("values").to_pylist(), batch_counts.field("counts").to_numpy(zero_copy_only=False)
+        ):
+            counts[value] = counts.get(value, 0) + int(count)
+    return pd.Series(counts, name="count", dtype=np.int64)
+
+
+class CellTypeCodes:
+    """
+    The cell type of each census cell, as a code indexed by soma_joinid (-1 for cells
+    excluded by the obs filter), and the cell type of each code. Built once per census
+    version and organism (see read_cell_type_codes), and shared by all gene expression
+    reads, which select cells (eg, of a tissue) by soma_joinid.
+    """
+
+    def __init__(self, codes: np.ndarray, cell_types: np.ndarray):
+        self.codes = codes
+        self.cell_types = cell_types
+        self.n_cells = np.bincount(codes[codes >= 0], minlength=len(cell_types))
+
+    def lookup(self, soma_joinids: np.ndarray) -> np.ndarray:
+        """
+        Return the codes of the cells, -1 for excluded cells.
+        """
+        in_range = soma_joinids < len(self.codes)
+        return np.where(in_range, self.codes[np.where(in_range, soma_joinids, 0)], -1)
+
+    def count(self, soma_joinids: np.ndarray) -> np.ndarray:
+        """
+        Return the number of cells of each cell type among the cells, not counting
+        excluded cells.
+        """
+        codes = self.lookup(soma_joinids)
+        return np.bincount(codes[codes >= 0], minlength=len(self.cell_types))
+
+
+@span("census_read")
+def read_cell_type_codes(experiment, obs_value_filter: str = None) -> CellTypeCodes:
+    """
+    Read the cell type of each primary data cell of the experiment, optionally
+    filtered. The obs is streamed, two columns at a time, into an array of small
+    integer codes, so the cells are never materialized in pandas.
+    """
+    obs_value_filter = " and ".join(f for f in ["is_primary_data == True", obs_value_filter] if f)
+    cell_type_codes = {}
+    codes = np.full(0, -1, dtype=np.int32)
+    for batch in read_batches(
+        experiment.obs, obs_value_filter, column_names=["soma_joinid", "cell_type_ontology_term_id"]
+    ):
+        if batch.num_rows == 0:
+            continue
+        encoded = pc.dictionary_encode(batch.column("cell_type_ontology_term_id")).combine_chunks()
+        batch_cell_types = encoded.dictionary.to_pylist()
+        batch_codes = np.array(
+            [cell_type_codes.setdefault(cell_type, len(cell_type_codes)) for cell_type in batch_cell_types],
+            dtype=np.int32,
+        )
+        joinids = batch.column("soma_joinid").to_numpy()
+        max_joinid = joinids.max()
+        if max_joinid >= len(codes):
+            # grow geometrically, so that the obs is copied O(log n) times
+            grown = np.full(max(2 * len(codes), max_joinid + 1), -1, dtype=np.int32)
+            grown[: len(codes)] = codes
+            codes = grown
+        codes[joinids] = batch_codes[encoded.indices.to_numpy()]
+
+    return CellTypeCodes(codes, np.asarray(list(cell_type_codes), dtype=object))
+
+
+@span("census_read")
+def read_soma_joinids(soma_df, value_filter: str = None) -> np.ndarray:
+    """
+    Read the sorted soma_joinids of the rows of a SOMA dataframe matching the filter.
+    """
+    batches = [batch.column("soma_joinid").to_numpy() for batch in read_batches(soma_df, value_filter, ["soma_joinid"])]
+    return np.sort(np.concatenate(batches)) if batches else np.zeros(0, dtype=np.int64)
+
+
+@span("census_read")
+def read_gene_expression_summary(
+    experiment, gene_ids: list, cell_type_codes: CellTypeCodes, soma_joinids: np.ndarray = None
+) -> pd.DataFrame:
+    """
+    Summarize the expression of each gene in each cell type, from the census X matrix.
+
+    Only the requested genes are read from X, and the matrix is consumed as a stream
+    of Arrow tables, accumulating per (cell type, gene) sums as it goes. The cells are
+    mapped to cell types by cell_type_codes, so the obs is not read.
+
+    Parameters
+    ----------
+    experiment : SOMA Experiment
+        Census experiment for one organism, eg, census["census_data"]["homo_sapiens"].
+
+    gene_ids : list
+        Feature (gene) IDs, eg, ["ENSG00000161798"].
+
+    cell_type_codes : CellTypeCodes
+        The cells to summarize, and their cell types, from read_cell_type_codes().
+        Typically only primary data, so cells are not counted more than once.
+
+    soma_joinids : numpy array, optional
+        Sorted soma_joinids of the cells to summarize (eg, of a tissue, see
+        read_soma_joinids), of which only those in cell_type_codes are included. By
+        default, all of the cells in cell_type_codes.
+
+    Returns
+    -------
+    summary : pandas DataFrame
+        Tidy dataframe with one row per (cell type with cells, gene), with columns:
+        cell_type_ontology_term_id, feature_id, n_cells (number of cells of the type),
+        nnz (number of cells of the type expressing the gene) and sum (sum of log1p
+        raw counts).
+    """
+    rna = experiment.ms["RNA"]
+    var = read_pandas(rna.var, f"feature_id in {list(gene_ids)!r}", column_names=["soma_joinid", "feature_id"])
+    var = var.sort_values("soma_joinid")
+    var_joinids = var["soma_joinid"].to_numpy(dtype=np.int64)
+    n_cell_types, n_genes = len(cell_type_codes.cell_types), len(var)
+    if soma_joinids is None:
+        obs_coords, n_cells = slice(None), cell_type_codes.n_cells
+    else:
+        obs_coords, n_cells = soma_joinids, cell_type_codes.count(soma_joinids)
+
+    sums = np.zeros(n_cell_types * n_genes, dtype=np.float64)
+    nnz = np.zeros(n_cell_types * n_genes, dtype=np.int64)
+    if n_genes > 0 and (soma_joinids is None or len(soma_joinids) > 0):
+        for table in rna.X["raw"].read(coords=(obs_coords, var_joinids)).tables():
+            cell_type_positions = cell_type_codes.lookup(table["soma_dim_0"].to_numpy())
+            included = cell_type_positions >= 0
+            gene_positions = np.searchsorted(var_joinids, table["soma_dim_1"].to_numpy()[included])
+            positions = cell_type_positions[included] * n_genes + gene_positions
+            values = np.log1p(table["soma_data"].to_numpy()[included])
+            sums += np.bincount(positions, weights=values, minlength=len(sums))
+            nnz += np.bincount(positions, minlength=len(nnz))
+
+    summary = pd.DataFrame(
+        {
+            "cell_type_ontology_term_id": np.repeat(cell_type_codes.cell_types, n_genes),
+            "feature_id": np.tile(var["feature_id"].to_numpy(dtype=object), n_cell_types),
+            "n_cells": np.repeat(n_cells, n_genes),
+            "nnz": nnz,
+            "sum": sums,
+        }
+    )
+    # the cell types with no cells among the selected cells
+    return summary[summary["n_cells"] > 0].reset_index(drop=True)
+
+
+def read_summary_cell_counts(census, organism: str = None, category: str = None, column_names: list = None):
+    """
+    Read the census summary cell counts, optionally limited to one organism and/or category.
+    """
+    return read_pandas(
+        census["census_info"]["summary_cell_counts"],
+        value_filter=value_filter(organism=organism, category=category),
+        column_names=column_names,
+    )
+
+
+def get_census_version(census) -> str:
+    """
+    Return a string identifying the census release, used to key cached results.
+    """
+    summary = read_pandas(census["census_info"]["summary"], column_names=["label", "value"])
+    info = dict(zip(summary["label"], summary["value"]))
+    return f"{info.get('census_schema_version')}/{info.get('census_build_date')}"
@@ -0,0 +1,183 @@
+"""
+Precomputed rollup cube of the census summary cell counts.
+
+The cube holds the cell counts of every (organism, category, term), rolled up across
+both descendants and ancestors, for every category whose ontology the server loads
+(see SERVER_ONTOLOGIES). Its terms are those with counts, and their ancestors. It is
+computed in one pass over summary_cell_counts by a background job, and rebuilt when
+the census version changes (which the census pool re-reads every CENSUS_VERSION_TTL
+seconds). The ontology versions are fixed for the life of the process, so a new
+ontology release is picked up on restart. Requests slice it, rather than reading and
+rolling up per request.
+"""
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from ontology import SERVER_ONTOLOGIES, get_ontology_closure
+from rollup import rollup_across_lineage
+from census_access import read_summary_cell_counts
+
+logger = logging.getLogger(__name__)
+
+# census summary categories that can be rolled up, and the ontology containing their terms
+CATEGORY_ONTOLOGIES = {
+    "cell_type": "CL",
+    "tissue": "UBERON",
+    "tissue_general": "UBERON",
+    "disease": "MONDO",
+    "assay": "EFO",
+    "sex": "PATO",
+    "self_reported_ethnicity": "HANCESTRO",
+}
+
+ROLLUP_DIRECTIONS = ["descendants", "ancestors"]
+
+
+def cube_categories() -> list:
+    # only categories whose ontology the server has loaded can be rolled up
+    return [category for category, ontology_name in CATEGORY_ONTOLOGIES.items() if ontology_name in SERVER_ONTOLOGIES]
+
+
+def organism_key(label: str) -> str:
+    # as used to name census experiments, eg, "Homo sapiens" -> "homo_sapiens"
+    return label.lower().replace(" ", "_")
+
+
+class RollupCube:
+    """
+    The rolled up cell counts, sorted by (organism, category), with the row range of
+    each (organism, category) slice indexed.
+    """
+
+    def __init__(self, df: pd.DataFrame, version: tuple):
+        """
+        version identifies the census and ontology versions the cube was computed from.
+        """
+        self.version = version
+        self.df = df.sort_values(["organism", "category"], kind="stable", ignore_index=True)
+        sizes = self.df.groupby(["organism", "category"], sort=False).size()
+        self._slices = {
+            key: (int(stop - size), int(stop)) for key, size, stop in zip(sizes.index, sizes, sizes.cumsum())
+        }
+
+    def __contains__(self, organism_category: tuple) -> bool:
+        return organism_category in self._slices
+
+    def slice(self, organism: str, category: str, direction: str) -> pd.DataFrame:
+        """
+        Return the ontology_term_id, unique_cell_count and unique_cell_count_with_{direction}
+        of the organism and category.
+        """
+        start, stop = self._slices[(organism, category)]
+        columns = ["ontology_term_id", "unique_cell_count", f"unique_cell_count_with_{direction}"]
+        return self.df.iloc[start:stop][columns].reset_index(drop=True)
+
+
+def compute_rollup_cube(census, version) -> RollupCube:
+    """
+    Compute the cube from a single read of the census summary cell counts.
+    """
+    categories = cube_categories()
+    counts = read_summary_cell_counts(
+        census, column_names=["organism", "category", "ontology_term_id", "unique_cell_count"]
+    )
+    counts = counts[counts["category"].isin(categories)]
+    counts = counts.assign(organism=counts["organism"].map(organism_key))
+
+    slices = []
+    for category in categories:
+        ontology_name = CATEGORY_ONTOLOGIES[category]
+        category_counts = counts[counts["category"] == category].drop(columns="category")
+
+        # add the ancestors of each organism's terms, which it has no counts for, so that there is something to roll up
+        # into. Only the ancestors in the ontology itself, not those imported from other ontologies.
+        closure = get_ontology_closure(ontology_name)
+        missing = []
+        for organism, terms in category_counts.groupby("organism")["ontology_term_id"]:
+            terms = set(terms)
+            ancestors = set(a for term in terms for a in closure.relatives(term, descendants=False))
+            missing.extend((organism, a) for a in sorted(ancestors - terms) if a.startswith(f"{ontology_name}:"))
+        missing = pd.DataFrame(missing, columns=["organism", "ontology_term_id"])
+        category_counts = pd.concat(
+            [category_counts, missing.assign(unique_cell_count=np.zeros(len(missing), dtype=np.int64))],
+            ignore_index=True,
+        )
+
+        # organism is the other dimension, so terms are only rolled up within each organism. Only the input counts
+        # are rolled up, not the rolled up counts of the previous direction.
+        rollup_columns = ["organism", "ontology_term_id", "unique_cell_count"]
+        for direction in ROLLUP_DIRECTIONS:
+            rollup_df = rollup_across_lineage(
+                category_counts[rollup_columns], ontology_name=ontology_name, descendants=(direction == "descendants")
+            )
+            category_counts[f"unique_cell_count_with_{direction}"] = rollup_df["unique_cell_count"]
+        slices.append(category_counts.assign(category=category))
+
+    return RollupCube(pd.concat(slices, ignore_index=True), version)
+
+
+class RollupCubeJob:
+    """
+    Computes the cube in a background thread, and recomputes it when the data version
+    changes. Requests made before the first cube is ready wait for it; thereafter the
+    previous cube is served while a new one is computed.
+    """
+
+    def __init__(self, compute_fn, version_fn):
+        """
+        compute_fn(version) computes a RollupCube. version_fn() returns the current
+        data version.
+        """
+        self._compute_fn = compute_fn
+        self._version_fn = version_fn
+        self._lock = threading.Lock()
+        self._cube = None
+        self._building = None
+        self._error = None
+
+    def start(self) -> threading.Event:
+        """
+        Start computing the cube for the current data version, unless it is already
+        computed or being computed. Return an event which is set when it is done.
+        """
+        version = self._version_fn()
+        with self._lock:
+            if self._building is not None:
+                return self._building[1]
+            done = threading.Event()
+            if self._cube is not None and self._cube.version == version:
+                done.set()
+                return done
+            self._building = (version, done)
+        threading.Thread(target=self._build, args=(version, done), name="rollup-cube", daemon=True).start()
+        return done
+
+    def get(self, timeout: float = None) -> RollupCube:
+        """
+        Return the current cube, waiting up to timeout seconds for the first one to be
+        computed. Raise TimeoutError if it isn't ready, or the error which failed it.
+        """
+        done = self.start()
+        if self._cube is None and not done.wait(timeout):
+            raise TimeoutError("The rollup cube is not ready")
+        if self._cube is None:
+            raise self._error
+        return self._cube
+
+    def _build(self, version, done: threading.Event):
+        try:
+            cube = self._compute_fn(version)
+            with self._lock:
+                self._cube = cube
+                self._error = None
+        except Exception as e:
+            logger.exception("Failed to compute the rollup cube")
+            with self._lock:
+                self._error = e
+        finally:
+            with self._lock:
+                self._building = None
+            done.set()
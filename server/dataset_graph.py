@@ -0,0 +1,212 @@
+"""
+The dataset graph (see scripts/create_dataset_graph), loaded once into an indexed,
+in-memory structure.
+
+The graph is the same dataset_graph.json the frontend loads, read from
+DATASET_GRAPH_URI (a local path, or an http(s) URL).
+"""
+import os
+import re
+import json
+import bisect
+import hashlib
+import threading
+from collections import Counter, defaultdict, deque
+
+import requests
+
+DATASET_GRAPH_URI = os.environ.get(
+    "DATASET_GRAPH_URI",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "dataset_graph.json"),
+)
+
+
+class DatasetGraph:
+    """
+    The terms of all ontologies in the dataset graph, indexed by term ID, with
+    parent and child links.
+    """
+
+    def __init__(self, graph: dict, version: str):
+        """
+        version identifies the graph content, eg, a hash of the JSON.
+        """
+        self.version = version
+        self.created_on = graph.get("created_on")
+        # the heaviest roots of each ontology, if create-graph recorded them
+        self.layout_roots = graph.get("layout_roots", {})
+        self.terms = {}
+        self.ontology_of = {}
+        self.children = defaultdict(list)
+        for ontology_name, terms in graph["ontologies"].items():
+            for term_id, term in terms.items():
+                self.terms[term_id] = term
+                self.ontology_of[term_id] = ontology_name
+        for term_id, term in self.terms.items():
+            for parent_id in self.parents(term_id):
+                self.children[parent_id].append(term_id)
+        self.search_index = TermSearchIndex(self)
+
+    def __contains__(self, term_id: str) -> bool:
+        return term_id in self.terms
+
+    def parents(self, term_id: str) -> list:
+        # parents outside of the graph (eg, filtered by create-graph) are ignored
+        return [p for p in self.terms[term_id].get("parents", []) if p in self.terms]
+
+    def descendants(self, term_id: str, max_depth: int = None) -> dict:
+        """
+        Return {term ID: depth} of the term and its descendants, where depth is the
+        shortest distance from the term, optionally limited to max_depth.
+        """
+        return self._walk(term_id, lambda t: self.children.get(t, []), max_depth)
+
+    def ancestors(self, term_id: str, max_depth: int = None) -> dict:
+        """
+        Return {term ID: depth} of the term and its ancestors, as for descendants().
+        """
+        return self._walk(term_id, self.parents, max_depth)
+
+    def neighborhood(self, term_id: str, depth: int) -> set:
+        """
+        Return the term, and its ancestors and descendants up to depth links away.
+        """
+        return set(self.ancestors(term_id, depth)) | set(self.descendants(term_id, depth))
+
+    def heaviest_roots(self, n_roots: int = 10) -> dict:
+        """
+        Return { ontology name: [term ID] } of the terms with the most descendants in each
+        ontology, as create-graph records in layout_roots, for graphs which predate it.
+        """
+        n_descendants = defaultdict(dict)
+        for term_id, ontology_name in self.ontology_of.items():
+            n_descendants[ontology_name][term_id] = len(self.descendants(term_id)) - 1
+        return {
+            ontology_name: [t for t in sorted(counts, key=counts.get, reverse=True)[:n_roots] if counts[t] > 0]
+            for ontology_name, counts in n_descendants.items()
+        }
+
+    def _walk(self, term_id: str, neighbors, max_depth: int) -> dict:
+        depths = {term_id: 0}
+        queue = deque([term_id])
+        while queue:
+            t = queue.popleft()
+            if max_depth is not None and depths[t] >= max_depth:
+                continue
+            for n in neighbors(t):
+                if n not in depths:
+                    depths[n] = depths[t] + 1
+                    queue.append(n)
+        return depths
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.split(r"[^0-9a-z]+", text.lower())).strip()
+
+
+def _ngrams(text: str, n: int = 3) -> Counter:
+    padded = f" {text} "
+    return Counter(padded[i : i + n] for i in range(len(padded) - n + 1))
+
+
+class TermSearchIndex:
+    """
+    Prefix and fuzzy search over term labels and synonyms.
+
+    Prefix matches (at the start of any word of a name) are found by bisecting a
+    sorted list of the name suffixes starting at each word. Fuzzy matches are found
+    via an inverted index of character trigrams, and ranked by trigram similarity.
+    """
+
+    # minimum trigram similarity (Jaccard) of a fuzzy match
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self, graph: DatasetGraph):
+        self._ontology_of = graph.ontology_of
+        # names are (term ID, name), where name is the label or a synonym
+        self.names = []
+        for term_id, term in graph.terms.items():
+            for name in [term.get("label")] + term.get("synonyms", []):
+                if name:
+                    self.names.append((term_id, name))
+
+        self._suffixes = []
+        self._trigrams = defaultdict(list)
+        self._trigram_counts = []
+        for i, (_, name) in enumerate(self.names):
+            normalized = _normalize(name)
+            words = normalized.split(" ")
+            for w in range(len(words)):
+                # whole name matches rank above matches of a later word
+                self._suffixes.append((" ".join(words[w:]), w > 0, i))
+            trigrams = _ngrams(normalized)
+            self._trigram_counts.append(sum(trigrams.values()))
+            for trigram, count in trigrams.items():
+                self._trigrams[trigram].append((i, count))
+        self._suffixes.sort()
+
+    def search(self, query: str, limit: int = 20, ontology_name: str = None) -> list:
+        """
+        Return up to limit matches, as [(term ID, matching name)], ordered by prefix
+        matches of the whole name, prefix matches of a later word, then fuzzy matches
+        by similarity. If ontology_name is given, only terms of that ontology are returned.
+        """
+        normalized = _normalize(query)
+        if not normalized:
+            return []
+
+        # (rank, tie-breaker, name index)
+        ranked = []
+        start = bisect.bisect_left(self._suffixes, (normalized,))
+        for suffix, later_word, i in self._suffixes[start:]:
+            if not suffix.startswith(normalized):
+                break
+            ranked.append((int(later_word), len(self.names[i][1]), i))
+
+        query_trigrams = _ngrams(normalized)
+        query_count = sum(query_trigrams.values())
+        shared = Counter()
+        for trigram, count in query_trigrams.items():
+            for i, name_count in self._trigrams.get(trigram, []):
+                shared[i] += min(count, name_count)
+        for i, n_shared in shared.items():
+            similarity = n_shared / (query_count + self._trigram_counts[i] - n_shared)
+            if similarity >= self.MIN_SIMILARITY:
+                ranked.append((2, -similarity, i))
+
+        results = []
+        seen = set()
+        for _, _, i in sorted(ranked):
+            term_id, name = self.names[i]
+            if term_id in seen or (ontology_name and self._ontology_of[term_id] != ontology_name):
+                continue
+            seen.add(term_id)
+            results.append((term_id, name))
+            if len(results) >= limit:
+                break
+        return results
+
+
+def load_dataset_graph(uri: str = DATASET_GRAPH_URI) -> DatasetGraph:
+    if uri.startswith(("http://", "https://")):
+        response = requests.get(uri, timeout=60)
+        response.raise_for_status()
+        content = response.content
+    else:
+        with open(uri, "rb") as f:
+            content = f.read()
+    return DatasetGraph(json.loads(content), hashlib.sha256(content).hexdigest()[:16])
+
+
+# loaded on first use
+_dataset_graph = None
+_lock = threading.Lock()
+
+
+def get_dataset_graph() -> DatasetGraph:
+    global _dataset_graph
+    if _dataset_graph is None:
+        with _lock:
+            if _dataset_graph is None:
+                _dataset_graph = load_dataset_graph()
+    return _dataset_graph
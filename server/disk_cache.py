@@ -0,0 +1,212 @@
+"""
+Persistent, size-bounded cache of computed results, shared by all server processes.
+
+Entries are pickled into a SQLite database (in WAL mode, so readers don't block the
+writer), which survives restarts and deploys, so that a fresh server process serves
+warm responses immediately. Keys must include the versions of all data an entry was
+computed from (eg, the census and ontology versions), as entries are never invalidated,
+only evicted in least recently used order once the total size exceeds max_bytes. The
+total size is maintained by triggers, so a write doesn't scan the cache, and eviction
+frees down to EVICT_TO_FRACTION of max_bytes, so it only runs once in a while. Reads
+queue the access time updates, which are written in batches (see TOUCH_BATCH_SIZE),
+so that readers don't contend for the write lock.
+
+Writes are transactional, so concurrent workers never see partial entries. The cache
+is best-effort: errors are logged, and treated as a miss.
+"""
+import os
+import json
+import time
+import pickle
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+DISK_CACHE_PATH = os.environ.get(
+    "DISK_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "disk_cache", "cache.sqlite")
+)
+DISK_CACHE_MAX_BYTES = int(os.environ.get("DISK_CACHE_MAX_BYTES", 2**30))
+
+# entries' access times are only updated if older than this (seconds), to limit writes on reads
+ACCESS_TIME_RESOLUTION = 60
+# reads don't write the access times themselves, but queue them, to be written in one transaction once this many are
+# queued, once ACCESS_TIME_RESOLUTION has passed since the last write, or with the next put
+TOUCH_BATCH_SIZE = 256
+# eviction frees down to this fraction of max_bytes, so that it isn't needed on every write
+EVICT_TO_FRACTION = 0.9
+# entries are evicted in batches of this many, least recently used first
+EVICT_BATCH_SIZE = 64
+
+# in a transaction, so that concurrently opened connections don't race to initialize the total size
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+
+-- the total size of the entries, in a single row
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total_size INTEGER NOT NULL
+);
+INSERT INTO stats (id, total_size)
+    SELECT 0, (SELECT COALESCE(SUM(size), 0) FROM entries) WHERE NOT EXISTS (SELECT 1 FROM stats);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE stats SET total_size = total_size + new.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE stats SET total_size = total_size - old.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE stats SET total_size = total_size + new.size - old.size WHERE id = 0;
+END;
+COMMIT;
+"""
+
+
+class DiskCache:
+    """
+    A SQLite-backed LRU cache of picklable values.
+    """
+
+    def __init__(self, path: str = DISK_CACHE_PATH, max_bytes: int = DISK_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # connections can't be shared across threads or forked processes
+        self._local = threading.local()
+        # {key: access time} of entries read, but not yet written (see _touch)
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+        self._touched_written_at = time.time()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(_SCHEMA)
+            except BaseException:
+                # don't leave the schema transaction holding the write lock
+                conn.close()
+                raise
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(namespace: str, key) -> str:
+        # keys are tuples of strings, numbers, booleans and None (or nested tuples thereof)
+        return json.dumps([namespace, key], separators=(",", ":"), default=str)
+
+    def get(self, key: str):
+        """
+        Return the value for key, or None.
+        """
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT value, accessed FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, accessed = row
+            now = time.time()
+            if now - accessed > ACCESS_TIME_RESOLUTION:
+                self._touch(key, now)
+            return pickle.loads(value)
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning(f"Disk cache read failed: {e}")
+            return None
+
+    def put(self, key: str, value):
+        """
+        Store the value for key, evicting least recently used entries if the cache is
+        over its size bound.
+        """
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(data) > self.max_bytes:
+                return
+            conn = self._connection()
+            touched = self._take_touched(force=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_access_times(conn, touched)
+                # an upsert rather than INSERT OR REPLACE, as the replaced row's delete would not fire the trigger
+                conn.execute(
+                    "INSERT INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE"
+                    " SET value = excluded.value, size = excluded.size, accessed = excluded.accessed",
+                    (key, data, len(data), time.time()),
+                )
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except (sqlite3.Error, pickle.PicklingError, TypeError) as e:
+            logger.warning(f"Disk cache write failed: {e}")
+
+    def _touch(self, key: str, now: float):
+        # queue the access time update, and write the queue if it is due, so that reads rarely take the write lock
+        with self._touched_lock:
+            self._touched[key] = now
+        touched = self._take_touched()
+        if not touched:
+            return
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_access_times(conn, touched)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # the entries were still read, so this isn't a miss
+            logger.warning(f"Disk cache access time update failed: {e}")
+
+    def _take_touched(self, force: bool = False) -> dict:
+        # return and clear the queued access times, if they are due to be written
+        with self._touched_lock:
+            now = time.time()
+            due = len(self._touched) >= TOUCH_BATCH_SIZE or now - self._touched_written_at > ACCESS_TIME_RESOLUTION
+            if not self._touched or not (force or due):
+                return {}
+            touched, self._touched = self._touched, {}
+            self._touched_written_at = now
+            return touched
+
+    @staticmethod
+    def _write_access_times(conn: sqlite3.Connection, touched: dict):
+        conn.executemany(
+            "UPDATE entries SET accessed = MAX(accessed, ?) WHERE key = ?", [(t, key) for key, t in touched.items()]
+        )
+
+    def _evict(self, conn: sqlite3.Connection):
+        (total,) = conn.execute("SELECT total_size FROM stats WHERE id = 0").fetchone()
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * EVICT_TO_FRACTION)
+        while total > target:
+            rows = conn.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT ?", (EVICT_BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= target:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+
+
+# shared by all caches in the process
+disk_cache = DiskCache()
@@ -0,0 +1,99 @@
+"""
+PCA followed by UMAP embedding of term (eg, cell type) gene expression profiles.
+
+Fitting is CPU bound, so it runs in a process pool rather than in the request
+thread. The fitted models are returned with the embedding, so that new terms can
+later be projected into it without refitting.
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 2))
+
+DEFAULT_PARAMS = {
+    "n_pca_components": 50,
+    "n_neighbors": 15,
+    "min_dist": 0.1,
+}
+
+# (type, min, max) of each parameter
+PARAM_RANGES = {
+    "n_pca_components": (int, 1, 500),
+    "n_neighbors": (int, 2, 200),
+    "min_dist": (float, 0.0, 1.0),
+}
+
+# the minimum number of (non-zero) profiles required to fit an embedding
+MIN_PROFILES = 3
+
+
+def validate_params(params: dict) -> dict:
+    """
+    Return the embedding parameters, the defaults overridden by those given (unknown
+    parameters are ignored). Raise ValueError for values of the wrong type, or out of
+    range.
+    """
+    validated = dict(DEFAULT_PARAMS)
+    for name, (param_type, min_value, max_value) in PARAM_RANGES.items():
+        if name not in params:
+            continue
+        value = params[name]
+        # bool is an int, but is never a sensible parameter value
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if not is_number or (param_type is int and not isinstance(value, int)):
+            raise ValueError(f"{name} must be {'an integer' if param_type is int else 'a number'}")
+        if not min_value <= value <= max_value:
+            raise ValueError(f"{name} must be between {min_value} and {max_value}")
+        validated[name] = param_type(value)
+    return validated
+
+
+def fit_embedding(vectors: np.ndarray, params: dict):
+    """
+    Fit PCA then UMAP to the row vectors, returning (coordinates, models).
+    """
+    from sklearn.decomposition import PCA
+    from umap import UMAP
+
+    n_samples, n_features = vectors.shape
+    pca = PCA(n_components=min(params["n_pca_components"], n_samples, n_features), random_state=0)
+    reduced = pca.fit_transform(vectors)
+    umap = UMAP(
+        n_components=2,
+        n_neighbors=min(params["n_neighbors"], n_samples - 1),
+        min_dist=params["min_dist"],
+        random_state=0,
+    )
+    coords = umap.fit_transform(reduced)
+    return coords, (pca, umap)
+
+
+def transform_embedding(models, vectors: np.ndarray) -> np.ndarray:
+    """
+    Project new row vectors into a previously fitted embedding.
+    """
+    pca, umap = models
+    return umap.transform(pca.transform(vectors))
+
+
+# created on first use, in each server process
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def run_in_pool(fn, *args):
+    """
+    Run fn(*args) in the embedding process pool, and return the result.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, as forking a multi-threaded server process is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=EMBEDDING_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _executor.submit(fn, *args).result()
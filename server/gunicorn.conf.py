@@ -0,0 +1,51 @@
+# gunicorn configuration, see https://docs.gunicorn.org/en/stable/settings.html
+import os
+import sys
+import multiprocessing
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+timeout = 120
+
+# SERVER_MODE=asgi serves asgi.py with an event loop per worker, otherwise app.py
+# is served with a thread pool per worker.
+if os.environ.get("SERVER_MODE", "wsgi") == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Don't load the app in the master process. Each worker opens its own census handles, and
+# memory-maps the ontology closures saved in the ontology cache, so the closure pages are
+# shared by all workers via the OS page cache.
+preload_app = False
+
+# The app doesn't start its warmup on import, but once the worker is initialized (see post_worker_init), so that
+# numba's thread pool is started by the worker's main thread.
+raw_env = ["SERVER_WARMUP_ON_IMPORT=0"]
+
+
+# With PROMETHEUS_MULTIPROC_DIR set, the workers' metrics are aggregated by /api/metrics,
+# see metrics.py. The directory is cleared on startup, and dead workers' gauges removed.
+def on_starting(server):
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def post_worker_init(worker):
+    # in the worker's main thread, once it has loaded the app (app.py is imported by both app:app and asgi:app)
+    app = sys.modules.get("app")
+    if app is not None and app.SERVER_WARMUP:
+        app.start_warmup()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
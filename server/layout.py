@@ -0,0 +1,189 @@
+"""
+Layered (Sugiyama-style) and force-directed layouts of dataset graph subgraphs.
+
+A layout is computed for the subgraph rooted at a term, after applying the same
+filters as the frontend DAG explorer, and is cached on disk keyed by (graph
+version, root, layout, filters). The heaviest roots recorded by create-graph can
+be precomputed with:
+
+    python layout.py precompute
+"""
+import os
+import sys
+import json
+import hashlib
+from collections import defaultdict
+
+import networkx as nx
+
+from util import atomic_write
+from dataset_graph import DatasetGraph, get_dataset_graph
+
+LAYOUT_CACHE_DIR = os.environ.get(
+    "LAYOUT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "layout_cache")
+)
+
+LAYOUTS = ["sugiyama", "force"]
+
+DEFAULT_FILTERS = {
+    "min_outdegree": 0,
+    "max_outdegree": None,
+    "max_depth": None,
+}
+
+# barycenter sweeps (each down then up) used to reduce edge crossings
+ORDERING_SWEEPS = 4
+
+
+def filtered_subgraph(graph: DatasetGraph, root: str, filters: dict) -> nx.DiGraph:
+    """
+    Return the subgraph of the root and its descendants, without the terms (and their
+    descendants) which are deeper than max_depth, or whose number of children is
+    outside [min_outdegree, max_outdegree]. The root itself is never removed.
+    """
+    depths = graph.descendants(root, filters["max_depth"])
+    g = nx.DiGraph()
+    g.add_nodes_from(depths)
+    g.add_edges_from((parent, child) for child in depths for parent in graph.parents(child) if parent in depths)
+
+    min_outdegree, max_outdegree = filters["min_outdegree"], filters["max_outdegree"]
+    removed = set()
+    for term_id in g.nodes:
+        n_children = g.out_degree(term_id)
+        if term_id != root and (
+            n_children < min_outdegree or (max_outdegree is not None and n_children > max_outdegree)
+        ):
+            removed.add(term_id)
+            removed.update(nx.descendants(g, term_id))
+    g.remove_nodes_from(removed)
+    return g
+
+
+def sugiyama_layout(g: nx.DiGraph) -> dict:
+    """
+    Layered layout: terms are layered by longest path from the root, edges spanning
+    more than one layer are routed through dummy points, and terms are ordered
+    within each layer by barycenter sweeps to reduce crossings. Coordinates are in
+    layer units.
+    """
+    layer = {}
+    for term_id in nx.topological_sort(g):
+        layer[term_id] = max((layer[p] + 1 for p in g.predecessors(term_id)), default=0)
+
+    # split long edges with dummy nodes, so that each edge connects adjacent layers
+    proper = nx.DiGraph()
+    proper.add_nodes_from(g.nodes)
+    chains = {}
+    for source, target in g.edges:
+        chain = [source] + [("dummy", source, target, i) for i in range(layer[source] + 1, layer[target])] + [target]
+        for node in chain[1:-1]:
+            layer[node] = node[3]
+        nx.add_path(proper, chain)
+        chains[(source, target)] = chain
+
+    layers = defaultdict(list)
+    for node in nx.dfs_preorder_nodes(proper):
+        layers[layer[node]].append(node)
+    layers = [layers[i] for i in range(len(layers))]
+
+    def reorder(rank, neighbors, adjacent_rank):
+        position = {node: i for i, node in enumerate(layers[adjacent_rank])}
+
+        def barycenter(item):
+            i, node = item
+            positions = [position[n] for n in neighbors(node)]
+            return sum(positions) / len(positions) if positions else i
+
+        layers[rank] = [node for _, node in sorted(enumerate(layers[rank]), key=barycenter)]
+
+    for _ in range(ORDERING_SWEEPS):
+        for rank in range(1, len(layers)):
+            reorder(rank, proper.predecessors, rank - 1)
+        for rank in range(len(layers) - 2, -1, -1):
+            reorder(rank, proper.successors, rank + 1)
+
+    coords = {}
+    for rank, nodes in enumerate(layers):
+        for i, node in enumerate(nodes):
+            coords[node] = [i - (len(nodes) - 1) / 2, rank]
+
+    return {
+        "width": max((len(nodes) for nodes in layers), default=0),
+        "height": len(layers),
+        "nodes": {term_id: coords[term_id] for term_id in g.nodes},
+        "edges": [
+            {"source": source, "target": target, "points": [coords[node] for node in chain]}
+            for (source, target), chain in chains.items()
+        ],
+    }
+
+
+def force_layout(g: nx.DiGraph) -> dict:
+    """
+    Force-directed (Fruchterman-Reingold) layout, with coordinates in [-1, 1].
+    """
+    positions = nx.spring_layout(g.to_undirected(as_view=True), seed=0) if len(g) > 0 else {}
+    return {
+        "width": 2,
+        "height": 2,
+        "nodes": {term_id: [float(x), float(y)] for term_id, (x, y) in positions.items()},
+        "edges": [{"source": source, "target": target} for source, target in g.edges],
+    }
+
+
+def compute_layout(graph: DatasetGraph, root: str, layout: str, filters: dict) -> dict:
+    g = filtered_subgraph(graph, root, filters)
+    result = sugiyama_layout(g) if layout == "sugiyama" else force_layout(g)
+    return {"version": graph.version, "root": root, "layout": layout, "filters": filters, **result}
+
+
+def _layout_path(version: str, root: str, layout: str, filters: dict, cache_dir: str) -> str:
+    key = json.dumps([root, layout, filters], sort_keys=True)
+    return os.path.join(cache_dir, version, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+
+def get_layout(graph: DatasetGraph, root: str, layout: str, filters: dict = None, cache_dir=LAYOUT_CACHE_DIR) -> dict:
+    """
+    Return the layout of the subgraph rooted at root, from the disk cache if present,
+    else computing and caching it.
+    """
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+    path = _layout_path(graph.version, root, layout, filters, cache_dir)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    result = compute_layout(graph, root, layout, filters)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, lambda f: f.write(json.dumps(result).encode("utf-8")))
+    return result
+
+
+def precompute_layouts(graph: DatasetGraph, cache_dir=LAYOUT_CACHE_DIR):
+    """
+    Compute and cache the default (unfiltered) layouts of the heaviest roots.
+    """
+    layout_roots = graph.layout_roots or graph.heaviest_roots()
+    for ontology_name, roots in layout_roots.items():
+        for root in roots:
+            if root not in graph:
+                continue
+            for layout in LAYOUTS:
+                get_layout(graph, root, layout, cache_dir=cache_dir)
+            print(f"{ontology_name}: {root}")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "precompute":
+        precompute_layouts(get_dataset_graph())
+    else:
+        print("Usage: python layout.py precompute")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Prometheus metrics for the server, exposed at /api/metrics.
+
+- per-route request latency histograms, and in-flight request gauges
+- sub-span timers (eg, census reads, ontology closure builds, rollups, serialization
+  and upstream fetches), via span()
+- cache hit/miss counters
+- process resident memory, sampled after each request
+
+Under gunicorn, each worker is a separate process. Set PROMETHEUS_MULTIPROC_DIR (to an
+empty directory) to aggregate the metrics of all workers, see gunicorn.conf.py.
+"""
+import os
+import time
+import resource
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "server_request_duration_seconds",
+    "Request latency, by route",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "server_requests_in_flight", "Requests being served, by route", ["route"], multiprocess_mode="livesum"
+)
+SPAN_DURATION = Histogram(
+    "server_span_duration_seconds", "Duration of request sub-spans, by span", ["span"], buckets=LATENCY_BUCKETS
+)
+CACHE_LOOKUPS = Counter(
+    "server_cache_lookups_total", "Cache lookups, by cache and result (hit, disk_hit or miss)", ["cache", "result"]
+)
+RESIDENT_MEMORY = Gauge(
+    "server_process_resident_memory_bytes", "Resident memory of each server process", multiprocess_mode="liveall"
+)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time the enclosed block as the named sub-span. May also be used as a (non-async)
+    function decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_DURATION.labels(name).observe(time.perf_counter() - start)
+
+
+def observe_request(route: str, method: str, status: int, seconds: float):
+    REQUEST_LATENCY.labels(route, method, str(status)).observe(seconds)
+    # sampled by every worker after each request, as in multiprocess mode each worker reports its own value
+    RESIDENT_MEMORY.set(_resident_memory())
+
+
+def _resident_memory() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # not Linux, so fall back to the peak (in KiB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def instrument_flask(app):
+    """
+    Record the latency and in-flight count of each Flask request, by route (URL rule).
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_request():
+        g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_start = time.perf_counter()
+        g.metrics_status = 500
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+    @app.after_request
+    def _record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _end_request(exc):
+        if "metrics_start" not in g:
+            return
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).dec()
+        observe_request(g.metrics_route, request.method, g.metrics_status, time.perf_counter() - g.metrics_start)
+
+
+def instrument_endpoint(route: str, endpoint):
+    """
+    Wrap an async (Starlette) endpoint to record its latency and in-flight count, as
+    instrument_flask does for the Flask routes.
+    """
+
+    async def instrumented(request):
+        REQUESTS_IN_FLIGHT.labels(route).inc()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+            return response
+        finally:
+            REQUESTS_IN_FLIGHT.labels(route).dec()
+            observe_request(route, request.method, status, time.perf_counter() - start)
+
+    return instrumented
+
+
+def metrics_text():
+    """
+    Return (body, content type) of the metrics, in the Prometheus text format.
+    """
+    RESIDENT_MEMORY.set(_resident_memory())
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,418 @@
+"""
+Offline, versioned on-disk cache of the ontologies used by the server.
+
+Loading an OWL file with owlready2 requires downloading and parsing the entire
+file, which dominates server startup and fails when GitHub is unreachable. The
+rollup only needs the class hierarchy, so we extract the term IDs and their
+direct (is_a) parents once, and save them in a compact .npz file keyed by the
+ontology version IRI. Startup loads the current cached version with no network
+access.
+
+Cache layout:
+
+    $ONTOLOGY_CACHE_DIR/
+        CL/                     # one directory per ontology, eg, CL, UBERON
+            index.json          # {"current": <version IRI>, "versions": {<version IRI>: <file name>}}
+            <hash>.npz          # term_ids, parent_indptr, parent_indices
+            <hash>.closure/     # transitive closure CSR arrays, memory-mapped by all server processes
+
+To pick up a new release (eg, at image build time):
+
+    $ python ontology.py refresh
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import gzip
+import uuid
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+
+import numpy as np
+import requests
+from scipy import sparse
+
+from util import atomic_write
+from metrics import span
+
+CL_BASIC_PERMANENT_URL_OWL = "https://github.com/obophenotype/cell-ontology/releases/latest/download/cl-basic.owl"
+
+# cellxgene schema ontology configuration, used to locate any ontology without an explicit source
+OWL_INFO_URI = (
+    "https://raw.githubusercontent.com/chanzuckerberg/single-cell-curation/main"
+    "/cellxgene_schema_cli/cellxgene_schema/ontology_files/owl_info.yml"
+)
+
+# ontologies with an explicit source, by name
+ONTOLOGY_SOURCES = {
+    "CL": CL_BASIC_PERMANENT_URL_OWL,
+}
+
+# ontologies loaded by the server, and refreshed by default. The other census categories' ontologies (MONDO, EFO, PATO
+# and HANCESTRO, see cube.py) are large or rarely used, so are opt-in, eg, SERVER_ONTOLOGIES=CL,UBERON,MONDO
+SERVER_ONTOLOGIES = os.environ.get("SERVER_ONTOLOGIES", "CL,UBERON").split(",")
+
+ONTOLOGY_CACHE_DIR = os.environ.get(
+    "ONTOLOGY_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ontology_cache")
+)
+
+# The parent links are stored in CSR form: the parents of term_ids[i] are
+# term_ids[parent_indices[parent_indptr[i] : parent_indptr[i + 1]]]
+ParsedOntology = namedtuple("ParsedOntology", ["name", "version", "term_ids", "parent_indptr", "parent_indices"])
+
+
+def parse_owl(name: str, url: str) -> ParsedOntology:
+    """
+    Download and parse an OWL file, returning the class hierarchy.
+    """
+    # owlready2 is only needed to refresh the cache, so don't pay for the import at startup
+    import owlready2
+
+    world = owlready2.World()
+    if url.endswith(".gz"):
+        fname = _download_gz(url)
+        try:
+            onto = world.get_ontology(fname).load()
+        finally:
+            os.unlink(fname)
+    else:
+        onto = world.get_ontology(url).load()
+
+    classes = list(onto.classes())
+    term_ids = [c.name.replace("_", ":") for c in classes]
+    term_index = {term_id: i for i, term_id in enumerate(term_ids)}
+
+    parent_indptr = [0]
+    parent_indices = []
+    for c in classes:
+        parents = [p.name.replace("_", ":") for p in c.is_a if isinstance(p, owlready2.ThingClass)]
+        parent_indices.extend(term_index[p] for p in parents if p in term_index)
+        parent_indptr.append(len(parent_indices))
+
+    term_ids = np.array(term_ids, dtype=str)
+    parent_indptr = np.array(parent_indptr, dtype=np.int32)
+    parent_indices = np.array(parent_indices, dtype=np.int32)
+    version = _version_iri(onto) or _content_version(url, term_ids, parent_indices)
+    return ParsedOntology(name, version, term_ids, parent_indptr, parent_indices)
+
+
+def ontology_source(name: str) -> str:
+    """
+    Return the OWL URL for the named ontology, falling back to the latest release
+    listed in the cellxgene schema owl_info.yml.
+    """
+    if name in ONTOLOGY_SOURCES:
+        return ONTOLOGY_SOURCES[name]
+
+    import yaml
+
+    response = requests.get(OWL_INFO_URI, timeout=60)
+    response.raise_for_status()
+    owl_info = yaml.safe_load(response.content)
+    if name not in owl_info:
+        raise KeyError(f"Unknown ontology {name}")
+    return owl_info[name]["urls"][owl_info[name]["latest"]]
+
+
+def _download_gz(url: str) -> str:
+    # owlready2 can't load compressed OWL, so decompress to a temp file. Caller must delete it.
+    with requests.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with tempfile.NamedTemporaryFile(mode="wb", suffix=".owl", delete=False) as f:
+            shutil.copyfileobj(gzip.GzipFile(fileobj=r.raw), f, 512 * 1024)
+            return f.name
+
+
+def _version_iri(onto) -> str:
+    for attr in ("versionIRI", "versionInfo"):
+        values = getattr(onto.metadata, attr, None)
+        if values:
+            return str(values[0])
+    return None
+
+
+def _content_version(url: str, term_ids: np.ndarray, parent_indices: np.ndarray) -> str:
+    # fallback for OWL files without a version IRI
+    digest = hashlib.sha256(term_ids.tobytes() + parent_indices.tobytes()).hexdigest()[:16]
+    return f"{url}#sha256-{digest}"
+
+
+def _ontology_dir(name: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, name)
+
+
+def _version_stem(version: str) -> str:
+    return hashlib.sha256(version.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_cache_index(name: str, cache_dir: str) -> dict:
+    try:
+        with open(os.path.join(_ontology_dir(name, cache_dir), "index.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"current": None, "versions": {}}
+
+
+def save_ontology(ontology: ParsedOntology, cache_dir: str = ONTOLOGY_CACHE_DIR, make_current: bool = True):
+    """
+    Save the parsed ontology in the cache, and optionally make it the current version.
+    """
+    ontology_dir = _ontology_dir(ontology.name, cache_dir)
+    os.makedirs(ontology_dir, exist_ok=True)
+
+    fname = _version_stem(ontology.version) + ".npz"
+    atomic_write(
+        os.path.join(ontology_dir, fname),
+        lambda f: np.savez(
+            f,
+            version=np.array(ontology.version),
+            term_ids=ontology.term_ids,
+            parent_indptr=ontology.parent_indptr,
+            parent_indices=ontology.parent_indices,
+        ),
+    )
+
+    index = _read_cache_index(ontology.name, cache_dir)
+    index["versions"][ontology.version] = fname
+    if make_current:
+        index["current"] = ontology.version
+    atomic_write(os.path.join(ontology_dir, "index.json"), lambda f: f.write(json.dumps(index, indent=2).encode()))
+
+
+def load_cached_ontology(name: str, version: str = None, cache_dir: str = ONTOLOGY_CACHE_DIR) -> ParsedOntology:
+    """
+    Load an ontology from the cache. If version is not specified, load the current
+    version. Return None if it is not cached.
+    """
+    index = _read_cache_index(name, cache_dir)
+    version = version or index["current"]
+    fname = index["versions"].get(version)
+    if fname is None:
+        return None
+
+    with np.load(os.path.join(_ontology_dir(name, cache_dir), fname)) as npz:
+        return ParsedOntology(
+            name,
+            str(npz["version"]),
+            npz["term_ids"],
+            npz["parent_indptr"],
+            npz["parent_indices"],
+        )
+
+
+def refresh_ontology(name: str, cache_dir: str = ONTOLOGY_CACHE_DIR) -> ParsedOntology:
+    """
+    Download the latest release of the ontology and make it the current cached version.
+    """
+    ontology = parse_owl(name, ontology_source(name))
+    save_ontology(ontology, cache_dir)
+    return ontology
+
+
+def load_ontology(name: str = "CL", version: str = None, cache_dir: str = ONTOLOGY_CACHE_DIR) -> ParsedOntology:
+    """
+    Load the ontology from the cache, populating the cache from the network only
+    if it is empty.
+    """
+    ontology = load_cached_ontology(name, version, cache_dir)
+    if ontology is None:
+        if version is not None:
+            raise KeyError(f"{name} version {version} is not cached")
+        ontology = refresh_ontology(name, cache_dir)
+    return ontology
+
+
+class OntologyClosure:
+    """
+    Transitive closure of an ontology's is_a hierarchy, indexed by dense integer term IDs.
+
+    `descendants[i, j]` is True if term j is term i or one of its descendants, and
+    `ancestors` is its transpose. Both are CSR matrices, so the lineage of term i is
+    the column indices of row i.
+    """
+
+    def __init__(self, ontology: ParsedOntology, descendants: sparse.csr_matrix = None, ancestors=None):
+        self.name = ontology.name
+        self.version = ontology.version
+        self.term_ids = ontology.term_ids
+        self.term_index = {term_id: i for i, term_id in enumerate(ontology.term_ids.tolist())}
+        # the OWL file may contain terms imported from other ontologies, eg, UBERON references CL
+        self.own_term_ids = [term_id for term_id in self.term_index if term_id.startswith(f"{self.name}:")]
+        if descendants is None:
+            descendants = _transitive_closure(ontology)
+        if ancestors is None:
+            ancestors = descendants.T.tocsr()
+            ancestors.sort_indices()
+        self.descendants = descendants
+        self.ancestors = ancestors
+
+    def lineage(self, terms, descendants: bool = True) -> sparse.csr_matrix:
+        """
+        Return the lineage of each term, restricted to the terms in the input list.
+
+        Parameters
+        ----------
+        terms : list
+            List of ontology term IDs.
+
+        descendants : bool, optional, default=True
+            If True, find descendants. If False, find ancestors.
+
+        Returns
+        -------
+        lineage : scipy.sparse.csr_matrix
+            Boolean matrix of shape (len(terms), len(terms)), with sorted indices. Row i
+            contains the positions (in `terms`) of the relatives of terms[i], including
+            itself. Terms unknown to the ontology are only related to themselves.
+        """
+        closure = self.descendants if descendants else self.ancestors
+        n_terms = len(terms)
+        term_indices = np.array([self.term_index.get(term, -1) for term in terms], dtype=np.int64)
+        known = np.flatnonzero(term_indices >= 0)
+        unknown = np.flatnonzero(term_indices < 0)
+
+        subset = closure[term_indices[known]][:, term_indices[known]].tocoo()
+        rows = np.concatenate([known[subset.row], unknown])
+        cols = np.concatenate([known[subset.col], unknown])
+        lineage = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n_terms, n_terms))
+        lineage.sort_indices()
+        return lineage
+
+    def relatives(self, term: str, descendants: bool = True) -> list:
+        """
+        Return the term and all of its descendants (or ancestors) in the ontology.
+        """
+        if term not in self.term_index:
+            return [term]
+        closure = self.descendants if descendants else self.ancestors
+        row = self.term_index[term]
+        return self.term_ids[closure.indices[closure.indptr[row] : closure.indptr[row + 1]]].tolist()
+
+
+def _transitive_closure(ontology: ParsedOntology) -> sparse.csr_matrix:
+    n_terms = len(ontology.term_ids)
+    # adjacency[parent, child], plus the identity so that each term is in its own lineage
+    children = np.repeat(np.arange(n_terms), np.diff(ontology.parent_indptr))
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(children), dtype=np.int32), (ontology.parent_indices, children)), shape=(n_terms, n_terms)
+    )
+    closure = (adjacency + sparse.identity(n_terms, dtype=np.int32, format="csr")).tocsr()
+    closure.data[:] = 1
+
+    # square until we reach a fixed point - log2(depth of the DAG) iterations
+    while True:
+        squared = closure @ closure
+        squared.data[:] = 1
+        if squared.nnz == closure.nnz:
+            break
+        closure = squared
+
+    closure = closure.astype(bool)
+    closure.sort_indices()
+    return closure
+
+
+CLOSURE_ARRAYS = ["descendants_indptr", "descendants_indices", "ancestors_indptr", "ancestors_indices", "data"]
+
+
+def _closure_dir(ontology: ParsedOntology, cache_dir: str) -> str:
+    return os.path.join(_ontology_dir(ontology.name, cache_dir), _version_stem(ontology.version) + ".closure")
+
+
+def save_closure(closure: OntologyClosure, ontology: ParsedOntology, cache_dir: str = ONTOLOGY_CACHE_DIR):
+    """
+    Save the closure CSR arrays as .npy files, so that they can be memory-mapped.
+    """
+    closure_dir = _closure_dir(ontology, cache_dir)
+    # write into a temp directory and rename it, so that other processes never see a partial closure
+    tmp_dir = f"{closure_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    arrays = {
+        "descendants_indptr": closure.descendants.indptr,
+        "descendants_indices": closure.descendants.indices,
+        "ancestors_indptr": closure.ancestors.indptr,
+        "ancestors_indices": closure.ancestors.indices,
+        "data": np.ones(closure.descendants.nnz, dtype=bool),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array.astype(np.int32 if name != "data" else bool))
+    try:
+        os.rename(tmp_dir, closure_dir)
+    except OSError:
+        # another process saved it first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@span("ontology_closure")
+def load_closure(ontology: ParsedOntology, cache_dir: str = ONTOLOGY_CACHE_DIR) -> OntologyClosure:
+    """
+    Load the closure for the ontology, memory-mapping the CSR arrays (read-only) so that
+    the pages are shared by all server processes. The closure is computed and saved on
+    first use.
+    """
+    closure_dir = _closure_dir(ontology, cache_dir)
+    if not os.path.exists(closure_dir):
+        save_closure(OntologyClosure(ontology), ontology, cache_dir)
+
+    arrays = {name: np.load(os.path.join(closure_dir, f"{name}.npy"), mmap_mode="r") for name in CLOSURE_ARRAYS}
+    n_terms = len(ontology.term_ids)
+
+    def csr(prefix):
+        matrix = sparse.csr_matrix(
+            (arrays["data"], arrays[f"{prefix}_indices"], arrays[f"{prefix}_indptr"]),
+            shape=(n_terms, n_terms),
+            copy=False,
+        )
+        # saved sorted, and the arrays are read-only
+        matrix.has_sorted_indices = True
+        return matrix
+
+    return OntologyClosure(ontology, descendants=csr("descendants"), ancestors=csr("ancestors"))
+
+
+# closures are expensive to build, so each ontology is loaded once and shared
+_closures = {}
+_closures_lock = threading.Lock()
+
+
+def get_ontology_closure(name: str = "CL") -> OntologyClosure:
+    """
+    Return the closure index for the named ontology, loading it on first use.
+    """
+    with _closures_lock:
+        if name not in _closures:
+            _closures[name] = load_closure(load_ontology(name))
+        return _closures[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the on-disk ontology cache")
+    parser.add_argument("--cache-dir", type=str, default=ONTOLOGY_CACHE_DIR, help="Cache directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sp = subparsers.add_parser("refresh", help="Download and cache the latest ontology releases")
+    sp.add_argument("names", nargs="*", default=SERVER_ONTOLOGIES, help="Ontologies to refresh")
+
+    sp = subparsers.add_parser("list", help="List cached ontology versions")
+    sp.add_argument("names", nargs="*", default=SERVER_ONTOLOGIES, help="Ontologies to list")
+
+    args = parser.parse_args()
+    for name in args.names:
+        if args.command == "refresh":
+            ontology = refresh_ontology(name, args.cache_dir)
+            load_closure(ontology, args.cache_dir)
+            print(f"{name}: cached {len(ontology.term_ids)} terms, version {ontology.version}")
+        else:
+            index = _read_cache_index(name, args.cache_dir)
+            for version in index["versions"]:
+                print(f"{name}: {version}{' (current)' if version == index['current'] else ''}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
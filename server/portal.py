@@ -0,0 +1,334 @@
+"""
+Caching proxy for the cellxgene data portal API.
+
+Upstream responses are fetched over a pooled HTTP session, and kept (gzip compressed,
+exactly as they will be sent to clients) in memory and on disk. Requests are served
+from the cached copy. Once it is older than max_age, the cached copy is still served
+but is revalidated in the background with a conditional request (stale-while-revalidate).
+
+When served via ASGI (see asgi.py), aget() fetches with a non-blocking HTTP client.
+"""
+import os
+import asyncio
+import gzip
+import json
+import time
+import logging
+import hashlib
+import threading
+from collections import namedtuple, defaultdict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Response, request
+
+from util import atomic_write
+from metrics import span
+from ontology import SERVER_ONTOLOGIES, get_ontology_closure
+
+PORTAL_DATASETS_INDEX_URL = os.environ.get(
+    "PORTAL_DATASETS_INDEX_URL", "https://api.cellxgene.cziscience.com/dp/v1/datasets/index"
+)
+
+PORTAL_CACHE_DIR = os.environ.get(
+    "PORTAL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "portal_cache")
+)
+
+logger = logging.getLogger(__name__)
+
+# dataset fields containing lists of {"label", "ontology_term_id"}
+DATASET_TERM_FIELDS = [
+    "assay",
+    "cell_type",
+    "development_stage",
+    "disease",
+    "organism",
+    "self_reported_ethnicity",
+    "sex",
+    "tissue",
+]
+
+# body is always gzip compressed
+UpstreamEntry = namedtuple("UpstreamEntry", ["body", "content_type", "etag", "last_modified", "fetched_at"])
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# shared by all upstream proxies
+session = _create_session()
+
+# shared by all upstream proxies, when served via ASGI. Created on first use, in the event loop.
+async_client = None
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    global async_client
+    if async_client is None:
+        async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+            transport=httpx.AsyncHTTPTransport(retries=3),
+        )
+    return async_client
+
+
+class CachedUpstream:
+    """
+    A cached, conditional, stale-while-revalidate proxy for a single upstream URL.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        max_age: float = 300,
+        timeout: float = 30,
+        cache_dir: str = PORTAL_CACHE_DIR,
+        on_update=None,
+    ):
+        """
+        on_update, if specified, is called with each new upstream body (ie, on load or
+        on refresh, but not on revalidation), to update any data derived from it.
+        """
+        self.name = name
+        self.url = url
+        self.max_age = max_age
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_task = None
+        self._async_lock = None
+        self._on_update = on_update
+        # loaded from the disk copy (or fetched) on first use
+        self._entry = None
+
+    def get(self) -> UpstreamEntry:
+        """
+        Return the cached upstream response, loading the disk copy or fetching it if
+        there is no cached copy, and starting a background refresh if the cached copy
+        is stale.
+        """
+        entry = self._entry
+        if entry is None:
+            with self._lock:
+                if self._entry is None:
+                    self._set_entry(self._load() or self._fetch(None))
+                entry = self._entry
+
+        if time.time() - entry.fetched_at > self.max_age:
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                threading.Thread(target=self._refresh, name=f"refresh-{self.name}", daemon=True).start()
+
+        return entry
+
+    async def aget(self) -> UpstreamEntry:
+        """
+        Async equivalent of get(), for use from an event loop.
+        """
+        entry = self._entry
+        if entry is None:
+            if self._async_lock is None:
+                self._async_lock = asyncio.Lock()
+            async with self._async_lock:
+                if self._entry is None:
+                    loaded = await asyncio.to_thread(self._load)
+                    await asyncio.to_thread(self._set_entry, loaded or await self._afetch(None))
+                entry = self._entry
+
+        if time.time() - entry.fetched_at > self.max_age:
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                # keep a reference to the task, so it isn't garbage collected before completion
+                self._refresh_task = asyncio.create_task(self._arefresh())
+
+        return entry
+
+    async def _arefresh(self):
+        try:
+            entry = await self._afetch(self._entry)
+            # updating derived data may be slow, so keep it off the event loop
+            await asyncio.to_thread(self._set_entry, entry)
+        except Exception as e:
+            logger.warning(f"Failed to refresh {self.url}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh(self):
+        try:
+            self._set_entry(self._fetch(self._entry))
+        except Exception as e:
+            # keep serving the stale copy
+            logger.warning(f"Failed to refresh {self.url}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _set_entry(self, entry: UpstreamEntry):
+        if entry is None:
+            return
+        # update derived data before publishing the new entry
+        if self._on_update and (self._entry is None or self._entry.body is not entry.body):
+            self._on_update(entry)
+        self._entry = entry
+
+    def _request_headers(self, entry: UpstreamEntry) -> dict:
+        headers = {"Accept-Encoding": "gzip"}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def _new_entry(self, entry: UpstreamEntry, status_code: int, headers, body: bytes) -> UpstreamEntry:
+        # body is as received, ie, not decoded
+        if status_code == 304 and entry is not None:
+            entry = entry._replace(fetched_at=time.time())
+        else:
+            if headers.get("Content-Encoding") != "gzip":
+                body = gzip.compress(body)
+            entry = UpstreamEntry(
+                body=body,
+                content_type=headers.get("Content-Type", "application/json"),
+                etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+                fetched_at=time.time(),
+            )
+        self._save(entry)
+        return entry
+
+    @span("upstream_fetch")
+    def _fetch(self, entry: UpstreamEntry) -> UpstreamEntry:
+        headers = self._request_headers(entry)
+        with session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and entry is not None:
+                return self._new_entry(entry, response.status_code, response.headers, None)
+
+            response.raise_for_status()
+            # keep the bytes as received, rather than decoding and re-encoding them
+            body = response.raw.read(decode_content=False)
+            return self._new_entry(entry, response.status_code, response.headers, body)
+
+    async def _afetch(self, entry: UpstreamEntry) -> UpstreamEntry:
+        headers = self._request_headers(entry)
+        client = _get_async_client()
+        with span("upstream_fetch"):
+            async with client.stream("GET", self.url, headers=headers, timeout=self.timeout) as response:
+                if response.status_code == 304 and entry is not None:
+                    body = None
+                else:
+                    response.raise_for_status()
+                    # keep the bytes as received, rather than decoding and re-encoding them
+                    body = b"".join([chunk async for chunk in response.aiter_raw()])
+
+        # compressing and saving the entry may block, so keep it off the event loop
+        return await asyncio.to_thread(self._new_entry, entry, response.status_code, response.headers, body)
+
+    def _paths(self):
+        return (os.path.join(self.cache_dir, f"{self.name}.gz"), os.path.join(self.cache_dir, f"{self.name}.json"))
+
+    def _save(self, entry: UpstreamEntry):
+        body_path, meta_path = self._paths()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        meta = entry._asdict()
+        del meta["body"]
+        atomic_write(body_path, lambda f: f.write(entry.body))
+        atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    def _load(self) -> UpstreamEntry:
+        body_path, meta_path = self._paths()
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                return UpstreamEntry(body=f.read(), **meta)
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+
+
+def upstream_response(entry: UpstreamEntry) -> Response:
+    """
+    Create a conditional Flask response for the cached upstream entry, sending the
+    compressed bytes as-is to clients which accept gzip.
+    """
+    if request.accept_encodings.quality("gzip") > 0:
+        response = Response(entry.body, content_type=entry.content_type)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(gzip.decompress(entry.body), content_type=entry.content_type)
+    response.headers["Vary"] = "Accept-Encoding"
+
+    if entry.etag:
+        response.headers["ETag"] = entry.etag
+    else:
+        response.set_etag(hashlib.sha256(entry.body).hexdigest())
+    if entry.last_modified:
+        response.headers["Last-Modified"] = entry.last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+class DatasetTermIndex:
+    """
+    Inverted index from ontology term ID to the portal datasets annotated with that term.
+    """
+
+    def __init__(self, datasets: list, version: str):
+        self.datasets = datasets
+        self.version = version
+        by_term = defaultdict(set)
+        for i, dataset in enumerate(datasets):
+            for field in DATASET_TERM_FIELDS:
+                for term in dataset.get(field) or []:
+                    if isinstance(term, dict) and "ontology_term_id" in term:
+                        by_term[term["ontology_term_id"]].add(i)
+        self._by_term = {term_id: sorted(indices) for term_id, indices in by_term.items()}
+
+    def lookup(self, term_id: str, descendants: bool = False) -> list:
+        """
+        Return the datasets annotated with the term or, if descendants is True, with
+        the term or any of its descendants.
+        """
+        term_ids = [term_id]
+        ontology_name = term_id.split(":", 1)[0]
+        if descendants and ontology_name in SERVER_ONTOLOGIES:
+            term_ids = get_ontology_closure(ontology_name).relatives(term_id, descendants=True)
+
+        indices = set()
+        for t in term_ids:
+            indices.update(self._by_term.get(t, []))
+        return [self.datasets[i] for i in sorted(indices)]
+
+
+# rebuilt each time the portal datasets index changes
+datasets_by_term = None
+
+
+def _update_datasets_by_term(entry: UpstreamEntry):
+    global datasets_by_term
+    datasets = json.loads(gzip.decompress(entry.body))
+    datasets_by_term = DatasetTermIndex(datasets, hashlib.sha256(entry.body).hexdigest())
+
+
+def get_datasets_by_term() -> DatasetTermIndex:
+    # ensure the datasets index has been fetched (and is refreshed if stale)
+    portal_datasets.get()
+    return datasets_by_term
+
+
+portal_datasets = CachedUpstream("datasets_index", PORTAL_DATASETS_INDEX_URL, on_update=_update_datasets_by_term)
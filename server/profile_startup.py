@@ -0,0 +1,83 @@
+"""
+Startup profile of the server: the import time of app.py (and the slowest modules it
+imports), the time to start the warmup, time to first byte of the first requests, and
+the duration of each warmup step.
+
+    python profile_startup.py [--top N] [--no-warmup] [path ...]
+
+eg, python profile_startup.py /api/health /api/census/cellCounts
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+DEFAULT_PATHS = ["/api/health", "/api/ready", "/api/census/cellCounts"]
+
+
+def import_times(top: int) -> list:
+    """
+    Return the top modules by cumulative import time, as [(seconds, module)], by
+    importing the app in a fresh interpreter with -X importtime.
+    """
+    env = {**os.environ, "SERVER_WARMUP": "0"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        times.append((int(cumulative) / 1e6, module.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS, help="Requests to time, in order")
+    parser.add_argument("--top", type=int, default=20, help="Number of slowest imports to report")
+    parser.add_argument("--no-warmup", action="store_true", help="Time the requests without the background warmup")
+    args = parser.parse_args()
+
+    print("Slowest imports (cumulative seconds):")
+    for seconds, module in import_times(args.top):
+        print(f"  {seconds:8.3f}  {module}")
+
+    os.environ["SERVER_WARMUP"] = "0" if args.no_warmup else "1"
+    # as in a gunicorn worker: import the app, then start the warmup (see post_worker_init in gunicorn.conf.py)
+    os.environ["SERVER_WARMUP_ON_IMPORT"] = "0"
+    start = time.perf_counter()
+    import app
+
+    print(f"\nimport app: {time.perf_counter() - start:.3f}s")
+    if not args.no_warmup:
+        warmup_start = time.perf_counter()
+        app.start_warmup()
+        print(f"start warmup: {time.perf_counter() - warmup_start:.3f}s")
+
+    client = app.app.test_client()
+    print("\nRequests (seconds to first byte, and a repeat):")
+    for path in args.paths:
+        timings = []
+        for _ in range(2):
+            request_start = time.perf_counter()
+            response = client.get(path)
+            timings.append(time.perf_counter() - request_start)
+        print(f"  {timings[0]:8.3f}  {timings[1]:8.3f}  {response.status_code}  {path}")
+
+    if not args.no_warmup:
+        app.warmup.wait()
+        print(f"\nWarmup finished after {time.perf_counter() - start:.3f}s:")
+        for name, status in app.warmup.status.items():
+            print(f"  {status.get('seconds', 0):8.3f}  {status['state']:8}  {name}  {status.get('error', '')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,26 @@
 """ THIS MODULE WAS PORTED FROM DATA PORTAL CODE """
-from functools import lru_cache
-
-import numba as nb
 import numpy as np
-import owlready2
 import pandas as pd
+from scipy.sparse import csr_matrix
 
-CL_BASIC_PERMANENT_URL_OWL = "https://github.com/obophenotype/cell-ontology/releases/latest/download/cl-basic.owl"
-
-# ontology object
-ontology = owlready2.get_ontology(CL_BASIC_PERMANENT_URL_OWL)
-ontology.load()
+from ontology import get_ontology_closure
+from metrics import span
 
-ALL_CELL_ONTOLOGY_TERMS = [i.name.replace('_',':') for i in ontology.classes()]
 
-# cache finding descendants per cell type
-@lru_cache(maxsize=None)
-def _descendants(cell_type):
-    global ontology
-    cell_type_iri = cell_type.replace(":", "_")
-    entity = ontology.search_one(iri=f"http://purl.obolibrary.org/obo/{cell_type_iri}")
-    descendants = [i.name.replace("_", ":") for i in entity.descendants()] if entity else [cell_type]
-    return descendants
+def __getattr__(name):
+    # the cell ontology closure index is loaded on first use, rather than on import
+    if name == "ontology":
+        return get_ontology_closure("CL")
+    if name == "ALL_CELL_ONTOLOGY_TERMS":
+        return get_ontology_closure("CL").term_ids.tolist()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-@lru_cache(maxsize=None)
-def _ancestors(cell_type):
-    global ontology
-    cell_type_iri = cell_type.replace(":", "_")
-    entity = ontology.search_one(iri=f"http://purl.obolibrary.org/obo/{cell_type_iri}")
-    ancestors = [i.name.replace("_", ":") for i in entity.ancestors()] if entity else [cell_type]
-    return ancestors
+# dense rollup arrays with more elements than this are rolled up as sparse matrices instead
+MAX_DENSE_ROLLUP_SIZE = 2**26
 
 
-def find_lineage_per_cell_type(cell_types, descendants=True):
+def find_lineage_per_cell_type(cell_types, descendants=True, ontology_name="CL"):
     """
     Find the ancestors or descendants for each cell type in the input list.
 
@@ -45,65 +32,92 @@ def find_lineage_per_cell_type(cell_types, descendants=True):
     descendants : bool, optional, default=True
         If True, find descendants. If False, find ancestors.
 
+    ontology_name : str, optional, default="CL"
+        Name of the ontology containing the terms, eg, "CL" or "UBERON".
+
     Returns
     -------
     descendants_per_cell_type : list
         List of lists of descendants for each cell type in the input list.
     """
 
-    relatives_per_cell_type = []
-    for cell_type in cell_types:
-        relatives = _descendants(cell_type) if descendants else _ancestors(cell_type)
-        relatives_per_cell_type.append(relatives)
-
-    for i, children in enumerate(relatives_per_cell_type):
-        # remove descendent cell types that are not cell types in the WMG data
-        relatives_per_cell_type[i] = list(set(children).intersection(cell_types))
+    lineage = get_ontology_closure(ontology_name).lineage(cell_types, descendants=descendants)
+    cell_types = np.asarray(cell_types)
+    return [
+        cell_types[lineage.indices[lineage.indptr[i] : lineage.indptr[i + 1]]].tolist() for i in range(len(cell_types))
+    ]
 
-    return relatives_per_cell_type
 
 def rollup_across_cell_type_descendants(
-    df, cell_type_col="ontology_term_id", ignore_cols=None
+    df, cell_type_col="ontology_term_id", ignore_cols=None, sparse=None
 ) -> pd.DataFrame:
     """
     Aggregate values for each cell type across its descendants in the input dataframe.
+    See rollup_across_lineage.
+    """
+    return rollup_across_lineage(df, term_col=cell_type_col, ignore_cols=ignore_cols, sparse=sparse)
+
+
+@span("rollup")
+def rollup_across_lineage(
+    df, term_col="ontology_term_id", ontology_name="CL", descendants=True, ignore_cols=None, sparse=None
+) -> pd.DataFrame:
+    """
+    Aggregate values for each term across its descendants (or ancestors) in the input dataframe.
 
-    The non-numeric columns in the input dataframe must contain cell type ontology term IDs,
+    The non-numeric columns in the input dataframe must contain ontology term IDs,
     and are treated as the dimensions of a multi-dimensional numpy array. The numeric data in
     the dataframe is slotted into this array and rolled up along the first axis (which will always
-    correspond to the cell type ontology term IDs). The resulting rolled up array is reshaped back
+    correspond to the term column). The resulting rolled up array is reshaped back
     into the tidy dataframe and returned.
 
-    This ensures that cell types are only rolled up within each combination of other dimensions
+    This ensures that terms are only rolled up within each combination of other dimensions
     (e.g. tissue, gene, organism). We wouldn't want to roll up expressions across genes and tissues.
 
+    For high-dimensional inputs the dense array is mostly empty, and may not fit in memory. In
+    that case, the rollup is instead computed as the product of a sparse descendant indicator
+    matrix and a sparse (term x other dimensions) value matrix, using memory proportional
+    to the number of input rows.
+
     Parameters
     ----------
     df : pandas DataFrame
         Tidy dataframe containing the dimensions across which the numeric columns will be
-        aggregated. The dataframe must have a column containing the cell type ontology term IDs.
-        By default, the column name is "ontology_term_id".
+        aggregated. The dataframe must have a column containing the ontology term IDs to roll
+        up across. By default, the column name is "ontology_term_id".
+
+    term_col : str, optional, default="ontology_term_id"
+        Name of the column in the input dataframe containing the ontology term IDs.
 
-    cell_type_col : str, optional, default="ontology_term_id"
-        Name of the column in the input dataframe containing the cell type ontology term IDs.
+    ontology_name : str, optional, default="CL"
+        Name of the ontology containing the terms, eg, "CL" or "UBERON".
+
+    descendants : bool, optional, default=True
+        If True, roll up each term across its descendants. If False, across its ancestors.
 
     ignore_cols : list, optional, default=None
         List of column names to ignore when rolling up the numeric columns.
 
+    sparse : bool, optional, default=None
+        If True, use the sparse rollup. If False, use the dense rollup. By default, the sparse
+        rollup is used when the dense array would have more than MAX_DENSE_ROLLUP_SIZE elements.
+
     Returns
     -------
     df : pandas DataFrame
         Tidy dataframe with the same dimensions as the input dataframe, but with the numeric
-        columns aggregated across the cell type's descendants.
+        columns aggregated across each term's descendants (or ancestors).
     """
     df = df.copy()
+    if len(df) == 0:
+        return df
     # numeric data
     numeric_df = df.select_dtypes(include="number")
     # non-numeric data
     dimensions_df = df.select_dtypes(exclude="number")
-    # move the cell type column to the front of the dataframe
-    cell_type_column = dimensions_df.pop(cell_type_col)
-    dimensions_df.insert(0, cell_type_col, cell_type_column)
+    # move the term column to the front of the dataframe
+    term_column = dimensions_df.pop(term_col)
+    dimensions_df.insert(0, term_col, term_column)
 
     # calculate integer indices for each non-numeric column in the input dataframe
     # and calculate the shape of the output array
@@ -119,16 +133,33 @@ def rollup_across_cell_type_descendants(
     # the last dimension corresponds to the numeric columns
     dim_shapes.append(numeric_df.shape[1])
     dim_shapes = tuple(dim_shapes)
-    array_to_sum = np.zeros(dim_shapes)
-    # slot the numeric data into the multi-dimensional numpy array
-    array_to_sum[tuple(dim_indices)] = numeric_df.to_numpy()
 
-    cell_types = cell_type_column.unique()
+    terms = term_column.unique()
 
-    summed = rollup_across_cell_type_descendants_array(array_to_sum, cell_types)
+    if sparse is None:
+        sparse = np.prod(dim_shapes, dtype=np.float64) > MAX_DENSE_ROLLUP_SIZE
 
-    # extract numeric data and write back into the dataframe
-    summed = summed[tuple(dim_indices)]
+    if sparse:
+        # each unique combination of the other dimensions is a column of the value matrix
+        other_dims = dimensions_df.columns[1:].to_list()
+        if other_dims:
+            other_indices = dimensions_df.groupby(other_dims, sort=False, dropna=False).ngroup().to_numpy()
+        else:
+            other_indices = np.zeros(len(dimensions_df), dtype=np.int64)
+        summed = rollup_across_lineage_sparse(
+            dim_indices[0], other_indices, numeric_df.to_numpy(dtype=np.float64), terms, ontology_name, descendants
+        )
+    else:
+        array_to_sum = np.zeros(dim_shapes)
+        # slot the numeric data into the multi-dimensional numpy array
+        array_to_sum[tuple(dim_indices)] = numeric_df.to_numpy()
+
+        summed = rollup_across_lineage_array(array_to_sum, terms, ontology_name, descendants)
+
+        # extract numeric data
+        summed = summed[tuple(dim_indices)]
+
+    # write back into the dataframe
     dtypes = numeric_df.dtypes
     for col, array in zip(numeric_df.columns, summed.T):
         if ignore_cols and col not in ignore_cols or not ignore_cols:
@@ -156,30 +187,100 @@ def rollup_across_cell_type_descendants_array(array_to_sum, cell_types) -> np.nd
     summed : numpy array
         Multi-dimensional numpy array aggregated across the cell type's descendants.
     """
-    descendants = find_lineage_per_cell_type(cell_types)
-    # a pandas series to map cell types to their index in the input arrays
-    indexer = pd.Series(index=cell_types, data=range(len(cell_types)))
-    descendants_indexes = [indexer[children].to_numpy() for children in descendants]
-    # flatten the descendant indices into a single array and create a linear
-    # index array for slicing out the descendants per cell type. The array
-    # must be flattened to satisfy numba type requirements.
-    z = 0
-    linear_indices = [z]
-    for ix in descendants_indexes:
-        z += len(ix)
-        linear_indices.append(z)
-    linear_indices = np.array(linear_indices)
-    descendants_indexes = np.concatenate(descendants_indexes)
-
-    # roll up the multi-dimensional array across cell types (first axis)
-    summed = np.zeros_like(array_to_sum)
-    _sum_array_elements(array_to_sum, summed, descendants_indexes, linear_indices)
-    return summed
-
-
-@nb.njit(parallel=True, fastmath=True, nogil=True)
-def _sum_array_elements(array, summed, descendants_indexes, linear_indices):
-    for i in nb.prange(len(linear_indices) - 1):
-        index = descendants_indexes[linear_indices[i] : linear_indices[i + 1]]
-        for j in index:
-            summed[i] += array[j]
+    return rollup_across_lineage_array(array_to_sum, cell_types)
+
+
+def rollup_across_lineage_array(array_to_sum, terms, ontology_name="CL", descendants=True) -> np.ndarray:
+    """
+    Aggregate values for each term across its descendants (or ancestors) in the input array.
+    Terms must be the first dimension of the input array.
+
+    Parameters
+    ----------
+    array_to_sum : numpy array
+        Multi-dimensional numpy array containing the numeric data to be rolled up. The first
+        dimension must correspond to the ontology term IDs.
+
+    terms : list
+        List of ontology term IDs corresponding to the first dimension of the input
+
+    ontology_name : str, optional, default="CL"
+        Name of the ontology containing the terms.
+
+    descendants : bool, optional, default=True
+        If True, roll up across descendants. If False, across ancestors.
+
+    Returns
+    -------
+    summed : numpy array
+        Multi-dimensional numpy array aggregated across each term's lineage.
+    """
+    if array_to_sum.size == 0:
+        return array_to_sum.copy()
+
+    # the lineage positions of each term, in CSR form. The indices are already
+    # flattened into a single array with a linear index array for slicing out the
+    # lineage per term, which satisfies numba type requirements.
+    lineage = get_ontology_closure(ontology_name).lineage(terms, descendants=descendants)
+    descendants_indexes = lineage.indices.astype(np.int64)
+    linear_indices = lineage.indptr.astype(np.int64)
+
+    # the kernel is compiled (and cached) for a single set of argument types, so the
+    # other dimensions are flattened into one, and the values summed as float64
+    from rollup_kernel import sum_array_elements
+
+    array_2d = np.ascontiguousarray(array_to_sum, dtype=np.float64).reshape(array_to_sum.shape[0], -1)
+    summed = np.zeros_like(array_2d)
+
+    # roll up the multi-dimensional array across terms (first axis)
+    sum_array_elements(array_2d, summed, descendants_indexes, linear_indices)
+    return summed.reshape(array_to_sum.shape).astype(array_to_sum.dtype, copy=False)
+
+
+def rollup_across_lineage_sparse(
+    term_indices, other_indices, values, terms, ontology_name="CL", descendants=True
+) -> np.ndarray:
+    """
+    Aggregate values for each term across its descendants (or ancestors), using sparse matrices.
+
+    The values are slotted into a sparse matrix with one row per term, and one column per
+    (combination of other dimensions, numeric column). Left-multiplying by the lineage
+    indicator matrix sums each term's row across its lineage.
+
+    Parameters
+    ----------
+    term_indices : numpy array
+        Index (into terms) of the term of each input row.
+
+    other_indices : numpy array
+        Integer index of the combination of the other (non-term) dimensions of each input row.
+
+    values : numpy array
+        Two-dimensional array of shape (n_rows, n_numeric_columns) containing the numeric data
+        to be rolled up. Duplicate (term, other dimensions) rows are summed.
+
+    terms : list
+        List of ontology term IDs.
+
+    ontology_name : str, optional, default="CL"
+        Name of the ontology containing the terms.
+
+    descendants : bool, optional, default=True
+        If True, roll up across descendants. If False, across ancestors.
+
+    Returns
+    -------
+    summed : numpy array
+        Array with the same shape as values, aggregated across each term's lineage.
+    """
+    n_rows, n_cols = values.shape
+    if n_rows == 0:
+        return np.zeros((0, n_cols))
+    n_other = int(other_indices.max()) + 1
+    rows = np.repeat(term_indices, n_cols)
+    cols = (np.repeat(other_indices, n_cols) * n_cols) + np.tile(np.arange(n_cols), n_rows)
+    value_matrix = csr_matrix((values.ravel(), (rows, cols)), shape=(len(terms), n_other * n_cols))
+
+    lineage = get_ontology_closure(ontology_name).lineage(terms, descendants=descendants).astype(np.float64)
+    summed = (lineage @ value_matrix).tocsr()
+    return np.asarray(summed[rows, cols]).reshape(n_rows, n_cols)
@@ -0,0 +1,47 @@
+"""
+The numba rollup kernel.
+
+The kernel is only ever called with one set of argument types (see
+rollup_across_lineage_array), and is cached on disk (cache=True, in __pycache__ or
+NUMBA_CACHE_DIR), so that server processes load the compiled kernel rather than JIT
+compiling it. The Docker build compiles it into the image with:
+
+    python rollup_kernel.py
+
+Importing numba is slow, so the kernel is compiled on first use, or by the warmup (see
+warmup.py), rather than when the app is imported. numba's parallel thread pool is
+started by the server's main thread just before the warmup, see init_threads().
+"""
+import numba as nb
+import numpy as np
+
+
+@nb.njit(parallel=True, fastmath=True, nogil=True, cache=True)
+def sum_array_elements(array, summed, descendants_indexes, linear_indices):
+    for i in nb.prange(len(linear_indices) - 1):
+        index = descendants_indexes[linear_indices[i] : linear_indices[i + 1]]
+        for j in index:
+            summed[i] += array[j]
+
+
+def init_threads():
+    """
+    Start numba's parallel thread pool. This must be called from the main thread before
+    the kernel is first compiled or called from any other thread (eg, the warmup or
+    request threads), as a pool started by another thread hangs the process on exit.
+    The server calls it with the warmup, see start_warmup in app.py.
+    """
+    nb.get_num_threads()
+
+
+def compile_kernel():
+    """
+    Compile the kernel (or load it from the disk cache) for the argument types it is
+    called with: 2D float64 arrays, and int64 indices.
+    """
+    array = np.zeros((1, 1), dtype=np.float64)
+    sum_array_elements(array, np.zeros_like(array), np.zeros(1, dtype=np.int64), np.array([0, 1], dtype=np.int64))
+
+
+if __name__ == "__main__":
+    compile_kernel()
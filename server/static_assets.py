@@ -0,0 +1,167 @@
+"""
+Precompressed, content-addressed serving of the large static files the frontend loads.
+
+Each asset is published under a content-hashed name (eg, dataset_graph.<hash>.json),
+which is served with immutable cache headers. The gzip and (if the brotli package is
+installed) brotli variants are compressed once, and stored next to the source file or
+in STATIC_CACHE_DIR, using the same naming as create-graph, eg,
+dataset_graph.<hash>.json.gz. They are never recompressed per request.
+
+To create the variants ahead of time:
+
+    python static_assets.py build
+"""
+import os
+import sys
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import Response, request
+
+from util import atomic_write
+
+STATIC_ASSETS_DIR = os.environ.get(
+    "STATIC_ASSETS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public")
+)
+STATIC_CACHE_DIR = os.environ.get(
+    "STATIC_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static_cache")
+)
+
+STATIC_ASSETS = ["dataset_graph.json", "ens_gene_convert.json"]
+
+# content encodings, in order of preference, with their file suffix and compression function
+ENCODINGS = [
+    ("br", ".br", lambda body: brotli.compress(body, quality=11) if brotli else None),
+    ("gzip", ".gz", lambda body: gzip.compress(body, compresslevel=9, mtime=0)),
+]
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def hashed_name(name: str, body: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:16]}{ext}"
+
+
+class StaticAsset:
+    """
+    A static file, and its precompressed variants, held in memory.
+    """
+
+    def __init__(self, path: str, cache_dir: str = STATIC_CACHE_DIR):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as f:
+            body = f.read()
+        self.name = os.path.basename(path)
+        self.hashed_name = hashed_name(self.name, body)
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = {"identity": body}
+        for encoding, suffix, compress in ENCODINGS:
+            variant = self._load_variant(suffix, cache_dir)
+            if variant is None:
+                variant = compress(body)
+                if variant is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    atomic_write(os.path.join(cache_dir, self.hashed_name + suffix), lambda f: f.write(variant))
+            if variant is not None:
+                self.variants[encoding] = variant
+
+    def _load_variant(self, suffix: str, cache_dir: str) -> bytes:
+        # as written by create-graph, or by a previous server process
+        for directory in [os.path.dirname(self.path), cache_dir]:
+            try:
+                with open(os.path.join(directory, self.hashed_name + suffix), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+        return None
+
+    def response(self, immutable: bool) -> Response:
+        """
+        Create a conditional, range-capable Flask response, with the best encoding
+        the client accepts.
+        """
+        encoding = next(
+            (e for e, _, _ in ENCODINGS if e in self.variants and request.accept_encodings.quality(e) > 0), "identity"
+        )
+        body = self.variants[encoding]
+        response = Response(body, mimetype=self.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        # each encoding is a different representation, so has its own ETag
+        response.set_etag(f"{self.hashed_name}-{encoding}")
+        response.headers["Cache-Control"] = IMMUTABLE if immutable else "no-cache"
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
+
+_assets = {}
+_lock = threading.Lock()
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def get_static_asset(name: str) -> StaticAsset:
+    """
+    Return the named asset, reloading it if the file has changed, or None if the file
+    does not exist.
+    """
+    asset = _assets.get(name)
+    path = os.path.join(STATIC_ASSETS_DIR, name)
+    mtime = _mtime(path)
+    if mtime is None:
+        _assets.pop(name, None)
+        return None
+    if asset is None or mtime != asset.mtime:
+        with _lock:
+            asset = _assets.get(name)
+            if asset is None or _mtime(path) != asset.mtime:
+                asset = _assets[name] = StaticAsset(path)
+    return asset
+
+
+def find_static_asset(filename: str):
+    """
+    Return (asset, is hashed name) for a logical or content-hashed file name, or (None, False).
+    """
+    for name in STATIC_ASSETS:
+        if filename == name:
+            return get_static_asset(name), False
+        stem, ext = os.path.splitext(name)
+        if filename.startswith(stem + ".") and filename.endswith(ext):
+            asset = get_static_asset(name)
+            # an outdated hash is not found, rather than served with the wrong content
+            return (asset, True) if asset is not None and filename == asset.hashed_name else (None, False)
+    return None, False
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "build":
+        for name in STATIC_ASSETS:
+            asset = get_static_asset(name)
+            if asset is None:
+                print(f"{name}: not found in {STATIC_ASSETS_DIR}")
+                continue
+            print(f"{asset.hashed_name}: {', '.join(asset.variants)}")
+    else:
+        print("Usage: python static_assets.py build")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
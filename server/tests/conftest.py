@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the server modules are imported flat, as when running from server/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
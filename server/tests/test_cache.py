@@ -0,0 +1,182 @@
+"""
+Coalescing of concurrent computations, and the in-memory LRU cache's fallthrough to the disk cache.
+"""
+import os
+import time
+import threading
+
+import pytest
+
+import cache
+from cache import LRUCache, SingleFlight
+from disk_cache import DiskCache
+
+N_THREADS = 8
+
+
+class _WaitCountingEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.n_waiting = 0
+        self._count_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self._count_lock:
+            self.n_waiting += 1
+        return super().wait(timeout)
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # the in-flight calls, whose done event counts the callers waiting on it
+    calls = []
+
+    class Call(cache._Call):
+        def __init__(self):
+            super().__init__()
+            self.done = _WaitCountingEvent()
+            calls.append(self)
+
+    monkeypatch.setattr(cache, "_Call", Call)
+    return calls
+
+
+def wait_for(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def run_concurrently(fn, n_threads: int, calls: list, release: threading.Event) -> list:
+    """
+    Call fn() from n_threads threads, releasing the first call once all others are waiting
+    on it. Return the results (or exceptions) of each thread.
+    """
+    results = [None] * n_threads
+
+    def run(i):
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    wait_for(lambda: len(calls) == 1 and calls[0].done.n_waiting == n_threads - 1)
+    release.set()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_single_flight_shares_one_call(calls):
+    flight = SingleFlight()
+    release = threading.Event()
+    n_calls = []
+
+    def compute():
+        n_calls.append(1)
+        release.wait()
+        return object()
+
+    results = run_concurrently(lambda: flight.do("key", compute), N_THREADS, calls, release)
+    assert len(n_calls) == 1
+    assert all(r is results[0] for r in results)
+
+    # the call is forgotten once complete
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def test_single_flight_shares_errors(calls):
+    flight = SingleFlight()
+    release = threading.Event()
+    error = RuntimeError("failed")
+
+    def compute():
+        release.wait()
+        raise error
+
+    results = run_concurrently(lambda: flight.do("key", compute), N_THREADS, calls, release)
+    assert all(r is error for r in results)
+    assert flight.do("key", lambda: "retried") == "retried"
+
+
+def test_single_flight_keys_are_independent():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: flight.do("b", lambda: "b") + "a") == "ba"
+
+
+@pytest.fixture
+def disk(tmp_path):
+    return DiskCache(os.path.join(tmp_path, "cache.sqlite"))
+
+
+def test_lru_evicts_least_recently_used():
+    lru = LRUCache(maxsize=2)
+    lru.put(("a",), 1)
+    lru.put(("b",), 2)
+    assert lru.get(("a",)) == 1
+    lru.put(("c",), 3)
+    assert lru.get(("b",)) is None
+    assert lru.get(("a",)) == 1
+    assert lru.get(("c",)) == 3
+
+
+def test_lru_falls_through_to_disk(disk):
+    lru = LRUCache(maxsize=1, persist="test", disk=disk)
+    lru.put(("a", 1), "first")
+    lru.put(("b", 1), "second")
+    assert lru._lookup(("a", 1)) == ("first", "disk_hit")
+    # and is back in memory
+    assert lru._lookup(("a", 1)) == ("first", "hit")
+    assert lru._lookup(("c", 1)) == (None, "miss")
+
+    # not persisted, so not looked up on disk
+    memory_only = LRUCache(maxsize=1, disk=disk)
+    memory_only.put(("a", 1), "first")
+    memory_only.put(("b", 1), "second")
+    assert memory_only._lookup(("a", 1)) == (None, "miss")
+
+
+def test_lru_namespaces_disk_entries(disk):
+    LRUCache(persist="one", disk=disk).put(("key",), "one")
+    assert LRUCache(persist="one", disk=disk).get(("key",)) == "one"
+    assert LRUCache(persist="two", disk=disk).get(("key",)) is None
+
+
+def test_get_or_compute_uses_disk_entries(disk):
+    LRUCache(persist="test", disk=disk).put(("key",), "persisted")
+    # eg, after a restart
+    restarted = LRUCache(persist="test", disk=disk)
+    assert restarted.get_or_compute(("key",), lambda: pytest.fail("recomputed")) == "persisted"
+
+
+def test_get_or_compute_coalesces_misses(calls, disk):
+    lru = LRUCache(persist="test", disk=disk)
+    release = threading.Event()
+    n_calls = []
+
+    def compute():
+        n_calls.append(1)
+        release.wait()
+        return "computed"
+
+    results = run_concurrently(lambda: lru.get_or_compute(("key",), compute), N_THREADS, calls, release)
+    assert results == ["computed"] * N_THREADS
+    assert len(n_calls) == 1
+    assert lru.get_or_compute(("key",), lambda: pytest.fail("recomputed")) == "computed"
+    assert disk.get(DiskCache.make_key("test", ("key",))) == "computed"
+
+
+def test_get_or_compute_does_not_cache_errors(disk):
+    lru = LRUCache(persist="test", disk=disk)
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        lru.get_or_compute(("key",), fail)
+    assert lru.get(("key",)) is None
+    assert lru.get_or_compute(("key",), lambda: "computed") == "computed"
@@ -0,0 +1,133 @@
+"""
+The ontology closure, checked against owlready2, and the dense and sparse rollups, checked against a
+brute force rollup, on a synthetic ontology.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import rollup
+from ontology import OntologyClosure, parse_owl
+
+N_TERMS = 150
+UNKNOWN_TERM = "CL:9999999"
+OBO = "http://purl.obolibrary.org/obo"
+
+
+def write_owl(path: str, n_terms: int, rng: np.random.Generator):
+    # a random DAG rooted at the first term, where each term has one or two earlier parents
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write(
+            f'<rdf:RDF xml:base="{OBO}/cl.owl" xmlns:owl="http://www.w3.org/2002/07/owl#"'
+            ' xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+            ' xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#">\n'
+        )
+        f.write(f'  <owl:Ontology rdf:about="{OBO}/cl.owl"/>\n')
+        for i in range(n_terms):
+            f.write(f'  <owl:Class rdf:about="{OBO}/CL_{i:07d}">\n')
+            n_parents = 0 if i == 0 else (2 if rng.random() < 0.2 else 1)
+            for parent in sorted(set(rng.integers(0, max(i, 1), size=n_parents).tolist())):
+                f.write(f'    <rdfs:subClassOf rdf:resource="{OBO}/CL_{parent:07d}"/>\n')
+            f.write("  </owl:Class>\n")
+        f.write("</rdf:RDF>\n")
+
+
+@pytest.fixture(scope="module")
+def owl_path(tmp_path_factory):
+    path = os.path.join(tmp_path_factory.mktemp("owl"), "CL.owl")
+    write_owl(path, N_TERMS, np.random.default_rng(0))
+    return path
+
+
+@pytest.fixture(scope="module")
+def parsed_ontology(owl_path):
+    return parse_owl("CL", f"file://{owl_path}")
+
+
+@pytest.fixture(scope="module")
+def closure(parsed_ontology):
+    return OntologyClosure(parsed_ontology)
+
+
+@pytest.fixture(scope="module")
+def owlready2_classes(owl_path):
+    owlready2 = pytest.importorskip("owlready2")
+    onto = owlready2.World().get_ontology(f"file://{owl_path}").load()
+    return {c.name.replace("_", ":"): c for c in onto.classes()}
+
+
+
+@pytest.fixture
+def use_closure(closure, monkeypatch):
+    monkeypatch.setattr(rollup, "get_ontology_closure", lambda name="CL": closure)
+
+
+def term_ids(classes) -> set:
+    return {c.name.replace("_", ":") for c in classes if c.name.startswith("CL_")}
+
+
+def test_closure_matches_owlready2(closure, owlready2_classes):
+    assert len(owlready2_classes) == N_TERMS
+    for term, c in owlready2_classes.items():
+        assert set(closure.relatives(term, descendants=True)) == term_ids(c.descendants())
+        assert set(closure.relatives(term, descendants=False)) == term_ids(c.ancestors())
+
+
+def test_closure_unknown_terms(closure):
+    assert closure.relatives(UNKNOWN_TERM, descendants=True) == [UNKNOWN_TERM]
+    assert closure.relatives(UNKNOWN_TERM, descendants=False) == [UNKNOWN_TERM]
+
+    terms = ["CL:0000000", UNKNOWN_TERM, "CL:0000001"]
+    lineage = closure.lineage(terms, descendants=True).toarray()
+    # the unknown term is only related to itself
+    assert lineage[1].tolist() == [False, True, False]
+    assert lineage[:, 1].tolist() == [False, True, False]
+
+
+def brute_force_rollup(df, closure, descendants):
+    # for each row, sum the rows of the same tissue whose term is in the row's lineage
+    summed = df.copy()
+    for i, (term, tissue) in enumerate(zip(df["ontology_term_id"], df["tissue"])):
+        relatives = set(closure.relatives(term, descendants=descendants))
+        rows = df[(df["tissue"] == tissue) & df["ontology_term_id"].isin(relatives)]
+        for col in ["n_cells", "sum"]:
+            summed.iloc[i, summed.columns.get_loc(col)] = rows[col].sum()
+    return summed
+
+
+def random_frame(closure, rng, n_rows=300):
+    terms = np.array(closure.term_ids.tolist() + [UNKNOWN_TERM], dtype=object)
+    return pd.DataFrame(
+        {
+            "ontology_term_id": rng.choice(terms, size=n_rows),
+            "tissue": rng.choice(["UBERON:0000001", "UBERON:0000002", "UBERON:0000003"], size=n_rows),
+            "n_cells": rng.integers(0, 100, size=n_rows),
+            "sum": rng.random(n_rows),
+        }
+    ).drop_duplicates(subset=["ontology_term_id", "tissue"], ignore_index=True)
+
+
+@pytest.mark.parametrize("descendants", [True, False])
+def test_rollup_dense_sparse_brute_force(closure, use_closure, descendants):
+    df = random_frame(closure, np.random.default_rng(1))
+    expected = brute_force_rollup(df, closure, descendants)
+    dense = rollup.rollup_across_lineage(df, descendants=descendants, sparse=False)
+    sparse = rollup.rollup_across_lineage(df, descendants=descendants, sparse=True)
+
+    pd.testing.assert_frame_equal(dense, expected)
+    pd.testing.assert_frame_equal(sparse, expected)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_rollup_empty_frame(use_closure, sparse):
+    df = pd.DataFrame(
+        {
+            "ontology_term_id": pd.Series([], dtype=object),
+            "tissue": pd.Series([], dtype=object),
+            "n_cells": pd.Series([], dtype=np.int64),
+        }
+    )
+    pd.testing.assert_frame_equal(rollup.rollup_across_lineage(df, sparse=sparse), df)
@@ -0,0 +1,64 @@
+"""
+Slicing of the rollup cube by organism and category.
+"""
+import pandas as pd
+import pytest
+
+from cube import RollupCube
+
+# (organism, category, ontology_term_id, unique_cell_count), deliberately not sorted by (organism, category)
+COUNTS = [
+    ("mus_musculus", "cell_type", "CL:0000001", 5),
+    ("homo_sapiens", "tissue", "UBERON:0000001", 7),
+    ("homo_sapiens", "cell_type", "CL:0000001", 10),
+    ("mus_musculus", "cell_type", "CL:0000002", 3),
+    ("homo_sapiens", "cell_type", "CL:0000002", 0),
+    ("homo_sapiens", "tissue", "UBERON:0000002", 2),
+    ("homo_sapiens", "cell_type", "CL:0000003", 4),
+]
+
+
+@pytest.fixture
+def cube():
+    df = pd.DataFrame(COUNTS, columns=["organism", "category", "ontology_term_id", "unique_cell_count"])
+    # distinct values, to check that the columns of each row stay together
+    df["unique_cell_count_with_descendants"] = df["unique_cell_count"] * 100
+    df["unique_cell_count_with_ancestors"] = df["unique_cell_count"] * 1000
+    return RollupCube(df, ("census", "ontologies"))
+
+
+def expected_slice(organism: str, category: str, direction: str) -> pd.DataFrame:
+    multiplier = 100 if direction == "descendants" else 1000
+    rows = [(t, n, n * multiplier) for o, c, t, n in COUNTS if (o, c) == (organism, category)]
+    return pd.DataFrame(rows, columns=["ontology_term_id", "unique_cell_count", f"unique_cell_count_with_{direction}"])
+
+
+@pytest.mark.parametrize("direction", ["descendants", "ancestors"])
+@pytest.mark.parametrize(
+    "organism, category", [("homo_sapiens", "cell_type"), ("homo_sapiens", "tissue"), ("mus_musculus", "cell_type")]
+)
+def test_slice(cube, organism, category, direction):
+    expected = expected_slice(organism, category, direction)
+    pd.testing.assert_frame_equal(cube.slice(organism, category, direction), expected)
+
+
+def test_contains(cube):
+    assert ("homo_sapiens", "cell_type") in cube
+    assert ("mus_musculus", "cell_type") in cube
+    assert ("mus_musculus", "tissue") not in cube
+    assert ("homo_sapiens", "disease") not in cube
+
+
+def test_missing_slice(cube):
+    with pytest.raises(KeyError):
+        cube.slice("mus_musculus", "tissue", "descendants")
+
+
+def test_version(cube):
+    assert cube.version == ("census", "ontologies")
+
+
+def test_empty_cube():
+    columns = ["organism", "category", "ontology_term_id", "unique_cell_count", "unique_cell_count_with_descendants"]
+    cube = RollupCube(pd.DataFrame(columns=columns), "version")
+    assert ("homo_sapiens", "cell_type") not in cube
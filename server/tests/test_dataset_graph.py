@@ -0,0 +1,71 @@
+"""
+Term search over the dataset graph's labels and synonyms.
+"""
+import pytest
+
+from dataset_graph import DatasetGraph
+
+GRAPH = {
+    "ontologies": {
+        "CL": {
+            "CL:0000000": {"label": "cell", "synonyms": []},
+            "CL:0000084": {"label": "T cell", "synonyms": ["T lymphocyte", "T-cell"], "parents": ["CL:0000000"]},
+            "CL:0002419": {"label": "mature T cell", "parents": ["CL:0000084"]},
+            "CL:0000236": {"label": "B cell", "synonyms": ["B lymphocyte"], "parents": ["CL:0000000"]},
+        },
+        "UBERON": {
+            "UBERON:0005162": {"label": "cell layer", "synonyms": []},
+            "UBERON:0002107": {"label": "liver", "synonyms": ["hepar"]},
+        },
+    }
+}
+
+
+@pytest.fixture(scope="module")
+def search_index():
+    return DatasetGraph(GRAPH, "version").search_index
+
+
+def test_whole_name_prefix_ranks_first(search_index):
+    results = search_index.search("t cell")
+    assert results[:2] == [("CL:0000084", "T cell"), ("CL:0002419", "mature T cell")]
+
+
+def test_matches_each_term_once(search_index):
+    term_ids = [term_id for term_id, _ in search_index.search("t")]
+    assert term_ids.count("CL:0000084") == 1
+
+
+def test_matches_later_words_and_synonyms(search_index):
+    assert search_index.search("lymph")[:2] == [("CL:0000084", "T lymphocyte"), ("CL:0000236", "B lymphocyte")]
+    assert search_index.search("hep") == [("UBERON:0002107", "hepar")]
+
+
+def test_normalizes_the_query(search_index):
+    assert search_index.search("  T-CELL ")[0] == ("CL:0000084", "T cell")
+
+
+def test_fuzzy_matches(search_index):
+    assert search_index.search("lymphocite")[:2] == [("CL:0000084", "T lymphocyte"), ("CL:0000236", "B lymphocyte")]
+    assert search_index.search("livers")[0] == ("UBERON:0002107", "liver")
+
+
+def test_prefix_matches_rank_above_fuzzy_matches(search_index):
+    results = search_index.search("cell")
+    # whole name prefix matches, shortest first, then later word prefix matches
+    assert results[:2] == [("CL:0000000", "cell"), ("UBERON:0005162", "cell layer")]
+    assert {term_id for term_id, _ in results[2:5]} == {"CL:0000084", "CL:0002419", "CL:0000236"}
+
+
+def test_filters_by_ontology(search_index):
+    assert search_index.search("cell", ontology_name="UBERON") == [("UBERON:0005162", "cell layer")]
+    assert all(term_id.startswith("CL:") for term_id, _ in search_index.search("cell", ontology_name="CL"))
+
+
+def test_limit(search_index):
+    assert len(search_index.search("cell", limit=2)) == 2
+
+
+@pytest.mark.parametrize("query", ["", " ", "-"])
+def test_empty_query(search_index, query):
+    assert search_index.search(query) == []
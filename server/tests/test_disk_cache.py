@@ -0,0 +1,127 @@
+"""
+Size-bounded, least recently used eviction, and batched access time updates, of the disk cache.
+"""
+import os
+import pickle
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import disk_cache
+from disk_cache import ACCESS_TIME_RESOLUTION, DiskCache
+
+VALUE = b"x" * 1000
+VALUE_SIZE = len(pickle.dumps(VALUE, protocol=pickle.HIGHEST_PROTOCOL))
+N_ENTRIES = 10
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(disk_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return os.path.join(tmp_path, "cache.sqlite")
+
+
+@pytest.fixture
+def cache(clock, cache_path):
+    # fits exactly N_ENTRIES entries
+    cache = DiskCache(cache_path, max_bytes=N_ENTRIES * VALUE_SIZE)
+    for i in range(N_ENTRIES):
+        cache.put(f"key{i}", VALUE)
+        clock.now += 1
+    return cache
+
+
+def read_rows(cache_path: str) -> dict:
+    with sqlite3.connect(cache_path) as conn:
+        return dict(conn.execute("SELECT key, accessed FROM entries").fetchall())
+
+
+def read_sizes(cache_path: str) -> tuple:
+    with sqlite3.connect(cache_path) as conn:
+        (total_size,) = conn.execute("SELECT total_size FROM stats").fetchone()
+        (sum_size,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+    return total_size, sum_size
+
+
+def test_round_trip(cache):
+    assert cache.get("key0") == VALUE
+    assert cache.get("missing") is None
+    cache.put("key0", {"replaced": [1, 2]})
+    assert cache.get("key0") == {"replaced": [1, 2]}
+
+
+def test_total_size_is_maintained(cache, cache_path):
+    assert read_sizes(cache_path) == (N_ENTRIES * VALUE_SIZE, N_ENTRIES * VALUE_SIZE)
+    # replacing an entry updates its size
+    cache.put("key0", b"")
+    total_size, sum_size = read_sizes(cache_path)
+    assert total_size == sum_size < N_ENTRIES * VALUE_SIZE
+    # as does eviction
+    for i in range(N_ENTRIES, 3 * N_ENTRIES):
+        cache.put(f"key{i}", VALUE)
+    total_size, sum_size = read_sizes(cache_path)
+    assert total_size == sum_size <= cache.max_bytes
+
+
+def test_evicts_least_recently_used(cache, clock, cache_path):
+    # a read of an entry older than the access time resolution updates its access time
+    clock.now += ACCESS_TIME_RESOLUTION + 1
+    assert cache.get("key0") == VALUE
+
+    # one over the bound, which frees down to EVICT_TO_FRACTION of it, ie, at least two entries
+    cache.put("new", VALUE)
+    keys = set(read_rows(cache_path))
+    evicted = {f"key{i}" for i in range(N_ENTRIES)} - keys
+    assert {"key0", "new"} <= keys
+    assert len(evicted) >= 2
+    assert evicted == {f"key{i}" for i in range(1, len(evicted) + 1)}
+    assert read_sizes(cache_path)[0] <= cache.max_bytes * disk_cache.EVICT_TO_FRACTION
+
+
+def test_does_not_store_entries_larger_than_the_cache(cache, cache_path):
+    cache.put("huge", b"x" * (cache.max_bytes + 1))
+    assert cache.get("huge") is None
+    assert len(read_rows(cache_path)) == N_ENTRIES
+
+
+def test_batches_access_time_updates(cache, clock, cache_path):
+    clock.now += ACCESS_TIME_RESOLUTION + 1
+    cache.get("key0")
+    accessed = read_rows(cache_path)
+    assert accessed["key0"] == clock.now
+
+    # within the resolution of the last write, reads are queued, not written
+    clock.now += 1
+    cache.get("key1")
+    cache.get("key2")
+    assert read_rows(cache_path) == accessed
+
+    # until the next write
+    cache.put("new", b"")
+    accessed = read_rows(cache_path)
+    assert accessed["key1"] == accessed["key2"] == clock.now
+
+
+def test_writes_full_batches_of_access_times(cache, clock, cache_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "TOUCH_BATCH_SIZE", 3)
+    # the first read writes, as it is a while since the cache was opened
+    clock.now += ACCESS_TIME_RESOLUTION + 1
+    cache.get("key0")
+    clock.now += 1
+    cache.get("key1")
+    cache.get("key2")
+    assert read_rows(cache_path)["key2"] < clock.now
+    cache.get("key3")
+    accessed = read_rows(cache_path)
+    assert accessed["key1"] == accessed["key2"] == accessed["key3"] == clock.now
+
+
+def test_is_shared_by_instances(cache, cache_path):
+    assert DiskCache(cache_path).get("key0") == VALUE
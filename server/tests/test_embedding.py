@@ -0,0 +1,42 @@
+"""
+Validation of the embedding parameters.
+"""
+import pytest
+
+from embedding import DEFAULT_PARAMS, validate_params
+
+
+def test_defaults():
+    assert validate_params({}) == DEFAULT_PARAMS
+    # not the defaults themselves
+    assert validate_params({}) is not DEFAULT_PARAMS
+
+
+def test_overrides():
+    params = validate_params({"n_pca_components": 10, "n_neighbors": 200, "min_dist": 0})
+    assert params == {"n_pca_components": 10, "n_neighbors": 200, "min_dist": 0.0}
+    assert isinstance(params["min_dist"], float)
+
+
+def test_ignores_unknown_params():
+    assert validate_params({"metric": "cosine", "n_neighbors": 5}) == {**DEFAULT_PARAMS, "n_neighbors": 5}
+
+
+@pytest.mark.parametrize(
+    "params, message",
+    [
+        ({"n_pca_components": 10.0}, "n_pca_components must be an integer"),
+        ({"n_pca_components": "10"}, "n_pca_components must be an integer"),
+        ({"n_neighbors": True}, "n_neighbors must be an integer"),
+        ({"min_dist": None}, "min_dist must be a number"),
+        ({"min_dist": False}, "min_dist must be a number"),
+        ({"n_pca_components": 0}, "n_pca_components must be between 1 and 500"),
+        ({"n_pca_components": 501}, "n_pca_components must be between 1 and 500"),
+        ({"n_neighbors": 1}, "n_neighbors must be between 2 and 200"),
+        ({"min_dist": -0.1}, "min_dist must be between 0.0 and 1.0"),
+        ({"min_dist": 1.5}, "min_dist must be between 0.0 and 1.0"),
+    ],
+)
+def test_invalid_params(params, message):
+    with pytest.raises(ValueError, match=message):
+        validate_params(params)
@@ -0,0 +1,69 @@
+"""
+Layering, long edge routing and ordering of the Sugiyama layout.
+"""
+import itertools
+
+import networkx as nx
+import pytest
+
+from layout import sugiyama_layout
+
+# b, c and d are children of a, e is a child of b and c, and a, via a long edge
+EDGES = [("a", "b"), ("a", "c"), ("a", "d"), ("b", "e"), ("c", "e"), ("a", "e"), ("d", "f")]
+
+
+@pytest.fixture
+def layout():
+    return sugiyama_layout(nx.DiGraph(EDGES))
+
+
+def n_crossings(layout: dict) -> int:
+    # crossings of the edge segments between adjacent layers
+    segments = [(p, q) for edge in layout["edges"] for p, q in zip(edge["points"], edge["points"][1:])]
+    return sum(
+        1
+        for (p1, q1), (p2, q2) in itertools.combinations(segments, 2)
+        if p1[1] == p2[1] and (p1[0] - p2[0]) * (q1[0] - q2[0]) < 0
+    )
+
+
+def test_layers_by_longest_path(layout):
+    ranks = {term_id: y for term_id, (_, y) in layout["nodes"].items()}
+    assert ranks == {"a": 0, "b": 1, "c": 1, "d": 1, "e": 2, "f": 2}
+    assert layout["height"] == 3
+
+
+def test_routes_long_edges_through_dummy_points(layout):
+    points = {(edge["source"], edge["target"]): edge["points"] for edge in layout["edges"]}
+    assert set(points) == set(EDGES)
+    for (source, target), edge_points in points.items():
+        assert edge_points[0] == layout["nodes"][source]
+        assert edge_points[-1] == layout["nodes"][target]
+        # one point per layer
+        assert [y for _, y in edge_points] == list(range(edge_points[0][1], edge_points[-1][1] + 1))
+    assert len(points[("a", "e")]) == 3
+    # the dummy point takes a position in the layer
+    assert layout["width"] == 4
+
+
+def test_centers_and_separates_each_layer(layout):
+    points = [tuple(p) for edge in layout["edges"] for p in edge["points"]]
+    points += [tuple(p) for p in layout["nodes"].values()]
+    for rank in range(layout["height"]):
+        xs = sorted(set(x for x, y in points if y == rank))
+        assert sum(xs) == 0
+        assert all(x2 - x1 == 1 for x1, x2 in zip(xs, xs[1:]))
+
+
+def test_orders_layers_without_crossings(layout):
+    assert n_crossings(layout) == 0
+
+
+def test_empty_graph():
+    assert sugiyama_layout(nx.DiGraph()) == {"width": 0, "height": 0, "nodes": {}, "edges": []}
+
+
+def test_single_term():
+    g = nx.DiGraph()
+    g.add_node("a")
+    assert sugiyama_layout(g) == {"width": 1, "height": 1, "nodes": {"a": [0.0, 0]}, "edges": []}
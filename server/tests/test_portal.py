@@ -0,0 +1,159 @@
+"""
+The cached upstream proxy, against the portal stub: stale-while-revalidate, ETag revalidation and the disk copy.
+"""
+import gzip
+import json
+import time
+import hashlib
+
+import flask
+import pytest
+
+import bench_fixtures
+from portal import CachedUpstream, upstream_response
+
+DATASETS = [{"id": "dataset-1", "cell_type": [{"label": "T cell", "ontology_term_id": "CL:0000084"}]}]
+
+
+def wait_for(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def portal_stub(tmp_path):
+    (tmp_path / "portal").mkdir()
+    (tmp_path / "portal" / "datasets_index.json").write_text(json.dumps(DATASETS))
+    server = bench_fixtures.start_portal_stub(str(tmp_path))
+
+    # record the If-None-Match header of each request
+    server.requests = []
+
+    class RecordingHandler(server.RequestHandlerClass):
+        def do_GET(self):
+            server.requests.append(self.headers.get("If-None-Match"))
+            super().do_GET()
+
+    server.RequestHandlerClass = RecordingHandler
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def update_stub(server, body: bytes):
+    server.body = body
+    server.etag = f'"{hashlib.sha256(body).hexdigest()}"'
+
+
+@pytest.fixture
+def updates():
+    return []
+
+
+@pytest.fixture
+def upstream(portal_stub, tmp_path, updates):
+    return CachedUpstream(
+        "datasets_index", portal_stub.url, max_age=3600, cache_dir=str(tmp_path / "cache"), on_update=updates.append
+    )
+
+
+def test_fetches_on_first_use(upstream, portal_stub, updates):
+    entry = upstream.get()
+    assert json.loads(gzip.decompress(entry.body)) == DATASETS
+    assert entry.etag == portal_stub.etag
+    assert portal_stub.requests == [None]
+    assert updates == [entry]
+
+    # fresh, so served from memory
+    assert upstream.get() is entry
+    assert portal_stub.requests == [None]
+
+
+def test_serves_stale_entry_while_revalidating(upstream, portal_stub, updates):
+    entry = upstream.get()
+    upstream.max_age = 0
+    time.sleep(0.01)
+
+    # the stale entry is served without waiting for the refresh
+    assert upstream.get() is entry
+    wait_for(lambda: upstream._entry is not entry)
+
+    # which is a conditional request, and the upstream is unchanged
+    assert portal_stub.requests == [None, portal_stub.etag]
+    refreshed = upstream._entry
+    assert refreshed.body is entry.body
+    assert refreshed.etag == entry.etag
+    assert refreshed.fetched_at > entry.fetched_at
+    # so derived data isn't updated
+    assert updates == [entry]
+
+
+def test_refreshes_changed_upstream(upstream, portal_stub, updates):
+    entry = upstream.get()
+    changed = DATASETS + [{"id": "dataset-2"}]
+    update_stub(portal_stub, json.dumps(changed).encode("utf-8"))
+    upstream.max_age = 0
+    time.sleep(0.01)
+
+    assert upstream.get() is entry
+    wait_for(lambda: upstream._entry is not entry)
+    refreshed = upstream._entry
+    assert json.loads(gzip.decompress(refreshed.body)) == changed
+    assert refreshed.etag == portal_stub.etag
+    assert updates == [entry, refreshed]
+
+
+def test_starts_one_refresh_at_a_time(upstream, portal_stub):
+    entry = upstream.get()
+    upstream.max_age = 0
+    time.sleep(0.01)
+    for _ in range(10):
+        upstream.get()
+    wait_for(lambda: upstream._entry is not entry and not upstream._refreshing)
+    assert len(portal_stub.requests) <= 3
+
+
+def test_keeps_serving_stale_entry_if_refresh_fails(upstream, portal_stub):
+    entry = upstream.get()
+
+    class FailingHandler(portal_stub.RequestHandlerClass):
+        def do_GET(self):
+            self.send_error(500)
+
+    portal_stub.RequestHandlerClass = FailingHandler
+    upstream.max_age = 0
+    time.sleep(0.01)
+
+    assert upstream.get() is entry
+    wait_for(lambda: not upstream._refreshing)
+    assert upstream._entry is entry
+
+
+def test_loads_the_disk_copy(upstream, portal_stub, tmp_path):
+    entry = upstream.get()
+    # eg, after a restart
+    restarted = CachedUpstream("datasets_index", portal_stub.url, max_age=3600, cache_dir=str(tmp_path / "cache"))
+    assert restarted.get() == entry
+    assert portal_stub.requests == [None]
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, gzipped",
+    [("gzip, deflate", True), ("gzip;q=0, deflate", False), ("", False)],
+)
+def test_upstream_response(upstream, accept_encoding, gzipped):
+    entry = upstream.get()
+    app = flask.Flask(__name__)
+    with app.test_request_context(headers={"Accept-Encoding": accept_encoding}):
+        response = upstream_response(entry)
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == ("gzip" if gzipped else None)
+    assert response.get_data() == (entry.body if gzipped else gzip.decompress(entry.body))
+    assert response.headers["ETag"] == entry.etag
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    with app.test_request_context(headers={"Accept-Encoding": accept_encoding, "If-None-Match": entry.etag}):
+        response = upstream_response(entry)
+    assert response.status_code == 304
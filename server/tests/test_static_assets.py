@@ -0,0 +1,99 @@
+"""
+Choice of the precompressed variant of static assets by Accept-Encoding, and their conditional responses.
+"""
+import gzip
+
+import flask
+import pytest
+
+import static_assets
+from static_assets import IMMUTABLE, StaticAsset
+
+BODY = b'{"terms": []}' * 100
+
+
+@pytest.fixture
+def asset_path(tmp_path):
+    path = tmp_path / "public" / "dataset_graph.json"
+    path.parent.mkdir()
+    path.write_bytes(BODY)
+    return path
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "static_cache")
+
+
+@pytest.fixture
+def asset(asset_path, cache_dir):
+    # a brotli variant, as create-graph writes if the brotli package is installed
+    hashed_name = static_assets.hashed_name(asset_path.name, BODY)
+    (asset_path.parent / (hashed_name + ".br")).write_bytes(b"brotli")
+    return StaticAsset(str(asset_path), cache_dir=cache_dir)
+
+
+def get(asset: StaticAsset, immutable: bool = True, **headers):
+    with flask.Flask(__name__).test_request_context(headers=headers):
+        return asset.response(immutable)
+
+
+def test_variants(asset, asset_path, cache_dir):
+    assert asset.hashed_name.startswith("dataset_graph.") and asset.hashed_name.endswith(".json")
+    assert asset.variants["identity"] == BODY
+    assert gzip.decompress(asset.variants["gzip"]) == BODY
+    # compressed once, and kept for the next process
+    with open(f"{cache_dir}/{asset.hashed_name}.gz", "rb") as f:
+        assert f.read() == asset.variants["gzip"]
+    assert StaticAsset(str(asset_path), cache_dir=cache_dir).variants == asset.variants
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encoding",
+    [
+        ("gzip, deflate, br", "br"),
+        ("br;q=0.5, gzip", "br"),
+        ("gzip, deflate", "gzip"),
+        ("br;q=0, gzip", "gzip"),
+        ("*", "br"),
+        ("gzip;q=0, deflate", "identity"),
+        ("identity", "identity"),
+        (None, "identity"),
+    ],
+)
+def test_chooses_encoding(asset, accept_encoding, encoding):
+    headers = {} if accept_encoding is None else {"Accept-Encoding": accept_encoding}
+    response = get(asset, **headers)
+    assert response.status_code == 200
+    assert response.get_data() == asset.variants[encoding]
+    assert response.headers.get("Content-Encoding") == (None if encoding == "identity" else encoding)
+    assert response.headers["Vary"] == "Accept-Encoding"
+    # each encoding has its own ETag
+    assert response.get_etag() == (f"{asset.hashed_name}-{encoding}", False)
+
+
+def test_without_brotli_variant(asset_path, cache_dir):
+    if static_assets.brotli is not None:
+        pytest.skip("brotli variants are created when the brotli package is installed")
+    asset = StaticAsset(str(asset_path), cache_dir=cache_dir)
+    assert set(asset.variants) == {"identity", "gzip"}
+    assert get(asset, **{"Accept-Encoding": "br, gzip"}).headers["Content-Encoding"] == "gzip"
+
+
+def test_cache_control(asset):
+    assert get(asset, immutable=True).headers["Cache-Control"] == IMMUTABLE
+    assert get(asset, immutable=False).headers["Cache-Control"] == "no-cache"
+
+
+def test_conditional_response(asset):
+    etag = f'"{asset.hashed_name}-gzip"'
+    assert get(asset, **{"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+    # the ETag of another encoding doesn't match
+    assert get(asset, **{"Accept-Encoding": "identity", "If-None-Match": etag}).status_code == 200
+
+
+def test_range_response(asset):
+    response = get(asset, **{"Accept-Encoding": "identity", "Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.get_data() == BODY[:10]
+    assert response.headers["Content-Range"] == f"bytes 0-9/{len(BODY)}"
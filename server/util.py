@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+
+def atomic_write(path: str, write_fn):
+    """
+    Write a file by calling write_fn with a binary file object. The data is written
+    to a temp file in the same directory, then renamed, so that concurrent readers
+    (in any process) never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,82 @@
+"""
+Background warmup of the server's heavy subsystems.
+
+The server starts serving immediately, with everything initialized lazily on first
+use. The warmup initializes the slow parts (loading ontology closures, compiling the
+rollup kernel, opening the census, computing the rollup cube, ...) in a background
+thread, so that they are ready before the first real request, and reports progress
+for the readiness endpoint (/api/ready).
+
+Disable with SERVER_WARMUP=0, eg, for scripts which import the app.
+"""
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SERVER_WARMUP = os.environ.get("SERVER_WARMUP", "1").lower() in ("1", "true", "yes")
+# whether the app starts the warmup when it is imported, or is started by the server (see gunicorn.conf.py)
+SERVER_WARMUP_ON_IMPORT = os.environ.get("SERVER_WARMUP_ON_IMPORT", "1").lower() in ("1", "true", "yes")
+
+
+class Warmup:
+    """
+    Runs named steps, in order, in a background thread. A failed step is logged and
+    the remaining steps still run, as everything is also initialized on first use, but
+    the server is only ready once every required step is done.
+    """
+
+    def __init__(self, steps: list, optional: tuple = ()):
+        """
+        steps is a list of (name, fn). The named optional steps (eg, those depending on
+        upstream services) don't hold up readiness if they fail.
+        """
+        self.steps = steps
+        self.optional = set(optional)
+        self.status = {name: {"state": "pending"} for name, _ in steps}
+        self._finished = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self) -> bool:
+        """
+        True once the warmup has finished, and every required step is done.
+        """
+        return self._finished.is_set() and not self.failed
+
+    @property
+    def failed(self) -> list:
+        """
+        The names of the required steps which failed.
+        """
+        return [
+            name
+            for name, status in self.status.items()
+            if status["state"] == "failed" and name not in self.optional
+        ]
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def _run(self):
+        for name, fn in self.steps:
+            self.status[name] = {"state": "running"}
+            start = time.perf_counter()
+            try:
+                fn()
+                self.status[name] = {"state": "done", "seconds": round(time.perf_counter() - start, 3)}
+            except Exception as e:
+                logger.exception(f"Warmup step {name} failed")
+                self.status[name] = {
+                    "state": "failed",
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "error": str(e),
+                }
+        self._finished.set()